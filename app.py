@@ -1,32 +1,29 @@
 import streamlit as st
-import edge_tts
-from gtts import gTTS
-import asyncio
+import queue
+import threading
 import zipfile
-import io
-import shutil
-import sys
 import os
-import wave
-import requests
 import time
-import google.generativeai as genai
-from pathlib import Path
-
-# --- 1. 環境檢測 ---
-HAS_FFMPEG = False
-HAS_PYDUB = False
-
-if shutil.which("ffmpeg"):
-    HAS_FFMPEG = True
-
-try:
-    from pydub import AudioSegment
-    HAS_PYDUB = True
-except ImportError:
-    HAS_PYDUB = False
-
-# --- 2. 設定頁面 ---
+import uuid
+from audio_cache import AudioCache
+from batch_jobs import BatchJob, cleanup_jobs, job_id_for
+from engine_registry import preload_engine
+from job_runner import get_job_runner
+from long_text import DEFAULT_CHUNK_CHARS, split_text
+from metrics import STAGES, get_registry
+from prefetch import get_prefetcher
+from rate_limit import DEFAULT_RPM, get_limiter
+from transcode import DEFAULT_BITRATE, DEFAULT_BITRATES, can_encode, pcm_to_wav
+from tts_core import (
+    DEFAULT_CONCURRENCY, DEFAULT_MAX_ATTEMPTS, FALLBACK_ENGINES, GEMINI_PROMPTS, GEMINI_SAMPLE_RATE, HAS_FFMPEG, HAS_NUMPY,
+    HAS_PYDUB, LANG_GOOGLE, NATIVE_MP3_KBPS, VOICES_EDGE, VOICES_GEMINI, SynthesisError, build_gemini_text,
+    iter_gemini_pcm, parse_items,
+)
+from voice_catalog import get_voice_catalog, seed_voices
+from work_queue import QUEUE_DB
+from zip_export import DEFAULT_SPOOL_MAX_MB, new_export_path, open_spooled_archive
+
+# --- 1. 設定頁面 ---
 st.set_page_config(page_title="格育 - 兒童語音工具", page_icon="🧩", layout="wide")
 
 # Clean White/Red CSS
@@ -109,6 +106,16 @@ st.markdown("""
         margin-top: 1rem;
     }
 
+    .download-link {
+        display: inline-block;
+        background-color: #ef4444;
+        color: #ffffff !important;
+        padding: 0.5rem 1rem;
+        border-radius: 8px;
+        text-decoration: none;
+        font-weight: 500;
+    }
+
     .row-label {
         margin-top: 6px;
         font-size: 14px;
@@ -118,67 +125,8 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-# --- 3. 數據定義 ---
-
-# EDGE TTS
-VOICES_EDGE = {
-    "簡體中文 (中國)": {
-        "zh-CN-XiaoxiaoNeural": "🇨🇳 小曉 (女聲 - 活潑/推薦) 🔥",
-        "zh-CN-XiaoyiNeural": "🇨🇳 小藝 (女聲 - 氣質)",
-        "zh-CN-YunxiaNeural": "🇨🇳 雲夏 (女聲 - 溫馨) ✨",
-        "zh-CN-YunxiNeural": "🇨🇳 雲希 (男聲 - 帥氣)",
-        "zh-CN-YunjianNeural": "🇨🇳 雲健 (男聲 - 體育)",
-        "zh-CN-YunyangNeural": "🇨🇳 雲揚 (男聲 - 專業/播音)",
-    },
-    "繁體中文 (台灣)": {
-        "zh-TW-HsiaoChenNeural": "🇹🇼 曉臻 (女聲 - 溫柔/標準)",
-        "zh-TW-HsiaoYuNeural": "🇹🇼 曉雨 (女聲 - 清晰)",
-        "zh-TW-YunJheNeural": "🇹🇼 雲哲 (男聲 - 沉穩)",
-    },
-    "英文 (美國)": {
-        "en-US-AnaNeural": "🇺🇸 Ana (女聲 - 兒童/可愛)",
-        "en-US-AriaNeural": "🇺🇸 Aria (女聲 - 標準)",
-        "en-US-GuyNeural": "🇺🇸 Guy (男聲 - 標準)",
-    }
-}
-
-# GOOGLE TTS
-LANG_GOOGLE = {
-    "簡體中文 (zh-cn)": "zh-cn",
-    "繁體中文 (zh-tw)": "zh-tw",
-    "英文 (en)": "en"
-}
-
-# ELEVENLABS CONFIG
-VOICES_ELEVEN = {
-    "Adam (男聲 - 沉穩/專業)": "pNInz6z7Z84N3pG095lW",
-    "Rachel (女聲 - 溫柔/熱門)": "21m00Tcm4TlvDq8ikWAM",
-    "Bella (女聲 - 俏皮)": "EXAVITQu4vr4xnSDxMaL",
-    "Antoni (男聲 - 陽光)": "ErXw9OlCNo38pE9vEx9d",
-    "Nicole (女聲 - 甜美)": "piTKPmq9nAByT39UE9Jm",
-    "Josh (男聲 - 深度)": "TxGEqnHWuXilU4dqJnmf",
-}
-
-# FISH AUDIO CONFIG
-FISH_MODELS = {
-    "default": "預設音色",
-}
 
-# GEMINI TTS CONFIG
-VOICES_GEMINI = {
-    "Kore": "👩 Kore (女聲 - 平衡專業/推薦) ✨",
-    "Puck": "👧 Puck (女聲 - 活力稚嫩)",
-    "Charon": "👨 Charon (男聲 - 沉穩冷靜)",
-    "Fenrir": "🧔 Fenrir (男聲 - 神秘低沉)",
-    "Zephyr": "👩 Zephyr (女聲 - 明亮輕快)"
-}
-
-GEMINI_PROMPTS = {
-    "none": "",
-    "game": "用充滿活力、興奮且鼓勵的語氣對小朋友說：",
-    "card": "以標準、清晰且溫柔的發音方式，像百科全書一樣朗讀：",
-    "story": "用溫柔、親切且像是在講故事的口吻，慢慢地說：",
-}
+# --- 2. 數據定義 ---
 
 # EDGE STYLES
 STYLE_PRESETS = {
@@ -203,7 +151,15 @@ STYLES = {
     "shouting": "📢 大喊",
 }
 
-# --- 4. Session State ---
+# 內建分類名稱對應的語言區域，目錄中其他語言直接顯示代碼
+EDGE_LOCALE_LABELS = {
+    "-".join(next(iter(voices)).split("-")[:2]): category
+    for category, voices in VOICES_EDGE.items()
+}
+
+GENDER_LABELS = {"": "全部", "Female": "女聲", "Male": "男聲"}
+
+# --- 3. Session State ---
 if 'rate_val' not in st.session_state: st.session_state['rate_val'] = 0
 if 'pitch_val' not in st.session_state: st.session_state['pitch_val'] = 0
 
@@ -213,212 +169,246 @@ def update_sliders():
         st.session_state.rate_val = STYLE_PRESETS[selected_style]["rate"]
         st.session_state.pitch_val = STYLE_PRESETS[selected_style]["pitch"]
 
-# --- 5. 輔助功能 ---
-def get_gemini_client():
-    api_key = os.environ.get("GEMINI_API_KEY")
-    if not api_key:
-        return None
-    genai.configure(api_key=api_key)
-    return True
-
-def wrap_wav_header(pcm_data, sample_rate=24000):
-    """將原始 PCM 16-bit 數據封裝成 WAV 格式"""
-    with io.BytesIO() as wav_io:
-        with wave.open(wav_io, "wb") as wav_file:
-            wav_file.setnchannels(1)  # Mono
-            wav_file.setsampwidth(2) # 16-bit
-            wav_file.setframerate(sample_rate)
-            wav_file.writeframes(pcm_data)
-        return wav_io.getvalue()
-
-def trim_silence(audio_bytes, threshold=-70.0):
-    if not HAS_PYDUB or not HAS_FFMPEG: return audio_bytes 
-    try:
-        audio = AudioSegment.from_file(io.BytesIO(audio_bytes), format="mp3")
-        def detect_leading(sound, silence_threshold=threshold, chunk_size=10):
-            trim_ms = 0
-            while trim_ms < len(sound) and sound[trim_ms:trim_ms+chunk_size].dBFS < silence_threshold:
-                trim_ms += chunk_size
-            return trim_ms
-        start_trim = detect_leading(audio)
-        end_trim = detect_leading(audio.reverse())
-        if start_trim + end_trim < len(audio):
-            trimmed = audio[start_trim:len(audio)-end_trim]
-            out = io.BytesIO()
-            trimmed.export(out, format="mp3")
-            return out.getvalue()
-    except: pass 
-    return audio_bytes
-
-# --- 7. 生成邏輯 ---
-async def generate_audio_stream_edge(text, voice, rate_val, volume_val, pitch_val, remove_silence=False, silence_threshold=-70.0):
-    rate_str = f"{rate_val:+d}%"
-    pitch_str = f"{pitch_val:+d}Hz"
-    volume_str = f"{volume_val:+d}%"
-    
-    try:
-        communicate = edge_tts.Communicate(text, voice, rate=rate_str, volume=volume_str, pitch=pitch_str)
-        audio_data = io.BytesIO()
-        has_data = False
-        async for chunk in communicate.stream():
-            if chunk["type"] == "audio":
-                audio_data.write(chunk["data"])
-                has_data = True
-        
-        if not has_data:
-            # 如果還是失敗，可能是這個新角色不支援微調參數，嘗試用預設參數再請求一次
-            if rate_val != 0 or pitch_val != 0 or volume_val != 0:
-                communicate = edge_tts.Communicate(text, voice)
-                audio_data = io.BytesIO()
-                async for chunk in communicate.stream():
-                    if chunk["type"] == "audio":
-                        audio_data.write(chunk["data"])
-                        has_data = True
-            
-        if not has_data:
-            raise ValueError(f"語音引擎無法生成角色 {voice} 的音訊內容。請檢查角色 ID 或稍後再試。")
-            
-        final_bytes = audio_data.getvalue()
-        if remove_silence:
-            final_bytes = trim_silence(final_bytes, silence_threshold)
-        return final_bytes
-    except Exception as e:
-        # 如果徹底失敗，拋出錯誤讓主迴圈捕獲
-        raise e
-
-def generate_audio_stream_google(text, lang, slow=False, remove_silence=False, silence_threshold=-70.0):
-    tts = gTTS(text=text, lang=lang, slow=slow)
-    fp = io.BytesIO()
-    tts.write_to_fp(fp)
-    final_bytes = fp.getvalue()
-    if remove_silence:
-        final_bytes = trim_silence(final_bytes, silence_threshold)
-    return final_bytes
-
-def get_gemini_api_key():
-    """從環境變數或 .env 檔案獲取 API Key"""
-    # 優先從系統環境變量獲取
-    key = os.environ.get("GEMINI_API_KEY")
-    if key and len(key.strip()) > 10:
-        return key.strip()
-    return None
-
-def generate_audio_stream_elevenlabs(text, api_key, voice_id):
-    """
-    使用 ElevenLabs API 生成音訊
-    API Document: https://elevenlabs.io/docs/api-reference/text-to-speech
-    """
-    if not api_key:
-        return {"error": "找不到 ElevenLabs API Key。"}
-    
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
-    headers = {
-        "xi-api-key": api_key,
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "text": text,
-        "model_id": "eleven_multilingual_v2",
-        "voice_settings": {
-            "stability": 0.5,
-            "similarity_boost": 0.75
-        }
-    }
-    
-    try:
-        response = requests.post(url, json=payload, headers=headers)
-        if response.status_code == 200:
-            return response.content
-        else:
-             err_msg = response.text
-             try:
-                 err_json = response.json()
-                 if "detail" in err_json and "message" in err_json["detail"]:
-                     err_msg = err_json["detail"]["message"]
-             except: pass
-             return {"error": f"ElevenLabs API 錯誤 ({response.status_code}): {err_msg}"}
-    except Exception as e:
-        return {"error": str(e)}
-
-def generate_audio_stream_fish(text, api_key, reference_id=""):
+# --- 4. 輔助功能 ---
+@st.cache_resource
+def get_audio_cache():
+    """跨 rerun 與 session 共用的磁碟音訊快取"""
+    return AudioCache()
+
+def edge_locale_options(catalog):
+    """內建的中文/英文區域排在最前，其餘依代碼排序"""
+    preferred = list(EDGE_LOCALE_LABELS)
+    return preferred + [loc for loc in catalog.locales() if loc not in EDGE_LOCALE_LABELS]
+
+def edge_voice_options(catalog, locale, gender=None):
+    """內建推薦角色優先，其餘依目錄順序"""
+    curated = [v for voices in VOICES_EDGE.values() for v in voices]
+    found = [v["ShortName"] for v in catalog.find(locale=locale, gender=gender)]
+    ordered = [v for v in curated if v in found] + [v for v in found if v not in curated]
+    return ordered or [v for v in curated if v.startswith(locale)] or curated[:1]
+
+def edge_voice_label(catalog, short_name):
+    for voices in VOICES_EDGE.values():
+        if short_name in voices:
+            return voices[short_name]
+    voice = catalog.get(short_name) or {}
+    gender = GENDER_LABELS.get(voice.get("Gender", ""), "")
+    return f"{short_name} ({gender})" if gender and voice.get("Gender") else short_name
+
+def engine_id_from_label(label):
+    """將側邊欄的引擎標籤對應到 tts_core 的引擎代號"""
+    for key, engine_id in (("Edge", "edge"), ("Google", "google"), ("Gemini", "gemini"),
+                           ("ElevenLabs", "elevenlabs"), ("Fish Audio", "fish")):
+        if key in label:
+            return engine_id
+    return "edge"
+
+STAGE_LABELS = {
+    "queue_wait": "排隊等待", "network": "網路請求", "ttfb": "首包時間",
+    "trim": "去靜音", "concat": "長文拼接", "split": "合併切分", "transcode": "轉碼", "write": "寫入壓縮檔", "total": "單筆合計",
+}
+
+def show_batch_metrics(batch_metrics):
+    """顯示本批次各階段耗時摘要與逐項明細"""
+    with st.expander("⏱️ 各階段耗時"):
+        st.dataframe([
+            {"階段": STAGE_LABELS[row["stage"]], "筆數": row["count"],
+             "平均 (ms)": round(row["mean_s"] * 1000), "p50 (ms)": round(row["p50_s"] * 1000),
+             "p95 (ms)": round(row["p95_s"] * 1000), "最大 (ms)": round(row["max_s"] * 1000),
+             "總計 (s)": round(row["sum_s"], 2)}
+            for row in batch_metrics.stage_summary()
+        ], hide_index=True, use_container_width=True)
+        st.dataframe([
+            {"編號": e["id"], "狀態": e["status"], "快取": {True: "命中", False: "未命中"}.get(e["cache_hit"], ""),
+             "重試": e["retries"], "共用": "✓" if e["shared"] else "",
+             **{STAGE_LABELS[name]: round(e[name] * 1000) if e[name] is not None else None
+                for name in STAGES + ("total",)},
+             "錯誤": e["error"] or "; ".join(e["warnings"])}
+            for e in batch_metrics.items if e
+        ], hide_index=True, use_container_width=True)
+
+def write_metrics_files(handle):
+    """工作結束時（於背景執行緒）寫出 JSON 日誌與 Prometheus 指標檔"""
+    handle.batch_metrics.write_json_log()
+    get_registry().write_prometheus()
+
+def session_id():
+    """目前瀏覽器分頁的識別碼，背景佇列依此在各使用者之間輪流分配"""
+    if "session_id" not in st.session_state:
+        st.session_state["session_id"] = uuid.uuid4().hex
+    return st.session_state["session_id"]
+
+JOB_STATUS_LABELS = {"queued": "排隊中", "running": "生成中", "done": "已完成", "failed": "失敗", "cancelled": "已取消"}
+
+@st.fragment(run_every=1.0)
+def show_job_progress(job_id):
+    """每秒讀取一次背景工作的進度；結束時重跑整頁以顯示結果"""
+    runner = get_job_runner()
+    handle = runner.get(job_id)
+    if handle is None or not handle.active:
+        st.rerun(scope="app")
+    if handle.status == "queued":
+        ahead = runner.queue_position(handle)
+        st.info(f"排隊中：前面還有 {ahead} 個批次，伺服器目前執行 {runner.running_count()} 個。可以關閉分頁，稍後再回來。")
+    else:
+        st.progress(handle.done / handle.total if handle.total else 0.0,
+                    text=f"{JOB_STATUS_LABELS[handle.status]}：{handle.done} / {handle.total}")
+        st.caption("批次在伺服器背景執行，調整其他設定或重新整理頁面都不會中斷。")
+    for level, text in handle.recent_messages(3):
+        st.caption(f"{'⚠️' if level != 'info' else 'ℹ️'} {text}")
+    if st.button("取消批次"):
+        runner.cancel(job_id)
+        st.rerun(scope="app")
+
+PREFETCH_STATUS_LABELS = {"waiting": "等待輸入停止", "paused": "批次執行中，暫停", "running": "預先合成中",
+                          "done": "預先合成完成", "failed": "預先合成失敗"}
+
+@st.fragment(run_every=1.0)
+def show_prefetch_status():
+    """顯示本分頁的預先合成進度"""
+    state = get_prefetcher().status(session_id())
+    if state is None or state.status == "cancelled":
+        return
+    label = PREFETCH_STATUS_LABELS[state.status]
+    if state.status in ("running", "done") and state.total:
+        label += f"：{state.done} / {state.total}"
+    elif state.status == "done":
+        label = "所有項目都已在快取中"
+    elif state.status == "failed":
+        label += f"（{state.error}）"
+    st.caption(f"⚡ {label}")
+
+PREVIEW_SWAP_MARGIN_S = 0.3  # 上一段預計播完後再等多久才換上下一段；瀏覽器載入與開始播放有延遲，提早替換會截掉結尾
+
+def play_streaming_preview(chunks, sample_rate=GEMINI_SAMPLE_RATE):
     """
-    使用 Fish Audio API 生成音訊
-    API Document: https://api.fish.audio/v1/tts
+    邊收邊播：第一塊 PCM 一到就開始播放，之後每播完一段（預計結束時間再加 PREVIEW_SWAP_MARGIN_S）
+    才接著播出這段期間收到的音訊，不會替換仍在播放的元素；
+    全部收完後換成完整音訊的播放器供重播。chunks 在背景執行緒中逐塊取得（通常為 iter_gemini_pcm）。
     """
-    if not api_key:
-        return {"error": "找不到 Fish Audio API Key。"}
-    
-    url = "https://api.fish.audio/v1/tts"
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    
-    payload = {
-        "text": text,
-        "format": "mp3"
-    }
-    if reference_id and reference_id.strip():
-        payload["reference_id"] = reference_id.strip()
-    
+    received = queue.Queue()
+
+    def produce():
+        try:
+            for pcm in chunks:
+                received.put(pcm)
+            received.put(None)
+        except Exception as e:
+            received.put(e)
+
+    threading.Thread(target=produce, name="tts-preview", daemon=True).start()
+    status = st.empty()
+    player = st.empty()
+    full, segment = [], []
+    play_end = 0.0
+    first_audio = 0.0
+    started = time.monotonic()
+    finished = False
+    status.caption("生成中…")
+    while not finished or segment:
+        try:
+            item = received.get(timeout=0.05)
+        except queue.Empty:
+            item = b""
+        if item is None:
+            finished = True
+        elif isinstance(item, Exception):
+            raise item
+        elif item:
+            segment.append(item)
+            full.append(item)
+        now = time.monotonic()
+        if segment and (not play_end or now >= play_end + PREVIEW_SWAP_MARGIN_S):
+            pcm = b"".join(segment)
+            segment = []
+            if not play_end:
+                first_audio = now - started
+                status.caption(f"{first_audio:.1f} 秒後開始播放，其餘音訊邊收邊播")
+            player.audio(pcm_to_wav(pcm, sample_rate), format="audio/wav", autoplay=True)
+            play_end = now + len(pcm) / (sample_rate * 2)
+    # 最後一段播完後才換成完整音訊，避免中斷播放
+    time.sleep(max(0.0, play_end + PREVIEW_SWAP_MARGIN_S - time.monotonic()))
+    player.audio(pcm_to_wav(b"".join(full), sample_rate), format="audio/wav")
+    status.caption(f"試聽完成：{first_audio:.1f} 秒開始播放，可再次播放")
+
+def preview_gemini(text, voice, vibe):
+    """以串流模式試聽一句 Gemini 語音，方便快速比較音色與場景語氣"""
+    limiter = get_limiter("gemini")
+
+    def chunks():
+        if limiter is not None:
+            limiter.acquire_sync()
+        yield from iter_gemini_pcm(build_gemini_text(text, vibe), voice)
+
     try:
-        response = requests.post(url, json=payload, headers=headers)
-        if response.status_code == 200:
-            return response.content
-        else:
-             err_msg = response.text
-             try:
-                 err_json = response.json()
-                 if "message" in err_json:
-                     err_msg = err_json["message"]
-             except: pass
-                 
-             if response.status_code == 402 or "Insufficient Balance" in err_msg:
-                 return {"error": "Fish Audio API 錯誤 (402): API 額度不足。請注意，Fish Audio 的「開發者 API」與「網頁版免費額度」可能是分開計費的。如果沒有儲值，可能無法調用 API。"}
-             return {"error": f"Fish Audio API 錯誤 ({response.status_code}): {err_msg}"}
-    except Exception as e:
-        return {"error": str(e)}
-
-def generate_audio_stream_gemini(text, voice_name):
+        play_streaming_preview(chunks())
+    except SynthesisError as e:
+        st.error(str(e))
+
+def job_download(handle):
     """
-    使用 Gemini 3.1 Flash TTS 生成音訊
+    返回 ("url", 下載網址) 或 ("file", 壓縮檔物件)。
+    session_state 只記住 job 與已發佈的網址，不保存壓縮檔內容：大檔直接打包到靜態服務目錄、只發佈一次，
+    小檔每次重跑從 job 目錄重新打包成 spooled 暫存檔，直接交給 download_button。
     """
-    api_key = get_gemini_api_key()
-    if not api_key:
-        return {"error": "找不到 GEMINI_API_KEY 環境變數或 .env 設定。"}
-    
-    try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel("models/gemini-3.1-flash-tts-preview")
-        response = model.generate_content(
-            text,
-            generation_config={
-                "response_modalities": ["AUDIO"],
-                "speech_config": {
-                    "voice_config": {
-                        "prebuilt_voice_config": {
-                            "voice_name": voice_name
-                        }
-                    }
-                }
-            }
-        )
-        
-        # 遍歷所有 candidate 和 part 尋找音訊數據
-        if not response.candidates:
-             return {"error": "Gemini 未生成任何內容，請檢查輸入或 API 狀態。"}
-             
-        for part in response.candidates[0].content.parts:
-            if hasattr(part, 'inline_data'):
-                pcm_data = part.inline_data.data
-                if pcm_data:
-                    return wrap_wav_header(pcm_data, 24000)
-            
-        return {"error": "已收到 Gemini 回應，但其中不包含音訊數據。"}
-    except Exception as e:
-        return {"error": f"Gemini 請求失敗: {str(e)}"}
-
-# --- 7. 介面邏輯 ---
+    key = (handle.job_id, handle.finished)
+    cached = st.session_state.get("job_download")
+    if cached and cached[0] == key:
+        return "url", cached[1]
+    if handle.job.archive_size() > DEFAULT_SPOOL_MAX_MB * 1024 * 1024:
+        # 大檔由靜態檔服務直接從磁碟串流，不經 Python bytes，也不先寫暫存檔再複製
+        path, url = new_export_path("audio.zip")
+        with zipfile.ZipFile(path, "w") as zf:
+            handle.job.write_archive(zf)
+        st.session_state["job_download"] = (key, url)
+        return "url", url
+    archive = open_spooled_archive()
+    with zipfile.ZipFile(archive, "w") as zf:
+        handle.job.write_archive(zf)
+    archive.seek(0)
+    return "file", archive
+
+def show_job_result(handle):
+    summary = handle.summary
+    if handle.status == "failed":
+        st.error(f"批次執行失敗：{handle.error}。已完成的項目已保存，再按一次按鈕即可繼續。")
+    elif handle.status == "cancelled":
+        st.warning(f"批次已取消，已完成 {handle.done} / {handle.total}。再按一次按鈕即可從中斷處繼續。")
+    elif summary["failed"]:
+        st.warning(f"有 {len(summary['failed'])} 個檔案失敗，再按一次按鈕即可只重試失敗的項目。")
+    else:
+        st.success("生成完成！")
+    for level, text in handle.recent_messages():
+        if level == "error":
+            st.error(text)
+        elif level == "warning":
+            st.warning(text)
+    if summary:
+        if summary["resumed"]:
+            st.caption(f"沿用先前完成的 {summary['resumed']} 個檔案")
+        if summary["retries"]:
+            st.caption(f"自動重試 {summary['retries']} 次")
+        if summary["hedged"]:
+            st.caption(f"{summary['hedged']} 個慢速請求已自動加送對沖請求")
+        if summary["fallback"]:
+            st.warning("以下檔案改用備援引擎生成：" + "、".join(f"{fname} ({eng})" for fname, eng in summary["fallback"]))
+        if summary["deduplicated"]:
+            st.caption(f"重複內容合併生成，省下 {summary['deduplicated']} 次請求")
+    counters = handle.batch_metrics.counters()
+    if counters["cache_hits"] or counters["cache_misses"]:
+        st.caption(f"快取命中 {counters['cache_hits']} / 未命中 {counters['cache_misses']}")
+    show_batch_metrics(handle.batch_metrics)
+    if not handle.job.counts()["done"]:
+        return
+    kind, download = job_download(handle)
+    if kind == "url":
+        # 靜態檔服務以 text/plain 回應 .zip；download 屬性讓瀏覽器直接存檔而不是在頁面中顯示
+        st.markdown(f'<a class="download-link" href="{download}" download="audio.zip" type="application/zip">下載 ZIP 壓縮檔</a>',
+                    unsafe_allow_html=True)
+    else:
+        st.download_button("下載 ZIP 壓縮檔", download, "audio.zip", "application/zip")
+
+# --- 5. 介面邏輯 ---
 def main():
     with st.sidebar:
         st.markdown("## 參數設定")
@@ -427,6 +417,8 @@ def main():
         engine_options = ["Edge TTS (微軟/免密鑰/高音質)", "Google TTS (谷歌/標準)", "Gemini 3.1 TTS (谷歌/最新)"]
         
         engine = st.radio("TTS 引擎庫", engine_options, label_visibility="collapsed")
+        # 選定引擎後即在背景載入其套件，按下生成時不必再等待匯入
+        preload_engine(engine_id_from_label(engine))
         
         # 參數變數初始化
         selected_voice = None
@@ -435,12 +427,16 @@ def main():
         rate = 0
         pitch = 0
         volume = 0
+        edge_concurrency = DEFAULT_CONCURRENCY["edge"]
+        gemini_rpm = DEFAULT_RPM["gemini"]
         
         # Gemini specific
         gemini_voice = None
+        gemini_vibe = "none"
         
         # Fish specific
         fish_api_key = None
+        fish_voice = None
         
         # ElevenLabs specific
         eleven_api_key = None
@@ -449,13 +445,18 @@ def main():
         # --- EDGE TTS UI ---
         if "Edge" in engine:
             st.markdown("### 1. 語音")
+            catalog = get_voice_catalog(seed=seed_voices(VOICES_EDGE))
             c1, c2 = st.columns([1, 2])
             with c1: st.markdown('<div class="row-label">語言區域</div>', unsafe_allow_html=True)
-            with c2: category = st.selectbox("語言區域", list(VOICES_EDGE.keys()), label_visibility="collapsed")
+            with c2: locale = st.selectbox("語言區域", edge_locale_options(catalog), format_func=lambda x: EDGE_LOCALE_LABELS.get(x, x), label_visibility="collapsed")
+
+            g1, g2 = st.columns([1, 2])
+            with g1: st.markdown('<div class="row-label">性別</div>', unsafe_allow_html=True)
+            with g2: gender = st.radio("性別", ["", "Female", "Male"], format_func=lambda x: GENDER_LABELS[x], horizontal=True, label_visibility="collapsed")
             
             c3, c4 = st.columns([1, 2])
             with c3: st.markdown('<div class="row-label">角色選擇</div>', unsafe_allow_html=True)
-            with c4: selected_voice = st.selectbox("角色選擇", list(VOICES_EDGE[category].keys()), format_func=lambda x: VOICES_EDGE[category][x], label_visibility="collapsed")
+            with c4: selected_voice = st.selectbox("角色選擇", edge_voice_options(catalog, locale, gender or None), format_func=lambda x: edge_voice_label(catalog, x), label_visibility="collapsed")
 
             st.markdown("### 2. 風格")
             c5, c6 = st.columns([1, 2])
@@ -468,6 +469,8 @@ def main():
             rate = st.slider("語速 (Rate)", -100, 100, key="rate_val", format="%d%%")
             pitch = st.slider("音調 (Pitch)", -100, 100, key="pitch_val", format="%dHz")
             volume = st.slider("音量 (Volume)", -100, 100, 0, format="%d%%")
+            edge_concurrency = st.slider("併發請求數", 1, 16, DEFAULT_CONCURRENCY["edge"], help="同時向微軟伺服器發出的請求數量，過高可能被暫時限流。")
+            edge_bundle = st.checkbox("合併短詞請求", value=False, help="將相鄰的短詞（如字卡單字）合併成一次請求，再依字詞時間切回各檔，大幅減少連線數；切不出來的項目自動改為逐筆生成。")
 
         # --- GOOGLE TTS UI ---
         elif "Google" in engine:
@@ -486,9 +489,13 @@ def main():
             st.success("New! Gemini 3.1 Flash TTS。目前提供 5 種核心音色。")
             
             st.markdown("🔑 **API Key 設定**")
-            ui_api_key = st.text_input("填入 Gemini API Key (不需存檔，貼上即用)", type="password", placeholder="AIzaSy...")
-            if ui_api_key:
-                os.environ["GEMINI_API_KEY"] = ui_api_key.strip()
+            if QUEUE_DB:
+                # 佇列模式由工作行程合成，只讀取工作行程自己的環境變數，這裡填的 Key 不會送到工作行程
+                st.info("目前由伺服器的工作行程生成，使用伺服器設定的 Gemini API Key，無法在此填入自己的 Key。")
+            else:
+                ui_api_key = st.text_input("填入 Gemini API Key (不需存檔，貼上即用)", type="password", placeholder="AIzaSy...")
+                if ui_api_key:
+                    os.environ["GEMINI_API_KEY"] = ui_api_key.strip()
                 
             c1, c2 = st.columns([1, 2])
             with c1: st.markdown('<div class="row-label">角色選擇</div>', unsafe_allow_html=True)
@@ -504,12 +511,43 @@ def main():
                     "card": "📚 專業圖卡 (清晰播音)",
                     "story": "📖 親切故事 (溫柔緩慢)"
                 }[x], label_visibility="collapsed")
+            gemini_rpm = st.number_input("每分鐘請求數 (RPM)", 1, 1000, DEFAULT_RPM["gemini"], help="遇到 429 時會自動降速並依 Retry-After 重試，連續成功後再逐步恢復。")
 
         st.markdown("---")
-        remove_silence_opt = st.checkbox("智能去靜音", value=True, disabled=not(HAS_PYDUB and HAS_FFMPEG))
+        # Edge / Google 只輸出 MP3，轉為其他格式需解碼（pydub + ffmpeg）
+        native_mp3_kbps = NATIVE_MP3_KBPS.get(engine_id_from_label(engine))
+        codec_options = [c for c in ("mp3", "opus", "wav") if can_encode(c)
+                         and (c == "mp3" or not native_mp3_kbps or (HAS_PYDUB and HAS_FFMPEG))]
+        c5, c6 = st.columns([1, 2])
+        with c5: st.markdown('<div class="row-label">輸出格式</div>', unsafe_allow_html=True)
+        with c6:
+            output_codec = st.selectbox("輸出格式", codec_options, format_func=lambda x: {
+                "mp3": "MP3", "opus": "Opus (OGG，體積最小)", "wav": "WAV (原始)"
+            }[x], label_visibility="collapsed")
+        output_bitrate = DEFAULT_BITRATES.get(output_codec, DEFAULT_BITRATE)
+        if output_codec == "mp3":
+            output_bitrate = st.select_slider("位元率 (kbps)", [32, 48, 64, 96, 128, 160, 192, 256, 320], value=output_bitrate)
+            if native_mp3_kbps:
+                st.caption(f"此引擎原生輸出 {native_mp3_kbps} kbps MP3；選擇 {native_mp3_kbps} kbps 以上時直接使用原始檔，不重新編碼。")
+        elif output_codec == "opus":
+            output_bitrate = st.select_slider("位元率 (kbps)", [16, 24, 32, 48, 64, 96, 128], value=output_bitrate)
+        use_cache = st.checkbox("使用音訊快取", value=True, help="相同文字與參數的音訊直接取用上次結果，只重新合成有變動的行。")
+        # 佇列模式由工作行程合成，介面行程預先寫入的快取不一定是工作行程讀取的那一份，只會多耗額度
+        prefetch_opt = st.checkbox("編輯時預先合成", value=False, disabled=not use_cache or bool(QUEUE_DB),
+                                   help="停止編輯片刻後，在背景以低併發先合成新增或變動的行並存入快取，按下生成時大多已完成。Gemini 等有額度限制的引擎會提前消耗額度。佇列模式下不提供。")
+        prefetch_opt = prefetch_opt and not QUEUE_DB
+        remove_silence_opt = st.checkbox("智能去靜音", value=True, disabled=not(HAS_PYDUB and HAS_FFMPEG and HAS_NUMPY))
         silence_threshold = -70
+        exact_trim_opt = False
         if remove_silence_opt:
             silence_threshold = st.slider("靜音判定閾值 (dB)", -80, -10, -70, step=5)
+            exact_trim_opt = st.checkbox("精確裁切 (重新編碼)", value=False, help="預設在 MP3 幀邊界直接切割，不重新編碼；勾選後以取樣精度裁切，但需重新編碼一次。")
+        chunk_chars = st.number_input("長文分段字數", 0, 2000, DEFAULT_CHUNK_CHARS, step=50, help="超過此字數的內容在句末標點處切段、平行合成後無縫拼接；0 表示不分段。")
+        max_attempts = st.slider("失敗重試次數", 0, 8, DEFAULT_MAX_ATTEMPTS - 1, help="遇到限流 (429)、伺服器錯誤或網路中斷時，以指數退避自動重試。") + 1
+        fallback_options = [""] + [e for e in FALLBACK_ENGINES if e != engine_id_from_label(engine)]
+        fallback_engine = st.selectbox("備援引擎", fallback_options, index=0, format_func=lambda x: {
+            "": "不使用", "edge": "Edge TTS", "google": "Google 翻譯 (gTTS)"
+        }[x], help="服務故障、重試用盡仍失敗的項目改用備援引擎生成，並在結果中標記；音色依主音色的語系選用，找不到同語系音色時不備援。API Key 或音色設定錯誤不會改用備援。")
         
         # Status Bar
         if HAS_PYDUB and HAS_FFMPEG:
@@ -518,15 +556,16 @@ def main():
             st.markdown('<div class="status-err"><span>○</span> 環境缺失 (需 ffmpeg)</div>', unsafe_allow_html=True)
         st.markdown("<div style='text-align: center; color: #a1a1aa; font-size: 10px; font-family: monospace;'>VERSION 1.1.0 / TRI-ENGINE</div>", unsafe_allow_html=True)
         with st.sidebar.expander("🛠️ 語音偵錯 (新角色偵測)"):
+            catalog = get_voice_catalog(seed=seed_voices(VOICES_EDGE))
+            if catalog.fetched_at:
+                st.caption(f"音色目錄更新於 {time.strftime('%Y-%m-%d %H:%M', time.localtime(catalog.fetched_at))}，共 {len(catalog.voices)} 個音色")
             if st.button("檢索當前可用微軟音色"):
                 try:
-                    async def scan():
-                        mgr = await edge_tts.VoicesManager.create()
-                        return mgr.find(Locale="zh-CN")
-                    res = asyncio.run(scan())
+                    catalog.refresh()
+                    res = catalog.find(locale="zh-CN")
                     st.write(f"系統檢測到 {len(res)} 個中文音色：")
                     for r in res:
-                        st.code(r['Name'])
+                        st.code(r['ShortName'])
                 except Exception as e:
                     st.error(str(e))
 
@@ -537,91 +576,91 @@ def main():
     placeholder_txt = "001 蘋果\n002 香蕉\n1-1 第一課\n\n(若未輸入編號，系統將自動產生)"
     text_input = st.text_area("輸入內容 (編號 內容)", height=320, placeholder=placeholder_txt)
     
-    items = []
-    lines = text_input.split('\n')
-    for i, line in enumerate(lines):
-        if line.strip():
-            parts = line.strip().split(maxsplit=1)
-            if len(parts) >= 2:
-                items.append((parts[0], parts[1]))
-            elif len(parts) == 1:
-                auto_id = f"auto_{i+1:03d}"
-                items.append((auto_id, parts[0]))
+    items = parse_items(text_input)
     
     st.markdown("<br>", unsafe_allow_html=True)
     
-    if st.button(f"開始批量生成 ({len(items)} 檔案)", type="primary", disabled=len(items)==0):
-        zip_buffer = io.BytesIO()
-        prog = st.progress(0)
-        
-        with zipfile.ZipFile(zip_buffer, "w") as zf:
-            for i, (fname, txt) in enumerate(items):
-                try:
-                    data = b""
-                    if "Edge" in engine:
-                        try:
-                            data = asyncio.run(generate_audio_stream_edge(txt, selected_voice, rate, volume, pitch, remove_silence_opt, silence_threshold))
-                            zf.writestr(f"{fname}.mp3", data)
-                        except Exception as e:
-                            st.error(f"檔案 {fname} 失敗: {str(e)}")
-                            continue
-                    elif "Google" in engine:
-                        data = generate_audio_stream_google(txt, selected_lang_code, google_slow, remove_silence_opt, silence_threshold)
-                        zf.writestr(f"{fname}.mp3", data)
-                    elif "ElevenLabs" in engine:
-                        result = generate_audio_stream_elevenlabs(txt, eleven_api_key.strip() if eleven_api_key else "", eleven_voice_id)
-                        if isinstance(result, dict) and "error" in result:
-                            st.error(f"檔案 {fname} 失敗: {result['error']}")
-                            continue
-                        data = result
-                        zf.writestr(f"{fname}.mp3", data)
-                    elif "Fish Audio" in engine:
-                        result = generate_audio_stream_fish(txt, fish_api_key.strip() if fish_api_key else "", fish_voice)
-                        if isinstance(result, dict) and "error" in result:
-                            st.error(f"檔案 {fname} 失敗: {result['error']}")
-                            continue
-                        data = result
-                        zf.writestr(f"{fname}.mp3", data)  # Assuming Fish Audio returns mp3, standard API behavior
-                    elif "Gemini" in engine:
-                        # Add a small delay between requests to avoid free tier rate limit
-                        if i > 0:
-                            time.sleep(2)
-                        # Gemini TTS preview can sometimes hallucinate or add conversational meta-text
-                        # We need to strictly instruct it to ONLY read the content.
-                        vibe_prompt = GEMINI_PROMPTS[gemini_vibe] if gemini_vibe != "none" else ""
-                        full_txt = f"{vibe_prompt}\n\n[請勿添加任何解釋或對話，直接朗讀以下內容：]\n{txt}"
-                        result = generate_audio_stream_gemini(full_txt, gemini_voice)
-                        if isinstance(result, dict) and "error" in result:
-                            err_msg = result['error']
-                            if "429" in err_msg or "quota" in err_msg.lower():
-                                st.error(f"檔案 {fname} 失敗: 請求太頻繁，觸發了免費版 API 的限制 (429 Quota Exceeded)。請等待約一分鐘後再試。")
-                            else:
-                                st.error(f"檔案 {fname} 失敗: {err_msg}")
-                            continue
-                        data = result
-                        
-                        ext = ".wav"
-                        if HAS_PYDUB and HAS_FFMPEG:
-                            try:
-                                audio = AudioSegment.from_wav(io.BytesIO(data))
-                                out = io.BytesIO()
-                                audio.export(out, format="mp3", bitrate="192k")
-                                data = out.getvalue()
-                                ext = ".mp3"
-                            except Exception as e:
-                                print(f"MP3 Conversion failed: {e}")
-                        
-                        if not data or len(data) < 100: # 檢查是否為空
-                             st.warning(f"注意：{fname} 的音訊內容異常過短（{len(data)} bytes）")
-                             
-                        zf.writestr(f"{fname}{ext}", data)
-                        
-                except Exception as e:
-                    st.error(f"{fname} 失敗: {e}")
-                prog.progress((i+1)/len(items))
-        
-        st.success("生成完成！")
-        st.download_button("下載 ZIP 壓縮檔", zip_buffer.getvalue(), "audio.zip", "application/zip")
+    engine_id = engine_id_from_label(engine)
+    settings = {
+        "engine": engine_id,
+        "remove_silence": remove_silence_opt,
+        "silence_threshold": silence_threshold,
+        "exact_trim": exact_trim_opt,
+        "fallback_engine": fallback_engine,
+        "chunk_chars": chunk_chars,
+        "codec": output_codec,
+        "bitrate": output_bitrate,
+    }
+    concurrency = None
+    rpm = None
+    if engine_id == "edge":
+        settings.update(voice=selected_voice, rate=rate, pitch=pitch, volume=volume, edge_bundle=edge_bundle)
+        concurrency = edge_concurrency
+    elif engine_id == "google":
+        settings.update(lang=selected_lang_code, slow=google_slow)
+    elif engine_id == "gemini":
+        settings.update(voice=gemini_voice, vibe=gemini_vibe)
+        rpm = gemini_rpm
+    elif engine_id == "elevenlabs":
+        settings.update(voice=eleven_voice_id, api_key=eleven_api_key or "")
+    elif engine_id == "fish":
+        settings.update(voice=fish_voice or "", api_key=fish_api_key or "")
+
+    if engine_id == "gemini" and items:
+        # 長文只取第一段試聽，幾秒內就能比較不同音色與語氣
+        if st.button(f"🔊 即時試聽：{items[0][1][:20]}"):
+            preview_gemini(split_text(items[0][1])[0], gemini_voice, gemini_vibe)
+
+    # 同樣的清單與設定對應同一個 job，中斷（額度錯誤、斷線、重新整理）後可從檢查點繼續
+    runner = get_job_runner()
+    current_job_id = job_id_for(items, settings) if items else None
+    handle = runner.get(st.session_state.get("job_id")) or (runner.get(current_job_id) if current_job_id else None)
+    if handle is not None and handle.active:
+        # 批次在背景執行緒中進行，與介面重跑無關；這裡只定期讀取進度
+        show_job_progress(handle.job_id)
+        return
+
+    prefetcher = get_prefetcher()
+    if prefetch_opt and use_cache and items:
+        # 每次重跑都回報最新內容；內容或設定有變動時才會取消舊的預先合成並重新倒數
+        prefetcher.schedule(session_id(), items, settings)
+        show_prefetch_status()
+    else:
+        prefetcher.cancel(session_id())
+
+    existing_job = BatchJob.find(items, settings) if items else None
+    job_counts = existing_job.counts() if existing_job else None
+    button_label = f"開始批量生成 ({len(items)} 檔案)"
+    if job_counts and job_counts["done"] > 0 and (handle is None or handle.job_id != current_job_id):
+        if job_counts["pending"]:
+            st.info(f"偵測到未完成的批次：已完成 {job_counts['done']} / {job_counts['total']}，"
+                    f"失敗 {job_counts['failed']}。繼續時只會處理剩下的項目。")
+            button_label = f"繼續批量生成 (剩餘 {job_counts['pending']} / 共 {job_counts['total']} 檔案)"
+        else:
+            st.info("此批次先前已全部完成，按下按鈕可直接重新打包下載。")
+        if st.button("捨棄進度，重新開始"):
+            existing_job.discard()
+            st.rerun()
+
+    if st.button(button_label, type="primary", disabled=len(items)==0):
+        # 剩下的項目交給正式批次，預先合成已存入快取的結果會直接命中
+        prefetcher.cancel(session_id())
+        cleanup_jobs()
+        job = BatchJob.open(items, settings)
+        # 全部項目在背景工作中共用一個事件迴圈併發執行，每完成一項即寫入 job 目錄
+        handle = runner.submit(
+            job, settings, session_id(),
+            on_finish=write_metrics_files,
+            concurrency=concurrency,
+            cache=get_audio_cache() if use_cache else None,
+            rpm=rpm,
+            max_attempts=max_attempts,
+        )
+        st.session_state["job_id"] = handle.job_id
+        st.rerun()
+
+    if handle is not None:
+        show_job_result(handle)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+# 預設快取位置與容量上限，可由環境變數覆寫
+DEFAULT_CACHE_DIR = os.environ.get("TTS_CACHE_DIR", str(Path.home() / ".cache" / "geyu-tts" / "audio"))
+DEFAULT_CACHE_MAX_MB = int(os.environ.get("TTS_CACHE_MAX_MB", "512"))
+EVICT_LOW_WATER = 0.9  # 超過上限時淘汰到上限的這個比例，之後的寫入不必每次都掃描整個快取目錄
+
+
+class AudioCache:
+    """
+    以內容雜湊為鍵的磁碟音訊快取。
+    每筆音訊存成一個檔案，以檔案 mtime 記錄最近使用時間，超過容量上限時依 LRU 淘汰到低水位。
+    """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_MAX_MB * 1024 * 1024):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._size = None  # 延遲統計目前佔用量
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(**params):
+        """將合成參數（引擎、音色、語速、文字等）正規化後取 SHA-256"""
+        blob = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return self.root / key[:2] / f"{key}.bin"
+
+    def contains(self, key):
+        """是否已有此鍵的音訊（不讀取內容、不更新最近使用時間）"""
+        return self._path(key).exists()
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+        except OSError:
+            return None
+        try:
+            os.utime(path)  # 標記為最近使用
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """寫入 bytes 或檔案物件（檔案物件寫完後會回到開頭供呼叫端繼續讀取）"""
+        is_file = hasattr(data, "read")
+        if not is_file and not data:
+            return
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 先寫暫存檔再改名，避免其他 session 讀到寫一半的檔案
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if is_file:
+                    data.seek(0)
+                    shutil.copyfileobj(data, f)
+                    data.seek(0)
+                else:
+                    f.write(data)
+                size = f.tell()
+            if size == 0:
+                os.unlink(tmp)
+                return
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = self.size()
+            else:
+                self._size += size
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def fetch(self, key, producer):
+        """命中則直接返回；否則呼叫 producer()，僅在結果為 bytes 或檔案物件時寫入快取（錯誤 dict 不快取）"""
+        data = self.get(key)
+        if data is not None:
+            return data
+        data = producer()
+        if isinstance(data, (bytes, bytearray)) or hasattr(data, "read"):
+            self.put(key, data)
+        return data
+
+    async def afetch(self, key, coro_factory):
+        """fetch 的非同步版本，供 Edge TTS 使用"""
+        data = self.get(key)
+        if data is not None:
+            return data
+        data = await coro_factory()
+        if isinstance(data, (bytes, bytearray)) or hasattr(data, "read"):
+            self.put(key, data)
+        return data
+
+    def _entries(self):
+        for path in self.root.glob("*/*.bin"):
+            try:
+                st_ = path.stat()
+            except OSError:
+                continue
+            yield path, st_.st_size, st_.st_mtime
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """超過容量上限時依 LRU 淘汰，直到佔用量降到 EVICT_LOW_WATER * max_bytes 以下"""
+        entries = list(self._entries())
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            target = self.max_bytes * EVICT_LOW_WATER
+            entries.sort(key=lambda e: e[2])  # 最久未使用者優先淘汰
+            for path, size, _ in entries:
+                if total <= target:
+                    break
+                try:
+                    path.unlink()
+                    total -= size
+                except OSError:
+                    pass
+        with self._lock:
+            self._size = total
+
+    def clear(self):
+        for path, _, _ in self._entries():
+            try:
+                path.unlink()
+            except OSError:
+                pass
+        with self._lock:
+            self._size = 0
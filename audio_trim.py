@@ -0,0 +1,169 @@
+import io
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+from engine_registry import detect_environment
+
+# pydub 只在實際解碼時才匯入（見 trim_silence_with_offsets）
+HAS_PYDUB = detect_environment()["pydub"]
+
+# MPEG Audio Layer III 幀頭查表（kbps / Hz）
+_MP3_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_MP3_SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    25: [11025, 12000, 8000],
+}
+MP3_GUARD_FRAMES = 1  # 幀邊界切割時語音前後各多保留的幀數
+
+
+def rms_envelope(samples, sample_rate, channels=1, window_ms=10):
+    """
+    計算每個 window_ms 視窗的 RMS 振幅（一次向量化運算）。
+    samples 為交錯排列的整數取樣陣列；最後一個不足長度的視窗也會計入。
+    """
+    frames = len(samples) // channels
+    if frames == 0:
+        return np.zeros(0, dtype=np.float64)
+    win = max(1, int(sample_rate * window_ms / 1000)) * channels
+    sq = np.asarray(samples[:frames * channels], dtype=np.float64) ** 2
+    starts = np.arange(0, len(sq), win)
+    sums = np.add.reduceat(sq, starts)
+    counts = np.minimum(win, len(sq) - starts)
+    return np.sqrt(sums / counts)
+
+
+def find_speech_bounds(samples, sample_rate, channels=1, sample_width=2, threshold=-70.0, window_ms=10):
+    """
+    依 dBFS 閾值找出語音起訖點，返回 (start_ms, end_ms)。
+    整段都低於閾值時返回 None。
+    """
+    env = rms_envelope(samples, sample_rate, channels, window_ms)
+    if len(env) == 0:
+        return None
+    # 以振幅比較取代逐窗 log10，閾值換算與 pydub 的 dBFS 定義一致
+    max_amp = float(1 << (8 * sample_width - 1))
+    loud = np.flatnonzero(env >= max_amp * (10 ** (threshold / 20.0)))
+    if len(loud) == 0:
+        return None
+    duration_ms = len(samples) // channels * 1000 / sample_rate
+    start_ms = int(loud[0]) * window_ms
+    end_ms = min((int(loud[-1]) + 1) * window_ms, duration_ms)
+    return start_ms, end_ms
+
+
+def detect_silence_offsets(audio, threshold=-70.0, window_ms=10):
+    """對已解碼的 AudioSegment 計算語音起訖點 (start_ms, end_ms)"""
+    samples = np.asarray(audio.get_array_of_samples())
+    return find_speech_bounds(samples, audio.frame_rate, audio.channels, audio.sample_width, threshold, window_ms)
+
+
+def _parse_mp3_header(data, pos):
+    """解析 pos 處的 Layer III 幀頭，返回 (幀長度, 每幀取樣數, 取樣率)；不合法時返回 None"""
+    if pos + 4 > len(data):
+        return None
+    b1, b2 = data[pos + 1], data[pos + 2]
+    if data[pos] != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version = {0: 25, 2: 2, 3: 1}.get((b1 >> 3) & 0x03)
+    if version is None or ((b1 >> 1) & 0x03) != 0x01:  # 僅支援 Layer III
+        return None
+    bitrate_idx = b2 >> 4
+    sr_idx = (b2 >> 2) & 0x03
+    if bitrate_idx in (0, 15) or sr_idx == 3:
+        return None
+    bitrate = _MP3_BITRATES[1 if version == 1 else 2][bitrate_idx] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][sr_idx]
+    padding = (b2 >> 1) & 0x01
+    if version == 1:
+        return 144 * bitrate // sample_rate + padding, 1152, sample_rate
+    return 72 * bitrate // sample_rate + padding, 576, sample_rate
+
+
+def mp3_frame_index(data):
+    """
+    掃描 MP3 位元流，返回 (前置 ID3v2 標籤長度, [(offset, length, start_ms), ...])。
+    VBR 的 Xing/Info 標頭幀不列入索引（裁切後其幀數資訊已失效）。
+    """
+    pos = 0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        pos = 10 + size + (10 if data[5] & 0x10 else 0)
+    id3_len = pos
+    frames = []
+    t_ms = 0.0
+    end = len(data)
+    if data[-128:-125] == b"TAG":
+        end -= 128
+    while pos < end:
+        header = _parse_mp3_header(data, pos)
+        if header is None or pos + header[0] > end:
+            pos += 1  # 重新同步
+            continue
+        length, spf, sample_rate = header
+        frame = data[pos:pos + length]
+        if not frames and (b"Xing" in frame[:64] or b"Info" in frame[:64]):
+            pos += length
+            continue
+        frames.append((pos, length, t_ms))
+        t_ms += spf * 1000.0 / sample_rate
+        pos += length
+    return id3_len, frames
+
+
+def cut_mp3_frames(data, start_ms, end_ms, guard=MP3_GUARD_FRAMES):
+    """
+    在幀邊界直接切割 MP3 位元流，不經解碼與重新編碼。
+    起點取包含 start_ms 的幀、終點取包含 end_ms 的幀，確保不切入語音；
+    前後再各多保留 guard 幀：首幀的主資料可能借用前一幀的位元儲存區（bit reservoir），
+    解碼器也有約 529 個取樣的延遲，緊貼語音切割會讓開頭失真、結尾被截掉。
+    返回 (bytes, (實際 start_ms, 實際 end_ms))；無法解析時返回 None。
+    """
+    id3_len, frames = mp3_frame_index(data)
+    if not frames:
+        return None
+    first = 0
+    while first + 1 < len(frames) and frames[first + 1][2] <= start_ms:
+        first += 1
+    last = first
+    while last + 1 < len(frames) and frames[last + 1][2] < end_ms:
+        last += 1
+    first = max(0, first - guard)
+    last = min(len(frames) - 1, last + guard)
+    frame_ms = frames[1][2] - frames[0][2] if len(frames) > 1 else 0.0
+    begin = frames[first][0]
+    stop = frames[last][0] + frames[last][1]
+    out = data[:id3_len] + data[begin:stop]
+    return out, (int(frames[first][2]), int(frames[last][2] + frame_ms))
+
+
+def trim_silence_with_offsets(audio_bytes, threshold=-70.0, fmt="mp3", exact=False):
+    """
+    解碼一次並去除頭尾靜音。
+    MP3 預設在幀邊界直接切割原始位元流；exact=True 時才以取樣精度裁切並重新編碼。
+    返回 (音訊 bytes, (start_ms, end_ms))；未裁切時 offsets 為 None。
+    """
+    if not HAS_PYDUB or not HAS_NUMPY:
+        return audio_bytes, None
+    from pydub import AudioSegment
+    audio = AudioSegment.from_file(io.BytesIO(audio_bytes), format=fmt)
+    bounds = detect_silence_offsets(audio, threshold)
+    if bounds is None:
+        return audio_bytes, None
+    start_ms, end_ms = bounds
+    if start_ms <= 0 and end_ms >= len(audio):
+        return audio_bytes, None
+    if fmt == "mp3" and not exact:
+        cut = cut_mp3_frames(audio_bytes, start_ms, end_ms)
+        if cut is not None:
+            return cut
+    out = io.BytesIO()
+    audio[start_ms:end_ms].export(out, format=fmt)
+    return out.getvalue(), (start_ms, end_ms)
@@ -0,0 +1,172 @@
+"""
+無介面批量生成：讀取清單檔，輸出 ZIP 或資料夾，不需啟動 Streamlit。
+
+    python batch_cli.py lesson.txt --engine edge --voice zh-CN-XiaoxiaoNeural -o lesson.zip
+    python batch_cli.py words.csv --engine gemini --voice Kore --vibe card --out-dir build/
+"""
+import argparse
+import asyncio
+import os
+import sys
+import zipfile
+
+from audio_cache import AudioCache
+from batch_jobs import BatchJob, run_job
+from http_pool import configure_pool
+from metrics import BatchMetrics, get_registry
+from transcode import DEFAULT_BITRATE, DEFAULT_BITRATES
+from tts_core import (
+    DEFAULT_MAX_ATTEMPTS, DEFAULT_SETTINGS, ENGINES, FALLBACK_ENGINES, GEMINI_PROMPTS,
+    dir_entry_writer, export_batch, load_manifest, zip_entry_writer,
+)
+
+API_KEY_ENV = {
+    "gemini": "GEMINI_API_KEY",
+    "elevenlabs": "ELEVENLABS_API_KEY",
+    "fish": "FISH_API_KEY",
+}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="格育語音批量生成 (CLI)")
+    parser.add_argument("manifest", help="清單檔 (.txt「編號 內容」/ .csv id,text / .json)")
+    parser.add_argument("--engine", choices=ENGINES, default=DEFAULT_SETTINGS["engine"])
+    parser.add_argument("--voice", help="音色：Edge 角色 ID、Gemini 音色名、ElevenLabs voice_id 或 Fish reference_id")
+    parser.add_argument("--rate", type=int, default=0, help="Edge 語速 (%%)")
+    parser.add_argument("--pitch", type=int, default=0, help="Edge 音調 (Hz)")
+    parser.add_argument("--volume", type=int, default=0, help="Edge 音量 (%%)")
+    parser.add_argument("--lang", default=DEFAULT_SETTINGS["lang"], help="Google TTS 語言代碼")
+    parser.add_argument("--slow", action="store_true", help="Google TTS 慢速模式")
+    parser.add_argument("--vibe", choices=list(GEMINI_PROMPTS), default="none", help="Gemini 場景語氣")
+    parser.add_argument("--api-key", help="API Key；未指定時讀取對應環境變數")
+    parser.add_argument("--remove-silence", action="store_true", help="去除頭尾靜音")
+    parser.add_argument("--silence-threshold", type=float, default=-70.0)
+    parser.add_argument("--exact-trim", action="store_true", help="以取樣精度裁切（需重新編碼）")
+    parser.add_argument("--codec", choices=["mp3", "wav", "opus"], default=DEFAULT_SETTINGS["codec"],
+                        help="輸出格式；ElevenLabs / Fish 直接向供應商要求，其餘引擎在本地轉碼（Edge / Google 轉 Opus、WAV 需 ffmpeg）")
+    parser.add_argument("--bitrate", type=int, default=None, help="位元率 (kbps)，預設 MP3 192、Opus 32")
+    parser.add_argument("--chunk-chars", type=int, default=DEFAULT_SETTINGS["chunk_chars"],
+                        help="長文分段字數上限（0 表示不分段）")
+    parser.add_argument("--chunk-gap-ms", type=int, default=DEFAULT_SETTINGS["chunk_gap_ms"], help="分段拼接的句間停頓 (ms)")
+    parser.add_argument("--edge-bundle", action="store_true",
+                        help="Edge 相鄰短句合併成一次請求，再依 WordBoundary 切回各檔")
+    parser.add_argument("--concurrency", type=int, help="同時請求數（預設依引擎而定）")
+    parser.add_argument("--rpm", type=float, help="該供應商每分鐘請求數上限（預設見 rate_limit.DEFAULT_RPM）")
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS, help="單筆最多嘗試次數（含第一次）")
+    parser.add_argument("--hedge", action=argparse.BooleanOptionalAction, default=None,
+                        help="慢於近期延遲百分位時加送對沖請求（預設只對 Edge / Google 啟用）")
+    parser.add_argument("--fallback-engine", choices=list(FALLBACK_ENGINES), help="重試用盡後改用的備援引擎")
+    parser.add_argument("--fallback-voice", help="備援引擎的音色（Google 為語言代碼）")
+    parser.add_argument("--http-pool-size", type=int, help="ElevenLabs / Fish Audio 連線池大小")
+    parser.add_argument("--http-timeout", type=float, help="HTTP 讀取逾時（秒）")
+    parser.add_argument("--resume", action="store_true", help="以磁碟檢查點執行：中斷後再次執行只處理未完成的項目")
+    parser.add_argument("--no-cache", action="store_true", help="停用磁碟音訊快取")
+    parser.add_argument("--timings", action="store_true", help="結束時列出各階段耗時摘要")
+    parser.add_argument("--metrics-log", help="將逐項計時以 JSON Lines 附加寫入此檔")
+    parser.add_argument("--metrics-prom", help="將各引擎計數器寫成 Prometheus 文字格式檔")
+    out = parser.add_mutually_exclusive_group(required=True)
+    out.add_argument("-o", "--out", help="輸出 ZIP 路徑")
+    out.add_argument("--out-dir", help="輸出資料夾")
+    return parser
+
+
+def settings_from_args(args):
+    settings = {
+        "engine": args.engine,
+        "rate": args.rate,
+        "pitch": args.pitch,
+        "volume": args.volume,
+        "lang": args.lang,
+        "slow": args.slow,
+        "vibe": args.vibe,
+        "remove_silence": args.remove_silence,
+        "silence_threshold": args.silence_threshold,
+        "exact_trim": args.exact_trim,
+        "codec": args.codec,
+        "bitrate": args.bitrate or DEFAULT_BITRATES.get(args.codec, DEFAULT_BITRATE),
+        "hedge": args.hedge,
+        "edge_bundle": args.edge_bundle,
+        "chunk_chars": args.chunk_chars,
+        "chunk_gap_ms": args.chunk_gap_ms,
+        "fallback_engine": args.fallback_engine or "",
+        "fallback_voice": args.fallback_voice or "",
+        "api_key": args.api_key or os.environ.get(API_KEY_ENV.get(args.engine, ""), ""),
+    }
+    if args.voice:
+        settings["voice"] = args.voice
+    elif args.engine == "gemini":
+        settings["voice"] = "Kore"
+    elif args.engine == "fish":
+        settings["voice"] = ""
+    return settings
+
+
+def print_message(level, text):
+    print(f"[{level}] {text}", file=sys.stderr)
+
+
+def print_timings(batch_metrics):
+    print(f"{'stage':<12}{'count':>6}{'mean ms':>10}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}{'sum s':>9}", file=sys.stderr)
+    for row in batch_metrics.stage_summary():
+        print(f"{row['stage']:<12}{row['count']:>6}{row['mean_s'] * 1000:>10.0f}{row['p50_s'] * 1000:>9.0f}"
+              f"{row['p95_s'] * 1000:>9.0f}{row['max_s'] * 1000:>9.0f}{row['sum_s']:>9.2f}", file=sys.stderr)
+
+
+def print_progress(done, total):
+    print(f"\r{done}/{total}", end="", file=sys.stderr, flush=True)
+    if done == total:
+        print(file=sys.stderr)
+
+
+async def run(args):
+    items = load_manifest(args.manifest)
+    if not items:
+        print_message("error", f"清單 {args.manifest} 沒有任何項目")
+        return 1
+    settings = settings_from_args(args)
+    if args.http_pool_size or args.http_timeout:
+        configure_pool(pool_size=args.http_pool_size, read_timeout=args.http_timeout)
+    cache = None if args.no_cache else AudioCache()
+    batch_metrics = BatchMetrics(args.engine)
+    kwargs = dict(concurrency=args.concurrency, cache=cache, on_progress=print_progress, on_message=print_message,
+                  rpm=args.rpm, max_attempts=args.max_attempts, batch_metrics=batch_metrics)
+
+    if args.resume:
+        job = BatchJob.open(items, settings)
+        summary = await run_job(job, settings, **kwargs)
+        if summary["resumed"]:
+            print(f"沿用先前完成的 {summary['resumed']} 個檔案（job {job.job_id}）", file=sys.stderr)
+        if args.out:
+            with zipfile.ZipFile(args.out, "w") as zf:
+                job.write_archive(zf)
+        else:
+            job.write_directory(args.out_dir)
+    elif args.out:
+        with zipfile.ZipFile(args.out, "w") as zf:
+            summary = await export_batch(items, settings, zip_entry_writer(zf), **kwargs)
+    else:
+        summary = await export_batch(items, settings, dir_entry_writer(args.out_dir), **kwargs)
+
+    print(f"完成 {summary['ok']} / {len(items)}，失敗 {len(summary['failed'])}，重試 {summary['retries']} 次，"
+          f"合併重複省下 {summary['deduplicated']} 次請求", file=sys.stderr)
+    for fname, engine in summary["fallback"]:
+        print(f"[fallback] {fname} 由備援引擎 {engine} 生成", file=sys.stderr)
+    if cache is not None:
+        counters = batch_metrics.counters()
+        print(f"快取命中 {counters['cache_hits']} / 未命中 {counters['cache_misses']}", file=sys.stderr)
+    if args.timings:
+        print_timings(batch_metrics)
+    if args.metrics_log:
+        batch_metrics.write_json_log(args.metrics_log)
+    if args.metrics_prom:
+        get_registry().write_prometheus(args.metrics_prom)
+    return 0 if not summary["failed"] else 2
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
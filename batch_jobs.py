@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from http_pool import copy_body
+from metrics import BatchMetrics
+from tts_core import DEFAULT_MAX_ATTEMPTS, DEFAULT_SETTINGS, export_batch
+
+DEFAULT_JOBS_DIR = os.environ.get("TTS_JOBS_DIR", str(Path.home() / ".cache" / "geyu-tts" / "jobs"))
+JOB_TTL_SECONDS = int(os.environ.get("TTS_JOB_TTL_DAYS", "7")) * 86400
+# mark / tag 累積這麼多筆變更或距上次存檔這麼久才重寫 manifest；中斷時最多重做這段期間的項目（多半命中音訊快取）
+SAVE_EVERY_ITEMS = 50
+SAVE_INTERVAL_SECONDS = 2.0
+
+# 不影響輸出內容的設定不列入 job ID
+_VOLATILE_SETTINGS = ("api_key", "hedge", "chunk_concurrency")
+
+
+def job_id_for(items, settings):
+    """
+    由輸入內容與合成設定決定 job ID。
+    同樣的清單與設定（例如瀏覽器重新整理後再按一次）會對應到同一個 job，可從中斷處繼續。
+    """
+    settings = {k: v for k, v in {**DEFAULT_SETTINGS, **settings}.items() if k not in _VOLATILE_SETTINGS}
+    blob = json.dumps({"items": items, "settings": settings}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()[:16]
+
+
+class BatchJob:
+    """
+    有磁碟檢查點的批次工作。
+    manifest.json 記錄每一項的狀態（pending / done / failed）與輸出檔名，
+    完成的音訊存於 audio/，中斷後只需重跑未完成的項目，再由磁碟重建壓縮檔。
+    """
+
+    def __init__(self, root, manifest):
+        self.root = Path(root)
+        self.manifest = manifest
+        self._lock = threading.Lock()
+        self._dirty = 0
+        self._saved = time.monotonic()
+
+    @property
+    def job_id(self):
+        return self.manifest["job_id"]
+
+    @property
+    def audio_dir(self):
+        return self.root / "audio"
+
+    @property
+    def entries(self):
+        return self.manifest["items"]
+
+    @classmethod
+    def open(cls, items, settings, jobs_dir=DEFAULT_JOBS_DIR):
+        """載入既有 job，不存在時建立新的"""
+        job = cls.find(items, settings, jobs_dir)
+        if job is not None:
+            return job
+        job_id = job_id_for(items, settings)
+        root = Path(jobs_dir) / job_id
+        (root / "audio").mkdir(parents=True, exist_ok=True)
+        manifest = {
+            "job_id": job_id,
+            "created": time.time(),
+            "updated": time.time(),
+            "settings": {k: v for k, v in {**DEFAULT_SETTINGS, **settings}.items() if k not in _VOLATILE_SETTINGS},
+            "items": [{"id": fname, "text": txt, "status": "pending", "file": None, "error": None}
+                      for fname, txt in items],
+        }
+        job = cls(root, manifest)
+        job.save()
+        return job
+
+    @classmethod
+    def find(cls, items, settings, jobs_dir=DEFAULT_JOBS_DIR):
+        """找出此清單與設定對應的既有 job；沒有時返回 None"""
+        return cls.load(job_id_for(items, settings), jobs_dir)
+
+    @classmethod
+    def load(cls, job_id, jobs_dir=DEFAULT_JOBS_DIR):
+        """以 job ID 載入既有 job（例如佇列模式的工作行程）；不存在時返回 None"""
+        root = Path(jobs_dir) / job_id
+        try:
+            manifest = json.loads((root / "manifest.json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        return cls(root, manifest)
+
+    def save(self):
+        with self._lock:
+            self.manifest["updated"] = time.time()
+            fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(self.manifest, f, ensure_ascii=False)
+            os.replace(tmp, self.root / "manifest.json")
+            self._dirty = 0
+            self._saved = time.monotonic()
+
+    def _changed(self):
+        # 每一項都重寫整份 manifest 會讓大批次的 I/O 隨項目數平方成長，改為批次存檔
+        self._dirty += 1
+        if self._dirty >= SAVE_EVERY_ITEMS or time.monotonic() - self._saved >= SAVE_INTERVAL_SECONDS:
+            self.save()
+
+    def flush(self):
+        """寫出尚未存檔的 mark / tag 變更"""
+        if self._dirty:
+            self.save()
+
+    def _disk_path(self, name):
+        # 編號可能含有路徑字元，磁碟上以雜湊命名，壓縮檔內仍使用原檔名
+        suffix = Path(name).suffix
+        return self.audio_dir / (hashlib.sha1(name.encode("utf-8")).hexdigest()[:20] + suffix)
+
+    def _is_done(self, entry):
+        return entry["status"] == "done" and entry["file"] and self._disk_path(entry["file"]).exists()
+
+    def pending_indices(self):
+        """尚未完成（含失敗與輸出檔遺失）的項目索引"""
+        return [i for i, entry in enumerate(self.entries) if not self._is_done(entry)]
+
+    def counts(self):
+        done = sum(1 for entry in self.entries if self._is_done(entry))
+        failed = sum(1 for entry in self.entries if entry["status"] == "failed")
+        return {"total": len(self.entries), "done": done, "failed": failed, "pending": len(self.entries) - done}
+
+    def is_complete(self):
+        return not self.pending_indices()
+
+    def write_file(self, name, data):
+        with open(self._disk_path(name), "wb") as dst:
+            copy_body(data, dst)
+
+    def copy_file(self, src_name, name):
+        """以已寫出的 src_name 作為 name 的內容（內容重複的項目共用同一次合成結果）"""
+        shutil.copyfile(self._disk_path(src_name), self._disk_path(name))
+
+    def mark(self, idx, name=None, error=None):
+        entry = self.entries[idx]
+        if error is None:
+            entry.update(status="done", file=name, error=None)
+        else:
+            entry.update(status="failed", error=str(error))
+        self._changed()
+
+    def tag(self, idx, **fields):
+        """在項目上加註額外資訊（例如 fallback 使用的備援引擎）"""
+        self.entries[idx].update(fields)
+        self._changed()
+
+    def archive_size(self):
+        """已完成音訊的總大小（bytes），用來預估打包後的壓縮檔大小"""
+        return sum(self._disk_path(entry["file"]).stat().st_size for entry in self.entries if self._is_done(entry))
+
+    def write_archive(self, zf):
+        """依輸入順序將已完成的音訊由磁碟寫入 ZipFile"""
+        for entry in self.entries:
+            if self._is_done(entry):
+                zf.write(self._disk_path(entry["file"]), arcname=entry["file"])
+
+    def write_directory(self, out_dir):
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        for entry in self.entries:
+            if self._is_done(entry):
+                target = out_dir / entry["file"]
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(self._disk_path(entry["file"]), target)
+
+    def discard(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+async def run_job(job, settings, concurrency=None, cache=None, on_progress=None, on_message=None,
+                  rpm=None, max_attempts=DEFAULT_MAX_ATTEMPTS, batch_metrics=None):
+    """
+    只合成 job 中未完成的項目，每完成一項立即寫入磁碟；manifest 批次更新，結束（含失敗）時一定存檔。
+    返回 export_batch 的摘要，另加 "resumed"（沿用先前結果的項目數）。
+    改用備援引擎完成的項目會在 manifest 中標記 "fallback"。
+    """
+    if batch_metrics is None:
+        batch_metrics = BatchMetrics(settings.get("engine"))
+    todo = job.pending_indices()
+    items = [(job.entries[i]["id"], job.entries[i]["text"]) for i in todo]
+    resumed = len(job.entries) - len(todo)
+    progress = (lambda done, total: on_progress(resumed + done, resumed + total)) if on_progress else None
+    try:
+        summary = await export_batch(
+            items, settings, job.write_file,
+            concurrency=concurrency, cache=cache, on_progress=progress, on_message=on_message,
+            rpm=rpm, max_attempts=max_attempts, batch_metrics=batch_metrics,
+            on_result=lambda k, name, err: job.mark(todo[k], name, err),
+        )
+        for k, entry in enumerate(batch_metrics.items):
+            if entry and entry["status"] == "ok" and entry["fallback"]:
+                job.tag(todo[k], fallback=entry["fallback"])
+    finally:
+        job.flush()
+    summary["resumed"] = resumed
+    return summary
+
+
+def cleanup_jobs(jobs_dir=DEFAULT_JOBS_DIR, ttl=JOB_TTL_SECONDS):
+    """刪除超過保存期限的 job"""
+    root = Path(jobs_dir)
+    if not root.exists():
+        return
+    cutoff = time.time() - ttl
+    for job_dir in root.iterdir():
+        try:
+            if (job_dir / "manifest.json").stat().st_mtime < cutoff:
+                shutil.rmtree(job_dir, ignore_errors=True)
+        except OSError:
+            pass
@@ -0,0 +1,293 @@
+"""
+批量合成效能測試：以本地替身服務（見 bench_stubs）驅動真實的生成與批次流程，
+量測各引擎在不同批量與併發數下的吞吐量、延遲百分位、峰值記憶體與各階段 CPU 時間。
+
+    python bench.py --engines edge,gemini --batch-sizes 50,200 --concurrency 1,4,16
+    python bench.py --latency-ms 300 --rate-429 0.05 --json results.json
+    python bench.py --engines edge --word-cards --edge-bundle
+    python bench.py --compare results.json      # 與先前結果比較，退步超過容許值時返回 1
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+import zipfile
+
+ENGINES = ("edge", "gemini", "elevenlabs", "fish")
+
+# 每筆結果中用來判斷退步的指標：(欄位, 越大越好)
+_REGRESSION_METRICS = (("items_per_s", True), ("p95_ms", False))
+
+
+def percentile(values, pct):
+    """最近秩 (nearest-rank) 百分位數"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def _peak_rss_mb():
+    # Linux 的 ru_maxrss 單位為 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class StageTimer:
+    """累計各階段的牆鐘與 CPU 時間（CPU 為執行該階段的執行緒 / 工作行程所花的時間）"""
+
+    def __init__(self):
+        self.wall = {}
+        self.cpu = {}
+
+    def add(self, stage, wall, cpu=0.0):
+        self.wall[stage] = self.wall.get(stage, 0.0) + wall
+        self.cpu[stage] = self.cpu.get(stage, 0.0) + cpu
+
+    def wrap_sync(self, stage, fn):
+        def timed(*args, **kwargs):
+            wall0, cpu0 = time.perf_counter(), time.thread_time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - wall0, time.thread_time() - cpu0)
+        return timed
+
+
+def _instrument(timer, latencies):
+    """替換 tts_core 中各階段的函式以記錄時間；返回 unittest.mock 的 patcher 清單"""
+    from unittest import mock
+
+    import tts_core
+    from bench_stubs import timed_call
+    from transcode import TranscodePool, encode_pcm, reencode
+
+    class TimedTranscodePool(TranscodePool):
+        async def run(self, fn, *args):
+            wall0 = time.perf_counter()
+            result, worker_cpu = await super().run(timed_call, fn, *args)
+            # 合併請求的切分（split_audio）與去靜音同屬幀層級的後處理，計入 trim 欄
+            timer.add("transcode" if fn in (encode_pcm, reencode) else "trim", time.perf_counter() - wall0, worker_cpu)
+            return result
+
+    pool = TimedTranscodePool()
+    original_fetch = tts_core._fetch_raw
+    original_item = tts_core.synthesize_item
+    original_bundle = tts_core.synthesize_edge_bundle
+
+    async def timed_fetch(*args, **kwargs):
+        wall0 = time.perf_counter()
+        try:
+            return await original_fetch(*args, **kwargs)
+        finally:
+            timer.add("fetch", time.perf_counter() - wall0)
+
+    async def timed_item(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await original_item(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    async def timed_bundle(*args, **kwargs):
+        start = time.perf_counter()
+        results = await original_bundle(*args, **kwargs)
+        # 合併請求中的每一筆都以整個請求的耗時計入延遲
+        latencies.extend(time.perf_counter() - start for data in results if data is not None)
+        return results
+
+    patchers = [
+        mock.patch.object(tts_core, "_fetch_raw", timed_fetch),
+        mock.patch.object(tts_core, "synthesize_item", timed_item),
+        mock.patch.object(tts_core, "synthesize_edge_bundle", timed_bundle),
+        mock.patch.object(tts_core, "get_transcode_pool", lambda: pool),
+    ]
+    return patchers, pool
+
+
+def run_case(case):
+    """在目前行程中執行一組測試，返回結果 dict"""
+    import tts_core
+    from bench_stubs import MockTTSServer, StubConfig, install_stubs
+    from transcode import DEFAULT_BITRATE, DEFAULT_BITRATES
+
+    config = StubConfig(latency_ms=case["latency_ms"], jitter_ms=case["jitter_ms"], rate_429=case["rate_429"],
+                        retry_after=case["retry_after"], payload_bytes=case["payload_kb"] * 1024, seed=case["seed"])
+    if case["word_cards"]:
+        items = [(f"item_{i:05d}", f"字卡 {i}") for i in range(case["batch_size"])]
+    else:
+        items = [(f"item_{i:05d}", f"效能測試第 {i} 句。Benchmark sentence number {i}.") for i in range(case["batch_size"])]
+    settings = {
+        "engine": case["engine"],
+        "voice": {"edge": "zh-CN-XiaoxiaoNeural", "gemini": "Kore"}.get(case["engine"], "bench-voice"),
+        "api_key": "bench-key-0000000000",
+        "remove_silence": case["remove_silence"],
+        "codec": case["codec"],
+        "bitrate": DEFAULT_BITRATES.get(case["codec"], DEFAULT_BITRATE),
+        "edge_bundle": case["edge_bundle"],
+    }
+    timer = StageTimer()
+    latencies = []
+    patchers, pool = _instrument(timer, latencies)
+
+    with MockTTSServer(config) as server, install_stubs(config, server.base_url):
+        for p in patchers:
+            p.start()
+        try:
+            with tempfile.TemporaryFile() as out, zipfile.ZipFile(out, "w") as zf:
+                write = timer.wrap_sync("write", tts_core.zip_entry_writer(zf))
+                cpu0 = time.process_time()
+                start = time.perf_counter()
+                summary = asyncio.run(tts_core.export_batch(
+                    items, settings, write, concurrency=case["concurrency"], rpm=case["rpm"],
+                    max_attempts=case["max_attempts"]))
+                elapsed = time.perf_counter() - start
+                cpu_total = time.process_time() - cpu0
+        finally:
+            for p in reversed(patchers):
+                p.stop()
+            pool.shutdown()
+
+    # 去靜音與轉碼在工作行程中執行；主行程 CPU 扣掉寫入，其餘為取得音訊、事件迴圈與 HTTP 用戶端的開銷
+    stage_cpu = {"trim": timer.cpu.get("trim", 0.0), "write": timer.cpu.get("write", 0.0),
+                 "transcode": timer.cpu.get("transcode", 0.0)}
+    stage_cpu["fetch"] = max(0.0, cpu_total - stage_cpu["write"])
+    return {
+        **{k: case[k] for k in ("engine", "batch_size", "concurrency")},
+        "items_per_s": len(items) / elapsed if elapsed else 0.0,
+        "elapsed_s": elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "peak_rss_mb": _peak_rss_mb(),
+        "cpu_s": stage_cpu,
+        "wall_s": {k: timer.wall.get(k, 0.0) for k in ("fetch", "trim", "transcode", "write")},
+        "ok": summary["ok"],
+        "failed": len(summary["failed"]),
+        "retries": summary["retries"],
+        "requests_429": server.httpd.throttled,
+    }
+
+
+def _case_entry(case, queue):
+    try:
+        queue.put(run_case(case))
+    except BaseException as e:
+        queue.put({"error": f"{type(e).__name__}: {e}", **case})
+
+
+def run_isolated(case):
+    """每組測試在獨立的 spawn 行程中執行，峰值 RSS 不受前一組影響"""
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_case_entry, args=(case, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def format_row(r):
+    if "error" in r:
+        return f"{r['engine']:<11}{r['batch_size']:>6}{r['concurrency']:>5}  錯誤: {r['error']}"
+    cpu = r["cpu_s"]
+    return (f"{r['engine']:<11}{r['batch_size']:>6}{r['concurrency']:>5}"
+            f"{r['items_per_s']:>9.1f}{r['p50_ms']:>8.0f}{r['p95_ms']:>8.0f}{r['p99_ms']:>8.0f}"
+            f"{r['peak_rss_mb']:>8.1f}"
+            f"{cpu['fetch']:>8.2f}{cpu['trim']:>7.2f}{cpu['transcode']:>7.2f}{cpu['write']:>7.2f}"
+            f"{r['retries']:>6}{r['failed']:>5}")
+
+
+HEADER = (f"{'engine':<11}{'batch':>6}{'conc':>5}{'items/s':>9}{'p50ms':>8}{'p95ms':>8}{'p99ms':>8}"
+          f"{'rssMB':>8}{'cpu:net':>8}{'trim':>7}{'enc':>7}{'write':>7}{'retry':>6}{'fail':>5}")
+
+
+def compare(results, baseline, tolerance):
+    """與基準結果逐組比較，返回退步說明的清單"""
+    base = {(b["engine"], b["batch_size"], b["concurrency"]): b for b in baseline if "error" not in b}
+    regressions = []
+    for r in results:
+        b = base.get((r["engine"], r["batch_size"], r["concurrency"]))
+        if b is None or "error" in r:
+            continue
+        for metric, higher_is_better in _REGRESSION_METRICS:
+            old, new = b[metric], r[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append(f"{r['engine']} batch={r['batch_size']} conc={r['concurrency']}: "
+                                   f"{metric} {old:.1f} -> {new:.1f} ({change:+.0%})")
+    return regressions
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="格育語音批量合成效能測試（本地替身服務，不消耗額度）")
+    parser.add_argument("--engines", default=",".join(ENGINES), help="以逗號分隔：" + ",".join(ENGINES))
+    parser.add_argument("--batch-sizes", type=_int_list, default=[50, 200])
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 4, 16])
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="替身服務的平均回應延遲")
+    parser.add_argument("--jitter-ms", type=float, default=50.0, help="延遲的均勻抖動幅度 (±)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="回應 429 的機率 (0~1)")
+    parser.add_argument("--retry-after", type=float, default=0.5, help="429 回應的 Retry-After 秒數")
+    parser.add_argument("--payload-kb", type=int, default=24, help="每筆音訊大小 (KB)")
+    parser.add_argument("--codec", choices=["mp3", "wav", "opus"], default="mp3", help="輸出格式")
+    parser.add_argument("--remove-silence", action="store_true", help="啟用去靜音（需 ffmpeg）")
+    parser.add_argument("--word-cards", action="store_true", help="以短詞（字卡）作為測試內容")
+    parser.add_argument("--edge-bundle", action="store_true", help="Edge 短句合併成一次請求（搭配 --word-cards）")
+    parser.add_argument("--rpm", type=float, default=1e6, help="限速器 RPM（預設實際上不限速）")
+    parser.add_argument("--max-attempts", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="將結果寫入 JSON 檔")
+    parser.add_argument("--compare", help="與先前 --json 輸出的基準比較")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="容許的退步比例")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    engines = [e.strip() for e in args.engines.split(",") if e.strip()]
+    unknown = set(engines) - set(ENGINES)
+    if unknown:
+        print(f"不支援的引擎: {', '.join(sorted(unknown))}", file=sys.stderr)
+        return 2
+
+    print(HEADER)
+    results = []
+    for engine in engines:
+        for batch_size in args.batch_sizes:
+            for concurrency in args.concurrency:
+                case = {
+                    "engine": engine, "batch_size": batch_size, "concurrency": concurrency,
+                    "latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "rate_429": args.rate_429,
+                    "retry_after": args.retry_after, "payload_kb": args.payload_kb, "codec": args.codec,
+                    "remove_silence": args.remove_silence, "rpm": args.rpm, "max_attempts": args.max_attempts,
+                    "seed": args.seed, "word_cards": args.word_cards, "edge_bundle": args.edge_bundle,
+                }
+                result = run_isolated(case)
+                results.append(result)
+                print(format_row(result), flush=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"[退步] {line}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0 if not any("error" in r for r in results) else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
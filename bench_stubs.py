@@ -0,0 +1,239 @@
+"""
+效能測試用的本地替身：ElevenLabs / Fish Audio 的 HTTP 模擬伺服器、Gemini 模型與 Edge 串流。
+延遲、抖動、429 比例與音訊大小皆可設定，不會連到真實服務、不消耗額度。
+"""
+import array
+import asyncio
+import contextlib
+import functools
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+
+# MPEG-2 Layer III、48 kbps、24 kHz、單聲道的空白幀（與 Edge 預設輸出同規格）
+_MP3_FRAME = b"\xff\xf3\x64\xc4" + bytes(140)
+_GEMINI_SAMPLE_RATE = 24000
+
+
+class StubConfig:
+    """替身服務的行為設定；latency / jitter 以毫秒計，rate_429 為 0~1 的機率"""
+
+    def __init__(self, latency_ms=200.0, jitter_ms=50.0, rate_429=0.0, retry_after=0.5,
+                 payload_bytes=24000, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.payload_bytes = payload_bytes
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """單次回應的延遲（秒）：latency 加上 ±jitter 的均勻抖動"""
+        with self._lock:
+            jitter = self._rng.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(0.0, self.latency_ms + jitter) / 1000.0
+
+    def throttle(self):
+        with self._lock:
+            return self._rng.random() < self.rate_429
+
+
+@functools.lru_cache(maxsize=8)
+def mp3_payload(size):
+    """約 size bytes 的 MP3（整數個幀）"""
+    return _MP3_FRAME * max(1, size // len(_MP3_FRAME))
+
+
+@functools.lru_cache(maxsize=8)
+def pcm_payload(size):
+    """約 size bytes 的 16-bit PCM 正弦波，讓轉碼負載接近真實語音"""
+    n = max(1, size // 2)
+    samples = array.array("h", (int(8000 * math.sin(2 * math.pi * 220 * i / _GEMINI_SAMPLE_RATE)) for i in range(n)))
+    return samples.tobytes()
+
+
+def _stub_payload(path, request_body, size):
+    """
+    依請求的輸出格式（ElevenLabs 的 output_format 查詢參數、Fish 的 format 欄位）返回 (本文, Content-Type)。
+    Opus 只模擬大小與 Ogg 標頭，內容不可解碼。
+    """
+    fmt = "mp3"
+    if "output_format=" in path:
+        fmt = path.split("output_format=", 1)[1].split("&")[0].split("_")[0]
+    elif request_body:
+        with contextlib.suppress(ValueError):
+            fmt = json.loads(request_body).get("format", "mp3")
+    if fmt == "pcm":
+        return pcm_payload(size), "audio/pcm"
+    if fmt == "wav":
+        from transcode import pcm_to_wav
+        return pcm_to_wav(pcm_payload(size), _GEMINI_SAMPLE_RATE), "audio/wav"
+    if fmt == "opus":
+        return b"OggS" + bytes(max(0, size // 4 - 4)), "audio/ogg"
+    return mp3_payload(size), "audio/mpeg"
+
+
+class _TTSHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 保持連線，與真實服務一樣可重用連線池
+    disable_nagle_algorithm = True  # 避免分段寫入時的延遲 ACK 灌水延遲數字
+
+    def do_POST(self):
+        config = self.server.config
+        length = int(self.headers.get("Content-Length") or 0)
+        request_body = self.rfile.read(length) if length else b""
+        self.server.requests += 1
+        time.sleep(config.delay())
+        if config.throttle():
+            self.server.throttled += 1
+            body = json.dumps({"detail": {"message": "rate limited (stub)"}, "message": "rate limited (stub)"}).encode()
+            self.send_response(429)
+            self.send_header("Retry-After", str(config.retry_after))
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        body, content_type = _stub_payload(self.path, request_body, config.payload_bytes)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        for i in range(0, len(body), 16 * 1024):
+            self.wfile.write(body[i:i + 16 * 1024])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockTTSServer:
+    """
+    同時回應 ElevenLabs（/v1/text-to-speech/<voice>）與 Fish Audio（/v1/tts）的本地 HTTP 伺服器。
+    在背景執行緒執行，base_url 可設為 tts_core.ELEVENLABS_API_BASE / FISH_API_BASE。
+    """
+
+    def __init__(self, config, host="127.0.0.1", port=0):
+        self.httpd = ThreadingHTTPServer((host, port), _TTSHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.config = config
+        self.httpd.requests = 0
+        self.httpd.throttled = 0
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="mock-tts-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+_GEMINI_STREAM_CHUNK = 9600  # 串流模式每塊約 0.2 秒的 PCM
+_GEMINI_FIRST_CHUNK_RATIO = 0.3  # 串流模式的首塊延遲佔整體延遲的比例
+
+
+def _gemini_response(pcm):
+    part = SimpleNamespace(inline_data=SimpleNamespace(data=pcm))
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+
+class FakeGeminiModel:
+    """
+    取代 GenerativeModel：generate_content 依設定延遲後返回 24 kHz PCM，或拋出 429 錯誤。
+    stream=True 時首塊在延遲的一部分後送出，其餘分塊平均分佈在剩下的時間。
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    def generate_content(self, text, stream=False):
+        if stream:
+            return self._stream()
+        time.sleep(self.config.delay())
+        if self.config.throttle():
+            raise RuntimeError(f"429 Resource has been exhausted (stub). Please retry in {self.config.retry_after}s.")
+        return _gemini_response(pcm_payload(self.config.payload_bytes))
+
+    def _stream(self):
+        delay = self.config.delay()
+        time.sleep(delay * _GEMINI_FIRST_CHUNK_RATIO)
+        if self.config.throttle():
+            raise RuntimeError(f"429 Resource has been exhausted (stub). Please retry in {self.config.retry_after}s.")
+        pcm = pcm_payload(self.config.payload_bytes)
+        chunks = [pcm[i:i + _GEMINI_STREAM_CHUNK] for i in range(0, len(pcm), _GEMINI_STREAM_CHUNK)]
+        for k, chunk in enumerate(chunks):
+            if k:
+                time.sleep(delay * (1 - _GEMINI_FIRST_CHUNK_RATIO) / max(1, len(chunks) - 1))
+            yield _gemini_response(chunk)
+
+
+_MP3_FRAME_MS = 24  # _MP3_FRAME 為 MPEG-2 24 kHz，每幀 576 個取樣
+_PAUSE_FRAMES = 12  # 合併請求中句與句之間的停頓幀數
+
+
+def fake_edge_communicate(config):
+    """
+    返回取代 edge_tts.Communicate 的類別：首包延遲後分塊送出 MP3 與 WordBoundary 事件。
+    多行文字（合併請求）的每一行各佔一段 payload 長度的音訊，行間插入停頓，事件時間與之對應。
+    """
+
+    class FakeCommunicate:
+        def __init__(self, text, voice, **kwargs):
+            self.text = text
+
+        async def stream(self):
+            await asyncio.sleep(config.delay())
+            if config.throttle():
+                raise RuntimeError("429, message='Invalid response status' (stub)")
+            lines = [line for line in self.text.split("\n") if line.strip()] or [self.text]
+            line = mp3_payload(config.payload_bytes)
+            line_ms = len(line) // len(_MP3_FRAME) * _MP3_FRAME_MS
+            pause_ms = _PAUSE_FRAMES * _MP3_FRAME_MS
+            for k, text in enumerate(lines):
+                word = text.strip().rstrip("。.！!？?")
+                yield {"type": "WordBoundary", "offset": k * (line_ms + pause_ms) * 10_000,
+                       "duration": line_ms * 10_000, "text": word}
+            body = (_MP3_FRAME * _PAUSE_FRAMES).join([line] * len(lines))
+            for i in range(0, len(body), 4096):
+                yield {"type": "audio", "data": body[i:i + 4096]}
+                await asyncio.sleep(0)
+
+    return FakeCommunicate
+
+
+@contextlib.contextmanager
+def install_stubs(config, http_base_url):
+    """在 with 區塊內讓 tts_core 的各引擎改用本地替身"""
+    import tts_core
+    from engine_registry import backend
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.object(tts_core, "ELEVENLABS_API_BASE", http_base_url))
+        stack.enter_context(mock.patch.object(tts_core, "FISH_API_BASE", http_base_url))
+        stack.enter_context(mock.patch.object(tts_core, "get_gemini_model", lambda api_key, voice: FakeGeminiModel(config)))
+        stack.enter_context(mock.patch.object(backend("edge_tts"), "Communicate", fake_edge_communicate(config)))
+        yield
+
+
+def timed_call(fn, *args):
+    """在後處理工作行程內執行 fn(*args)，一併返回該行程花費的 CPU 秒數"""
+    start = time.process_time()
+    result = fn(*args)
+    return result, time.process_time() - start
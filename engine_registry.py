@@ -0,0 +1,66 @@
+"""
+各引擎後端套件的延遲載入與執行環境檢測。
+google.generativeai、edge_tts 等套件匯入成本高，只在第一次用到該引擎時才載入；
+ffmpeg / pydub / NumPy 的檢測每個進程只做一次，不隨 Streamlit 重跑重複執行。
+"""
+import functools
+import importlib
+import importlib.util
+import shutil
+import sys
+import threading
+
+# 各引擎需要的後端模組（ElevenLabs / Fish Audio 經 http_pool 使用 requests）
+ENGINE_BACKENDS = {
+    "edge": ("edge_tts",),
+    "google": ("gtts",),
+    "gemini": ("google.generativeai", "google.ai.generativelanguage"),
+    "elevenlabs": ("requests",),
+    "fish": ("requests",),
+}
+
+_preloading = set()
+_preload_lock = threading.Lock()
+
+
+def backend(module_name):
+    """返回後端模組，第一次呼叫時才匯入（已匯入時只查 sys.modules；匯入鎖由 importlib 處理，可跨執行緒呼叫）"""
+    return importlib.import_module(module_name)
+
+
+def load_engine(engine):
+    """載入某引擎的全部後端模組"""
+    return [backend(name) for name in ENGINE_BACKENDS.get(engine, ())]
+
+
+def is_loaded(engine):
+    return all(name in sys.modules for name in ENGINE_BACKENDS.get(engine, ()))
+
+
+def preload_engine(engine):
+    """在背景執行緒中預先載入引擎後端（使用者選了引擎、還沒按下生成時先暖機）；重複呼叫不會重複載入"""
+    with _preload_lock:
+        if engine in _preloading or is_loaded(engine):
+            return
+        _preloading.add(engine)
+
+    def run():
+        try:
+            load_engine(engine)
+        except ImportError:
+            pass  # 實際使用時會再拋出錯誤
+        finally:
+            with _preload_lock:
+                _preloading.discard(engine)
+
+    threading.Thread(target=run, name=f"preload-{engine}", daemon=True).start()
+
+
+@functools.lru_cache(maxsize=None)
+def detect_environment():
+    """檢測 ffmpeg、pydub 與 NumPy 是否可用；只查找、不匯入套件，每個進程只執行一次"""
+    return {
+        "ffmpeg": shutil.which("ffmpeg") is not None,
+        "pydub": importlib.util.find_spec("pydub") is not None,
+        "numpy": importlib.util.find_spec("numpy") is not None,
+    }
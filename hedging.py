@@ -0,0 +1,81 @@
+import asyncio
+import collections
+import os
+import threading
+
+# 預設只對免費引擎送出對沖請求；付費引擎（依字數計費）的第二個請求會重複扣款
+HEDGE_ENGINES = tuple(e.strip() for e in os.environ.get("TTS_HEDGE_ENGINES", "edge,google").split(",") if e.strip())
+HEDGE_PERCENTILE = float(os.environ.get("TTS_HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 1.0  # 秒；樣本延遲都很低時也至少等這麼久才對沖
+
+
+class LatencyTracker:
+    """記錄某引擎最近成功請求的延遲，推算對沖門檻（第 N 百分位）"""
+
+    def __init__(self, window=200, percentile=HEDGE_PERCENTILE, min_samples=HEDGE_MIN_SAMPLES,
+                 min_delay=HEDGE_MIN_DELAY):
+        self.samples = collections.deque(maxlen=window)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def hedge_delay(self):
+        """樣本足夠時返回對沖前的等待秒數，否則返回 None（不對沖）"""
+        with self._lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        rank = max(1, -(-len(ordered) * int(self.percentile) // 100))
+        return max(self.min_delay, ordered[rank - 1])
+
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def get_latency_tracker(engine):
+    """每個引擎一個進程內共用的延遲紀錄"""
+    with _trackers_lock:
+        if engine not in _trackers:
+            _trackers[engine] = LatencyTracker()
+        return _trackers[engine]
+
+
+def should_hedge(engine, hedge=None):
+    """hedge 為 None 時依 HEDGE_ENGINES 決定，True / False 則強制開關"""
+    return engine in HEDGE_ENGINES if hedge is None else bool(hedge)
+
+
+async def hedged_race(make_attempt, delay):
+    """
+    先送出一個請求；超過 delay 秒仍未完成時再送出第二個，取最先成功的結果，另一個取消。
+    make_attempt(is_hedge) 返回 coroutine。返回 (結果, 是否送出對沖, 是否由對沖請求勝出)。
+    兩個都失敗時拋出最後一個錯誤；第一個在 delay 內就失敗時直接拋出，交給外層重試。
+    """
+    first = asyncio.ensure_future(make_attempt(False))
+    tasks = [first]
+    try:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result(), False, False
+        second = asyncio.ensure_future(make_attempt(True))
+        tasks.append(second)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), True, task is second
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import metrics
+from engine_registry import backend
+
+# 連線池大小與逾時（秒），可由環境變數覆寫
+DEFAULT_POOL_SIZE = int(os.environ.get("TTS_HTTP_POOL_SIZE", "16"))
+DEFAULT_TIMEOUT = (
+    float(os.environ.get("TTS_HTTP_CONNECT_TIMEOUT", "10")),
+    float(os.environ.get("TTS_HTTP_READ_TIMEOUT", "120")),
+)
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# 單筆回應超過此大小時改存磁碟暫存檔
+BODY_SPOOL_MAX_BYTES = 1024 * 1024
+
+_session = None
+_timeout = DEFAULT_TIMEOUT
+_lock = threading.Lock()
+
+
+def _build_session(pool_size):
+    # requests 只有 ElevenLabs / Fish Audio 會用到，第一次建立連線池時才匯入
+    requests = backend("requests")
+    session = requests.Session()
+    # 重試交給 rate_limit 的退避策略處理，這裡不自動重試
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """取得進程內共用、保持連線 (keep-alive) 的 requests.Session"""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = _build_session(DEFAULT_POOL_SIZE)
+        return _session
+
+
+def configure_pool(pool_size=None, connect_timeout=None, read_timeout=None):
+    """重建連線池並調整逾時；已在使用中的舊連線會隨舊 Session 關閉"""
+    global _session, _timeout
+    with _lock:
+        old = _session
+        _session = _build_session(pool_size or DEFAULT_POOL_SIZE)
+        _timeout = (connect_timeout or _timeout[0], read_timeout or _timeout[1])
+    if old is not None:
+        old.close()
+
+
+def get_timeout():
+    return _timeout
+
+
+def new_audio_body():
+    """建立單筆音訊的暫存容器：小檔留在記憶體，大檔自動落地磁碟"""
+    return tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_MAX_BYTES, mode="w+b")
+
+
+def stream_post(url, out, json=None, headers=None):
+    """
+    以共用連線池送出 POST，200 時將回應本文分塊寫入 out（不整包緩衝）。
+    返回 response；非 200 時 out 不寫入，呼叫端可讀取 response.text 取得錯誤內容。
+    """
+    response = get_session().post(url, json=json, headers=headers, timeout=_timeout, stream=True)
+    if response.status_code == 200:
+        try:
+            first = True
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                if chunk:
+                    if first:
+                        metrics.mark_first_byte()
+                        first = False
+                    out.write(chunk)
+        finally:
+            response.close()
+        out.seek(0)
+    return response
+
+
+def body_size(data):
+    """bytes 或檔案物件的長度"""
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    pos = data.tell()
+    data.seek(0, os.SEEK_END)
+    size = data.tell()
+    data.seek(pos)
+    return size
+
+
+def copy_body(data, dst):
+    """將 bytes 或檔案物件分塊寫入 dst"""
+    if isinstance(data, (bytes, bytearray)):
+        dst.write(data)
+    else:
+        data.seek(0)
+        shutil.copyfileobj(data, dst, length=STREAM_CHUNK_SIZE)
@@ -0,0 +1,80 @@
+"""
+匯入時間預算檢查：在全新的 Python 行程中以 -X importtime 匯入指定模組，
+確認總匯入時間不超過預算，且沒有提前載入任何引擎的後端套件（見 engine_registry.ENGINE_BACKENDS）。
+
+    python import_budget.py                       # 檢查 tts_core、job_runner、batch_cli
+    python import_budget.py --budget-ms 250 tts_core
+超出預算或提前載入後端套件時返回 1，可放進 CI。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from engine_registry import ENGINE_BACKENDS
+
+DEFAULT_MODULES = ("tts_core", "job_runner", "batch_cli")
+DEFAULT_BUDGET_MS = float(os.environ.get("TTS_IMPORT_BUDGET_MS", "400"))
+# 這些套件只能在第一次使用時才匯入
+LAZY_MODULES = sorted({name for names in ENGINE_BACKENDS.values() for name in names} | {"pydub"})
+
+
+def measure(module):
+    """在子行程中匯入 module，返回 (總匯入毫秒, [(頂層依賴, 累計毫秒), ...], 提前載入的延遲套件)"""
+    code = (f"import json, sys; import {module}; "
+            f"print(json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules]))")
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"匯入 {module} 失敗")
+    total_us = 0
+    deps = []
+    children = []
+    # 子模組的紀錄排在父模組之前；只取緊接在 module 之前、縮排一層的項目
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue  # 標題列
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        if depth == 1:
+            children.append((name, int(cumulative) / 1000))
+        elif depth == 0:
+            if name == module:
+                total_us, deps = int(cumulative), children
+            children = []
+    eager = json.loads(proc.stdout.strip().splitlines()[-1])
+    return total_us / 1000, sorted(deps, key=lambda d: -d[1]), eager
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="檢查模組的冷啟動匯入時間與延遲載入")
+    parser.add_argument("modules", nargs="*", default=list(DEFAULT_MODULES))
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="每個模組的匯入時間上限")
+    parser.add_argument("--top", type=int, default=5, help="列出最耗時的前幾個依賴")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for module in args.modules:
+        try:
+            total_ms, deps, eager = measure(module)
+        except RuntimeError as e:
+            print(f"[錯誤] {module}: {e}", file=sys.stderr)
+            failed = True
+            continue
+        over = total_ms > args.budget_ms
+        status = "超出預算" if over else "OK"
+        print(f"{module:<14}{total_ms:>9.1f} ms / {args.budget_ms:.0f} ms  {status}")
+        for name, ms in deps[:args.top]:
+            print(f"    {name:<28}{ms:>9.1f} ms")
+        if eager:
+            print(f"    [提前載入] {', '.join(eager)}", file=sys.stderr)
+        failed = failed or over or bool(eager)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+"""
+在 Streamlit 腳本之外執行批次工作的背景佇列。
+
+Streamlit 每次互動都會重跑腳本、瀏覽器斷線時腳本也會中止，批次若在按鈕回呼中執行就會跟著被打斷。
+JobRunner 為進程內共用的工作佇列（以 get_job_runner() 取得），由數個背景執行緒各自以事件迴圈執行 run_job；
+介面只在 session_state 記住 job ID，每次重跑時讀取進度。
+排隊的工作依工作階段（瀏覽器分頁）輪流分配，單一使用者的大批次不會讓其他人一直等待。
+"""
+import asyncio
+import collections
+import itertools
+import os
+import threading
+import time
+
+from batch_jobs import run_job
+from metrics import BatchMetrics, logger
+from work_queue import QUEUE_DB, QueueRunner
+
+JOB_WORKERS = int(os.environ.get("TTS_JOB_WORKERS", "2"))  # 同時執行的批次數
+FINISHED_TTL_SECONDS = 3600  # 結束的工作保留在記憶體中的時間，供重新整理後的頁面取回結果
+MAX_MESSAGES = 200
+
+
+class JobHandle:
+    """單一背景工作的狀態；由工作執行緒更新，介面端只讀取"""
+
+    def __init__(self, job, settings, session_id, options, on_finish=None):
+        self.job = job
+        self.settings = settings
+        self.session_id = session_id
+        self.options = options  # 傳給 run_job 的其他參數（concurrency、cache、rpm 等）
+        self.on_finish = on_finish
+        self.status = "queued"  # queued / running / done / failed / cancelled
+        counts = job.counts()
+        self.done, self.total = counts["done"], counts["total"]
+        self.messages = []
+        self.summary = None
+        self.error = None
+        self.batch_metrics = BatchMetrics(settings.get("engine"))
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._cancel = threading.Event()
+        self._loop = None
+        self._task = None
+        self._lock = threading.Lock()
+
+    @property
+    def job_id(self):
+        return self.job.job_id
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+    def recent_messages(self, limit=None):
+        with self._lock:
+            return list(self.messages[-limit:] if limit else self.messages)
+
+    def _on_progress(self, done, total):
+        self.done, self.total = done, total
+
+    def _on_message(self, level, text):
+        with self._lock:
+            self.messages.append((level, text))
+            del self.messages[:-MAX_MESSAGES]
+
+    def _request_cancel(self):
+        self._cancel.set()
+        loop, task = self._loop, self._task
+        if loop is not None and task is not None:
+            loop.call_soon_threadsafe(task.cancel)
+
+    async def _run(self):
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        if self._cancel.is_set():
+            raise asyncio.CancelledError
+        return await run_job(self.job, self.settings, on_progress=self._on_progress, on_message=self._on_message,
+                             batch_metrics=self.batch_metrics, **self.options)
+
+
+class JobRunner:
+    """
+    進程內的批次工作佇列。
+    挑選下一個工作時，執行中工作最少的工作階段優先，其次是最久沒輪到的，同一階段內依提交順序。
+    已完成的項目都寫在 job 目錄的檢查點中，取消或伺服器重啟後再提交同一個 job 會從中斷處繼續。
+    """
+
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = max(1, int(workers))
+        self._jobs = {}  # job_id -> JobHandle
+        self._queue = []
+        self._running = collections.Counter()  # session_id -> 執行中的工作數
+        self._last_served = {}  # session_id -> 上次開始執行的序號
+        self._serial = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def submit(self, job, settings, session_id, on_finish=None, **options):
+        """
+        排入一個 BatchJob，返回 JobHandle；同一個 job 已在排隊或執行中時直接返回既有的 handle。
+        on_finish(handle) 在工作結束後於工作執行緒中呼叫。
+        """
+        with self._cond:
+            handle = self._jobs.get(job.job_id)
+            if handle is not None and handle.active:
+                return handle
+            self._prune()
+            handle = JobHandle(job, settings, session_id, options, on_finish)
+            self._jobs[job.job_id] = handle
+            self._queue.append(handle)
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._worker, name=f"tts-job-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify()
+        return handle
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def queue_position(self, handle):
+        """排隊中的工作前面還有幾個（依提交順序估計）；不在排隊中時返回 0"""
+        with self._cond:
+            return self._queue.index(handle) if handle in self._queue else 0
+
+    def running_count(self):
+        with self._cond:
+            return sum(self._running.values())
+
+    def cancel(self, job_id):
+        """取消排隊或執行中的工作；執行中的工作在目前的請求結束後停止，已完成的項目保留在檢查點"""
+        with self._cond:
+            handle = self._jobs.get(job_id)
+            if handle is None or not handle.active:
+                return
+            if handle in self._queue:
+                self._queue.remove(handle)
+                handle.status = "cancelled"
+                handle.finished = time.time()
+                return
+        handle._request_cancel()
+
+    def _prune(self):
+        cutoff = time.time() - FINISHED_TTL_SECONDS
+        for job_id, handle in list(self._jobs.items()):
+            if not handle.active and handle.finished and handle.finished < cutoff:
+                del self._jobs[job_id]
+
+    def _next(self):
+        best, best_key = None, None
+        for handle in self._queue:
+            key = (self._running[handle.session_id], self._last_served.get(handle.session_id, -1))
+            if best is None or key < best_key:
+                best, best_key = handle, key
+        return best
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                handle = self._next()
+                self._queue.remove(handle)
+                self._running[handle.session_id] += 1
+                self._last_served[handle.session_id] = next(self._serial)
+            try:
+                self._execute(handle)
+            finally:
+                with self._cond:
+                    self._running[handle.session_id] -= 1
+                    if not self._running[handle.session_id]:
+                        del self._running[handle.session_id]
+
+    def _execute(self, handle):
+        handle.status = "running"
+        handle.started = time.time()
+        status = "failed"
+        try:
+            handle.summary = asyncio.run(handle._run())
+            status = "done"
+        except asyncio.CancelledError:
+            status = "cancelled"
+        except Exception as e:
+            handle.error = str(e)
+            logger.exception("批次工作 %s 失敗", handle.job_id)
+        # 先記下結束時間再更新狀態，介面看到結束狀態時 finished 一定已設定
+        handle.finished = time.time()
+        handle.status = status
+        if handle.on_finish is not None:
+            try:
+                handle.on_finish(handle)
+            except Exception:
+                logger.exception("批次工作 %s 的結束回呼失敗", handle.job_id)
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_job_runner():
+    """
+    進程內共用的工作佇列（跨所有 Streamlit 工作階段）。
+    設定 TTS_QUEUE_DB 時改為持久化佇列（work_queue.QueueRunner），合成由 tts_worker.py 工作行程執行。
+    """
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = QueueRunner(QUEUE_DB) if QUEUE_DB else JobRunner()
+        return _runner
@@ -1,11 +1,13 @@
-import asyncio
-import edge_tts
+import sys
+from voice_catalog import VoiceCatalog
 
-async def main():
-    voices = await edge_tts.VoicesManager.create()
-    zh_voices = voices.find(Locale="zh-CN")
-    for v in zh_voices:
-        print(f"{v['Name']} - {v['Gender']}")
+def main(locale="zh-CN"):
+    catalog = VoiceCatalog()
+    # 沒有本地目錄或已過期時同步更新一次，其餘情況直接讀取快取
+    if not catalog.voices or catalog.is_stale():
+        catalog.refresh()
+    for v in catalog.find(locale=locale):
+        print(f"{v['ShortName']} - {v['Gender']}")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main(*sys.argv[1:2])
@@ -0,0 +1,167 @@
+import io
+import os
+import re
+
+from audio_trim import _MP3_BITRATES, HAS_NUMPY, HAS_PYDUB, _parse_mp3_header, find_speech_bounds, mp3_frame_index
+from transcode import encode_pcm, pcm_to_wav, read_wav_pcm
+
+if HAS_NUMPY:
+    import numpy as np
+
+# 超過此字數的文字切成多段平行合成；0 表示不切
+DEFAULT_CHUNK_CHARS = int(os.environ.get("TTS_CHUNK_CHARS", "200"))
+DEFAULT_GAP_MS = 250  # 句與句之間的停頓
+CHUNK_CONCURRENCY = int(os.environ.get("TTS_CHUNK_CONCURRENCY", "4"))  # 單筆長文同時合成的段數
+FADE_MS = 5  # 接縫處的淡入淡出，避免波形不連續造成爆音
+JOIN_THRESHOLD = -50.0  # 拼接時判定句首句尾靜音的 dBFS 閾值
+
+# 句末標點（中英文）與次要斷點（逗號、頓號等），標點留在前一句
+_SENTENCE_RE = re.compile(r"[^。！？!?；;…\n]*(?:[。！？!?；;…]+[」』”’）)]*|\n+|$)")
+_CLAUSE_RE = re.compile(r"[^，、,：:]*[，、,：:]?")
+
+
+def _split_sentences(text):
+    sentences = []
+    for part in _SENTENCE_RE.findall(text):
+        # 英文句點只在後面接空白時才斷句（避免切開 3.14 之類的數字）
+        sentences.extend(s for s in re.split(r"(?<=\.)\s+", part) if s.strip())
+    return [s.strip() for s in sentences if s.strip()]
+
+
+def _hard_split(sentence, max_chars):
+    """單句超過上限時先在逗號等次要斷點切，仍太長才依字數硬切"""
+    pieces, current = [], ""
+    for clause in (c for c in _CLAUSE_RE.findall(sentence) if c):
+        while len(clause) > max_chars:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(clause[:max_chars])
+            clause = clause[max_chars:]
+        if current and len(current) + len(clause) > max_chars:
+            pieces.append(current)
+            current = ""
+        current += clause
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_text(text, max_chars=DEFAULT_CHUNK_CHARS):
+    """
+    在中英文句末標點處將長文切段，每段不超過 max_chars 字，相鄰短句合併成同一段。
+    文字本身未超過上限（或 max_chars 為 0）時原樣返回單一段。
+    """
+    text = text.strip()
+    if not max_chars or len(text) <= max_chars:
+        return [text]
+    chunks, current = [], ""
+    for sentence in _split_sentences(text):
+        for piece in ([sentence] if len(sentence) <= max_chars else _hard_split(sentence, max_chars)):
+            sep = " " if current and current[-1].isascii() and piece[0].isascii() else ""
+            if current and len(current) + len(sep) + len(piece) > max_chars:
+                chunks.append(current)
+                current, sep = "", ""
+            current += sep + piece
+    if current:
+        chunks.append(current)
+    return chunks or [text]
+
+
+def _to_samples(pcm, sample_width):
+    return np.frombuffer(pcm, dtype={1: np.uint8, 2: np.int16, 4: np.int32}[sample_width])
+
+
+def join_pcm(pcms, sample_rate, channels=1, sample_width=2, gap_ms=DEFAULT_GAP_MS, trim_ends=False,
+             threshold=JOIN_THRESHOLD, fade_ms=FADE_MS):
+    """
+    拼接多段 PCM：去掉每段接縫側的靜音，兩段之間插入固定長度靜音，接縫處加短淡入淡出。
+    trim_ends=True 時連整段的頭尾靜音也去掉。沒有 NumPy 時只插入靜音、不淡入淡出。
+    """
+    frame_bytes = channels * sample_width
+    gap = bytes(int(sample_rate * gap_ms / 1000) * frame_bytes)
+    if not HAS_NUMPY or sample_width != 2:
+        return gap.join(pcms)
+    fade = int(sample_rate * fade_ms / 1000)
+    parts = []
+    last = len(pcms) - 1
+    for i, pcm in enumerate(pcms):
+        samples = _to_samples(pcm, sample_width)
+        bounds = find_speech_bounds(samples, sample_rate, channels, sample_width, threshold)
+        if bounds is None:
+            continue
+        start = int(bounds[0] * sample_rate / 1000) if (i > 0 or trim_ends) else 0
+        end = int(bounds[1] * sample_rate / 1000) if (i < last or trim_ends) else len(samples) // channels
+        seg = samples[start * channels:end * channels].astype(np.float32).reshape(-1, channels)
+        n = min(fade, len(seg) // 2)
+        if n:
+            ramp = np.linspace(0.0, 1.0, n, dtype=np.float32)[:, None]
+            if i > 0 or trim_ends:
+                seg[:n] *= ramp
+            if i < last or trim_ends:
+                seg[-n:] *= ramp[::-1]
+        parts.append(seg.astype(np.int16).tobytes())
+    return gap.join(parts)
+
+
+def _mp3_stream_info(data):
+    """返回第一個音訊幀的 (位元率 kbps, 取樣率)"""
+    _, frames = mp3_frame_index(data)
+    if not frames:
+        return None
+    pos = frames[0][0]
+    version = {0: 25, 2: 2, 3: 1}[(data[pos + 1] >> 3) & 0x03]
+    bitrate = _MP3_BITRATES[1 if version == 1 else 2][data[pos + 2] >> 4]
+    return bitrate, _parse_mp3_header(data, pos)[2]
+
+
+def _silent_mp3_frames(header, gap_ms):
+    """以現有幀頭（去掉 CRC 與 padding）製作全零的靜音幀，副資訊全零的 Layer III 幀解碼為無聲"""
+    header = bytearray(header[:4])
+    header[1] |= 0x01
+    header[2] &= ~0x02 & 0xFF
+    length, spf, sample_rate = _parse_mp3_header(header + bytes(4), 0)
+    count = max(1, round(gap_ms * sample_rate / 1000 / spf))
+    return (bytes(header) + bytes(length - 4)) * count
+
+
+def join_mp3_frames(chunks, gap_ms=DEFAULT_GAP_MS):
+    """
+    不解碼、直接以 MP3 幀拼接（無 ffmpeg 時使用）。
+    各段需為同一規格（同一引擎與音色），去掉各段的 ID3 與 Xing 標頭後以靜音幀隔開。
+    """
+    parts = []
+    silence = b""
+    for data in chunks:
+        _, frames = mp3_frame_index(data)
+        if not frames:
+            continue
+        if not silence:
+            silence = _silent_mp3_frames(data[frames[0][0]:frames[0][0] + 4], gap_ms)
+        parts.append(data[frames[0][0]:frames[-1][0] + frames[-1][1]])
+    return silence.join(parts)
+
+
+def join_audio(chunks, fmt="mp3", gap_ms=DEFAULT_GAP_MS, trim_ends=False, threshold=JOIN_THRESHOLD):
+    """
+    將分段合成的音訊拼成單一檔案（在後處理工作行程中執行）。
+    WAV 直接拼接 PCM；MP3 在可解碼時（pydub + ffmpeg）解碼、拼接後以原位元率重新編碼一次，
+    否則退回幀拼接。返回與輸入相同格式的 bytes。
+    """
+    if fmt == "wav":
+        decoded = [read_wav_pcm(c) for c in chunks]
+        _, sample_rate, channels, sample_width = decoded[0]
+        pcm = join_pcm([d[0] for d in decoded], sample_rate, channels, sample_width, gap_ms, trim_ends, threshold)
+        return pcm_to_wav(pcm, sample_rate, channels, sample_width)
+    info = _mp3_stream_info(chunks[0])
+    if not (HAS_PYDUB and HAS_NUMPY) or info is None:
+        return join_mp3_frames(chunks, gap_ms)
+    from pydub import AudioSegment
+    try:
+        segments = [AudioSegment.from_file(io.BytesIO(c), format="mp3") for c in chunks]
+    except Exception:
+        return join_mp3_frames(chunks, gap_ms)
+    first = segments[0]
+    pcm = join_pcm([s.raw_data for s in segments], first.frame_rate, first.channels, first.sample_width,
+                   gap_ms, trim_ends, threshold)
+    return encode_pcm(pcm, first.frame_rate, first.channels, "mp3", max(32, info[0]))
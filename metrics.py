@@ -0,0 +1,260 @@
+"""
+批次合成的逐項計時與指標輸出。
+
+每一項在 run_batch 的 worker 中建立一筆紀錄，透過 contextvars 傳到引擎、快取、去靜音與轉碼各處
+（asyncio task 與 asyncio.to_thread 都會帶著同一個 context），各階段以 stage() 累計耗時。
+批次結束後可輸出 JSON Lines 日誌，並累加到進程內的計數器、寫成 Prometheus 文字格式檔案。
+"""
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+DEFAULT_METRICS_DIR = os.environ.get("TTS_METRICS_DIR", str(Path.home() / ".cache" / "geyu-tts" / "metrics"))
+DEFAULT_JSON_LOG = os.path.join(DEFAULT_METRICS_DIR, "items.jsonl")
+DEFAULT_PROM_FILE = os.path.join(DEFAULT_METRICS_DIR, "geyu_tts.prom")
+
+# 各階段名稱：排隊（併發 + 限速等待）、網路請求、首包時間、去靜音、長文拼接、合併請求切分、轉碼、寫入壓縮檔
+STAGES = ("queue_wait", "network", "ttfb", "trim", "concat", "split", "transcode", "write")
+
+_current = contextvars.ContextVar("tts_item_record", default=None)
+logger = logging.getLogger("geyu_tts")
+
+
+def new_record(engine, text):
+    return {
+        "engine": engine, "chars": len(text), "cache_hit": None, "retries": 0,
+        # 未經過的階段保持 None（例如快取命中沒有網路請求、Edge 不需轉碼），不計入統計
+        "queue_wait": 0.0, "network": None, "ttfb": None, "trim": None, "concat": None,
+        "split": None, "transcode": None, "write": None,
+        "total": 0.0, "hedged": False, "hedge_won": False, "fallback": None,
+        "bundled": 0,  # 與其他短句合併請求時為該次請求的筆數
+        "warnings": [], "_stack": [],
+    }
+
+
+@contextlib.contextmanager
+def track(record):
+    """在 with 區塊（及其衍生的 task / 執行緒）內將 record 設為目前項目的紀錄"""
+    token = _current.set(record)
+    try:
+        yield record
+    finally:
+        _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    累計目前項目在 name 階段的耗時；沒有紀錄時不做任何事。
+    巢狀的階段時間只算在內層（例如 Edge 生成函式內的去靜音不計入網路請求）。
+    """
+    record = _current.get()
+    if record is None:
+        yield
+        return
+    entry = [name, time.perf_counter(), 0.0]
+    record["_stack"].append(entry)
+    try:
+        yield
+    finally:
+        record["_stack"].pop()
+        elapsed = time.perf_counter() - entry[1]
+        record[name] = (record.get(name) or 0.0) + elapsed - entry[2]
+        if record["_stack"]:
+            record["_stack"][-1][2] += elapsed
+
+
+def mark_first_byte():
+    """在收到第一個音訊位元組時呼叫；記錄自本次網路請求開始的時間（重試時以最後一次為準）"""
+    record = _current.get()
+    if record is None:
+        return
+    for name, start, _ in reversed(record["_stack"]):
+        if name == "network":
+            record["ttfb"] = time.perf_counter() - start
+            return
+
+
+def fork():
+    """
+    為同一項目的並行嘗試（對沖請求）建立獨立紀錄，避免兩個嘗試互相打亂階段堆疊。
+    沒有目前紀錄時返回 None。
+    """
+    record = _current.get()
+    if record is None:
+        return None
+    return new_record(record["engine"], "")
+
+
+def merge(child, fields=("ttfb", "trim")):
+    """將勝出嘗試的 fork 紀錄中指定階段併入目前項目"""
+    record = _current.get()
+    if record is None or child is None:
+        return
+    for name in fields:
+        if child.get(name) is not None:
+            record[name] = child[name] if name == "ttfb" else (record.get(name) or 0.0) + child[name]
+    record["warnings"].extend(child["warnings"])
+
+
+def tag(**fields):
+    """在目前項目的紀錄加上標記（例如 hedged、fallback）"""
+    record = _current.get()
+    if record is not None:
+        record.update(fields)
+
+
+def note(field, value=1):
+    """累加目前項目的計數欄位（例如 retries）"""
+    record = _current.get()
+    if record is not None:
+        record[field] = record.get(field, 0) + value
+
+
+def warn(message):
+    """記錄不致失敗、但應讓使用者看到的狀況（例如去靜音或轉碼失敗而保留原檔）"""
+    logger.warning(message)
+    record = _current.get()
+    if record is not None:
+        record["warnings"].append(message)
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, -(-len(ordered) * pct // 100) - 1))]
+
+
+class BatchMetrics:
+    """一個批次的逐項紀錄；items 依輸入順序排列"""
+
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.started = time.time()
+        self.finished = None
+        self.items = []
+
+    def add(self, idx, fname, record, shared=False):
+        """
+        登錄第 idx 項的合成紀錄。重複內容共用同一次合成時 shared=True，
+        其網路與轉碼時間只在第一項計入統計。
+        """
+        entry = {k: v for k, v in record.items() if not k.startswith("_")}
+        entry["warnings"] = list(record["warnings"])
+        entry.update(index=idx, id=fname, shared=shared, status="pending", error=None, file=None)
+        while len(self.items) <= idx:
+            self.items.append(None)
+        self.items[idx] = entry
+        return entry
+
+    def finish(self):
+        self.finished = time.time()
+        _registry.observe(self)
+
+    def stage_summary(self):
+        """每個階段的筆數、平均、p50、p95、最大值與總和（秒）；共用合成的項目不重複計算"""
+        rows = []
+        for name in STAGES + ("total",):
+            values = [e[name] for e in self.items
+                      if e and e[name] is not None and not (e["shared"] and name != "write")]
+            rows.append({
+                "stage": name, "count": len(values),
+                "mean_s": sum(values) / len(values) if values else 0.0,
+                "p50_s": _percentile(values, 50), "p95_s": _percentile(values, 95),
+                "max_s": max(values) if values else 0.0, "sum_s": sum(values),
+            })
+        return rows
+
+    def counters(self):
+        entries = [e for e in self.items if e]
+        return {
+            "items": len(entries),
+            "failed": sum(1 for e in entries if e["status"] == "failed"),
+            "retries": sum(e["retries"] for e in entries if not e["shared"]),
+            "cache_hits": sum(1 for e in entries if e["cache_hit"] and not e["shared"]),
+            "cache_misses": sum(1 for e in entries if e["cache_hit"] is False and not e["shared"]),
+        }
+
+    def write_json_log(self, path=DEFAULT_JSON_LOG):
+        """以 JSON Lines 附加寫入每一項的紀錄"""
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            for e in self.items:
+                if e:
+                    f.write(json.dumps({"batch_started": self.started, **e}, ensure_ascii=False) + "\n")
+
+
+class MetricsRegistry:
+    """進程內累計的各引擎計數器與階段耗時，輸出為 Prometheus 文字格式"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}  # (metric, engine) -> 值
+        self.stage_seconds = {}  # (engine, stage) -> [總和, 筆數]
+
+    def observe(self, batch):
+        with self._lock:
+            for e in batch.items:
+                if not e:
+                    continue
+                engine = e["engine"]
+                self._inc("items_total", engine)
+                if e["status"] == "failed":
+                    self._inc("failures_total", engine)
+                if e["shared"]:
+                    self._inc("deduplicated_total", engine)
+                    continue
+                self._inc("retries_total", engine, e["retries"])
+                if e["cache_hit"] is not None:
+                    self._inc("cache_hits_total" if e["cache_hit"] else "cache_misses_total", engine)
+                for name in STAGES:
+                    if e[name] is not None:
+                        acc = self.stage_seconds.setdefault((engine, name), [0.0, 0])
+                        acc[0] += e[name]
+                        acc[1] += 1
+
+    def _inc(self, metric, engine, value=1):
+        self.counters[(metric, engine)] = self.counters.get((metric, engine), 0) + value
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for metric in sorted({m for m, _ in self.counters}):
+                lines.append(f"# TYPE geyu_tts_{metric} counter")
+                for (m, engine), value in sorted(self.counters.items()):
+                    if m == metric:
+                        lines.append(f'geyu_tts_{metric}{{engine="{engine}"}} {value}')
+            if self.stage_seconds:
+                lines.append("# TYPE geyu_tts_stage_seconds summary")
+                for (engine, name), (total, count) in sorted(self.stage_seconds.items()):
+                    labels = f'engine="{engine}",stage="{name}"'
+                    lines.append(f"geyu_tts_stage_seconds_sum{{{labels}}} {total:.6f}")
+                    lines.append(f"geyu_tts_stage_seconds_count{{{labels}}} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path=DEFAULT_PROM_FILE):
+        """原子寫入 Prometheus 文字格式（可供 node_exporter textfile collector 讀取）"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+
+_registry = MetricsRegistry()
+
+
+def get_registry():
+    return _registry
@@ -0,0 +1,169 @@
+"""
+編輯中的預先合成：使用者還在修改清單時，在背景先合成新增或變動的行並寫入音訊快取，
+按下「開始批量生成」時大部分項目已可直接命中快取。
+
+每個工作階段只保留最新一次的內容與設定；任何變動都會取消進行中的預先合成（已寫入快取的結果保留），
+並在最後一次變動後等待 PREFETCH_DEBOUNCE_SECONDS 才重新開始。
+合成走與正式批次相同的 run_batch（相同的快取鍵、限速器與 Edge 合併請求），
+但併發數較低、失敗不重試，且有正式批次執行時暫停，讓出供應商配額。
+佇列模式（設定 TTS_QUEUE_DB）不使用：合成在工作行程中進行，介面行程的快取對它們沒有幫助。
+"""
+import asyncio
+import os
+import threading
+import time
+
+from audio_cache import AudioCache
+from batch_jobs import job_id_for
+from job_runner import get_job_runner
+from metrics import logger
+from tts_core import DEFAULT_SETTINGS, cache_key_params, run_batch
+
+PREFETCH_DEBOUNCE_SECONDS = float(os.environ.get("TTS_PREFETCH_DEBOUNCE_SECONDS", "1.5"))
+PREFETCH_CONCURRENCY = int(os.environ.get("TTS_PREFETCH_CONCURRENCY", "2"))
+PREFETCH_MAX_ITEMS = 300  # 單次最多預先合成的項目數，避免貼上大量文字時一口氣用掉配額
+PREFETCH_SLICE = 8  # 每合成這麼多項就檢查一次是否有正式批次在執行
+IDLE_TTL_SECONDS = 3600
+
+
+def missing_items(items, settings, cache):
+    """返回快取中還沒有的項目；以實際合成參數判斷，音色或設定改變時所有項目都視為新項目。內容相同的只留一筆"""
+    settings = {**DEFAULT_SETTINGS, **settings}
+    seen = set()
+    missing = []
+    for fname, txt in items:
+        key = AudioCache.make_key(**cache_key_params(settings, txt))
+        if key not in seen and not cache.contains(key):
+            missing.append((fname, txt))
+        seen.add(key)
+    return missing
+
+
+class PrefetchState:
+    """單一工作階段的預先合成進度；由背景事件迴圈更新，介面端只讀取"""
+
+    def __init__(self, signature, items, settings):
+        self.signature = signature
+        self.items = items
+        self.settings = settings
+        self.status = "waiting"  # waiting / paused / running / done / failed / cancelled
+        self.done = 0
+        self.total = 0
+        self.error = None
+        self.updated = time.time()
+        self.task = None
+
+
+class Prefetcher:
+    """
+    進程內共用的預先合成器；所有工作階段共用一個背景執行緒上的事件迴圈。
+    is_busy() 為真時（有正式批次在執行）暫停，不與批次搶同一個供應商的限速器。
+    """
+
+    def __init__(self, cache=None, concurrency=PREFETCH_CONCURRENCY, debounce=PREFETCH_DEBOUNCE_SECONDS,
+                 is_busy=None):
+        self.cache = cache or AudioCache()
+        self.concurrency = max(1, int(concurrency))
+        self.debounce = debounce
+        self.is_busy = is_busy or (lambda: False)
+        self._sessions = {}  # session_id -> PrefetchState
+        self._lock = threading.Lock()
+        self._loop = None
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="tts-prefetch", daemon=True).start()
+            return self._loop
+
+    def schedule(self, session_id, items, settings):
+        """
+        記下此工作階段最新的清單與設定；與上次相同時不做任何事，不同時取消舊的預先合成並重新倒數。
+        返回該階段的 PrefetchState。
+        """
+        signature = job_id_for(items, settings)
+        loop = self._get_loop()
+        with self._lock:
+            self._prune()
+            state = self._sessions.get(session_id)
+            if state is not None and state.signature == signature:
+                return state
+            if state is not None:
+                self._cancel(state)
+            state = self._sessions[session_id] = PrefetchState(signature, list(items), dict(settings))
+        loop.call_soon_threadsafe(self._start, state)
+        return state
+
+    def cancel(self, session_id):
+        """停止此工作階段的預先合成（例如按下正式生成或關閉預先合成）"""
+        with self._lock:
+            state = self._sessions.pop(session_id, None)
+        if state is not None:
+            self._cancel(state)
+
+    def status(self, session_id):
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def _cancel(self, state):
+        task, loop = state.task, self._loop
+        state.status = "cancelled"
+        if task is not None and loop is not None:
+            loop.call_soon_threadsafe(task.cancel)
+
+    def _start(self, state):
+        if state.status != "cancelled":
+            state.task = asyncio.ensure_future(self._run(state))
+
+    def _prune(self):
+        cutoff = time.time() - IDLE_TTL_SECONDS
+        for session_id, state in list(self._sessions.items()):
+            if state.task is not None and state.task.done() and state.updated < cutoff:
+                del self._sessions[session_id]
+
+    async def _wait_idle(self, state):
+        while self.is_busy():
+            state.status = "paused"
+            await asyncio.sleep(1.0)
+
+    async def _run(self, state):
+        # 防抖：等待期間再有變動時，此工作會被取消、由新的工作重新倒數
+        await asyncio.sleep(self.debounce)
+        try:
+            await self._wait_idle(state)
+            todo = await asyncio.to_thread(missing_items, state.items, state.settings, self.cache)
+            todo = todo[:PREFETCH_MAX_ITEMS]
+            state.total = len(todo)
+            # 失敗的項目不重試、不改用備援、也不送對沖請求，留給正式批次處理（屆時才有完整的錯誤回報）
+            settings = {**state.settings, "fallback_engine": "", "hedge": False}
+            for start in range(0, len(todo), PREFETCH_SLICE):
+                await self._wait_idle(state)
+                state.status = "running"
+                async for _, data, _, err in run_batch(todo[start:start + PREFETCH_SLICE], settings,
+                                                       concurrency=self.concurrency, cache=self.cache, max_attempts=1):
+                    if hasattr(data, "close"):
+                        data.close()
+                    state.done += err is None
+                    state.updated = time.time()
+            state.status = "done"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            state.status, state.error = "failed", str(e)
+            logger.warning("預先合成失敗：%s", e)
+        finally:
+            state.updated = time.time()
+
+
+_prefetcher = None
+_prefetcher_lock = threading.Lock()
+
+
+def get_prefetcher():
+    """進程內共用的預先合成器；有正式批次執行（含佇列模式的工作行程）時自動暫停"""
+    global _prefetcher
+    with _prefetcher_lock:
+        if _prefetcher is None:
+            _prefetcher = Prefetcher(is_busy=lambda: get_job_runner().running_count() > 0)
+        return _prefetcher
@@ -0,0 +1,140 @@
+import asyncio
+import os
+import random
+import re
+import threading
+import time
+
+# 各供應商每分鐘請求數上限；未列出者（Edge）不限速。可用 TTS_RPM_<ENGINE> 覆寫
+DEFAULT_RPM = {
+    "gemini": 30,
+    "google": 120,
+    "elevenlabs": 100,
+    "fish": 100,
+}
+
+
+class AdaptiveTokenBucket:
+    """
+    每個供應商共用的權杖桶限速器。
+    狀態以 threading.Lock 保護、等待以 sleep 實現，可跨事件迴圈與執行緒共用。
+    遇到 429 時速率減半並暫停到 Retry-After；連續成功後逐步恢復到 max_rpm。
+    """
+
+    def __init__(self, rpm, burst=1, max_rpm=None):
+        self.max_rpm = float(max_rpm or rpm)
+        self.min_rpm = 1.0
+        self.rpm = float(rpm)
+        self.burst = max(1, int(burst))
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self.throttled = 0
+
+    def configure(self, rpm, max_rpm=None):
+        with self._lock:
+            self.rpm = float(rpm)
+            self.max_rpm = float(max_rpm or rpm)
+
+    def _reserve(self):
+        """預約一個權杖，返回需等待的秒數（權杖可為負值，代表已排隊的預約）"""
+        with self._lock:
+            now = time.monotonic()
+            rate = self.rpm / 60.0
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * rate)
+            self._last = now
+            self._tokens -= 1
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / rate
+            return max(wait, self._blocked_until - now)
+
+    async def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            if self.rpm < self.max_rpm:
+                self.rpm = min(self.max_rpm, self.rpm + max(1.0, self.max_rpm * 0.05))
+
+    def on_throttle(self, retry_after=None):
+        with self._lock:
+            self.throttled += 1
+            self.rpm = max(self.min_rpm, self.rpm / 2)
+            pause = retry_after if retry_after else 60.0 / self.rpm
+            self._blocked_until = max(self._blocked_until, time.monotonic() + pause)
+            self._tokens = min(self._tokens, 0.0)
+
+
+class RetryPolicy:
+    """指數退避加全幅抖動 (full jitter)；有 Retry-After 時以其為下限"""
+
+    def __init__(self, max_attempts=4, base_delay=1.0, max_delay=60.0):
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after:
+            return max(float(retry_after), backoff)
+        return backoff
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(engine):
+    """取得（必要時建立）該供應商的進程內共用限速器；不限速的引擎返回 None"""
+    with _limiters_lock:
+        if engine not in _limiters:
+            rpm = os.environ.get(f"TTS_RPM_{engine.upper()}") or DEFAULT_RPM.get(engine)
+            if not rpm:
+                return None
+            max_rpm = os.environ.get(f"TTS_MAX_RPM_{engine.upper()}")
+            _limiters[engine] = AdaptiveTokenBucket(float(rpm), max_rpm=float(max_rpm) if max_rpm else None)
+        return _limiters[engine]
+
+
+def configure_limiter(engine, rpm, max_rpm=None):
+    """調整（或建立）某供應商的每分鐘請求數"""
+    limiter = get_limiter(engine)
+    with _limiters_lock:
+        if limiter is None:
+            limiter = _limiters[engine] = AdaptiveTokenBucket(rpm, max_rpm=max_rpm)
+            return limiter
+    limiter.configure(rpm, max_rpm)
+    return limiter
+
+
+def parse_retry_after(value):
+    """解析 Retry-After 標頭（秒數或 HTTP 日期）"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+_RETRY_IN_RE = re.compile(r"retry in ([\d.]+)\s*s|retry_delay\s*\{\s*seconds:\s*(\d+)", re.IGNORECASE)
+
+
+def retry_after_from_message(message):
+    """從 Gemini 等錯誤訊息中擷取建議的重試秒數"""
+    m = _RETRY_IN_RE.search(message or "")
+    if not m:
+        return None
+    return float(m.group(1) or m.group(2))
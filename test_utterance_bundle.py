@@ -0,0 +1,37 @@
+from audio_trim import mp3_frame_index
+from utterance_bundle import split_audio
+
+# MPEG-1 Layer III、128 kbps、44.1 kHz 的幀頭；每幀 417 bytes、約 26.1 ms
+_HEADER = bytes([0xFF, 0xFB, 0x90, 0x00])
+_FRAME_LEN = 144 * 128000 // 44100
+
+
+def _mp3(frame_count):
+    return b"".join(_HEADER + bytes([i % 256]) * (_FRAME_LEN - 4) for i in range(frame_count))
+
+
+def _duration_ms(data):
+    _, frames = mp3_frame_index(data)
+    return frames[-1][2] + (frames[1][2] - frames[0][2])
+
+
+def test_split_audio_cuts_between_located_items():
+    data = _mp3(160)  # 約 4180 ms
+    parts = split_audio(data, [(0, 1000), (1500, 2500), (3000, 4000)])
+    assert all(parts)
+    assert 1100 < _duration_ms(parts[0]) < 1400
+    assert 1400 < _duration_ms(parts[1]) < 1700
+
+
+def test_split_audio_drops_neighbours_of_unlocated_item():
+    data = _mp3(160)
+    parts = split_audio(data, [(0, 1000), None, (3000, 4000)])
+    assert parts == [None, None, None]
+
+
+def test_split_audio_keeps_items_away_from_the_gap():
+    data = _mp3(200)  # 約 5220 ms
+    parts = split_audio(data, [(0, 800), (1200, 2000), None, (3600, 4400), (4800, 5200)])
+    assert parts[1] is None and parts[2] is None and parts[3] is None
+    assert parts[0] is not None and parts[4] is not None
+    assert _duration_ms(parts[0]) < 1100
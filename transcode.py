@@ -0,0 +1,159 @@
+import asyncio
+import io
+import multiprocessing
+import os
+import struct
+import subprocess
+import threading
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from engine_registry import detect_environment
+
+try:
+    import lameenc
+    HAS_LAMEENC = True
+except ImportError:
+    HAS_LAMEENC = False
+
+DEFAULT_CODEC = "mp3"
+DEFAULT_BITRATE = 192  # kbps
+DEFAULT_BITRATES = {"mp3": DEFAULT_BITRATE, "opus": 32}  # 語音用 Opus 32 kbps 已相當清晰
+TRANSCODE_WORKERS = int(os.environ.get("TTS_TRANSCODE_WORKERS", "0")) or max(1, min(4, os.cpu_count() or 1))
+
+# 找不到行程內編碼器時改用 ffmpeg：codec -> (ffmpeg 格式, 編碼器)
+_FFMPEG_CODECS = {
+    "mp3": ("mp3", "libmp3lame"),
+    "opus": ("ogg", "libopus"),
+}
+
+CODEC_EXTENSIONS = {"mp3": ".mp3", "wav": ".wav", "opus": ".ogg"}
+
+
+def read_wav_pcm(data):
+    """從 WAV bytes 或檔案物件取出 (PCM, 取樣率, 聲道數, 取樣寬度)，不經 ffmpeg"""
+    if hasattr(data, "read"):
+        data.seek(0)
+    else:
+        data = io.BytesIO(data)
+    with wave.open(data, "rb") as wav_file:
+        return (wav_file.readframes(wav_file.getnframes()), wav_file.getframerate(),
+                wav_file.getnchannels(), wav_file.getsampwidth())
+
+
+def pcm_to_wav(pcm, sample_rate, channels=1, sample_width=2):
+    with io.BytesIO() as wav_io:
+        with wave.open(wav_io, "wb") as wav_file:
+            wav_file.setnchannels(channels)
+            wav_file.setsampwidth(sample_width)
+            wav_file.setframerate(sample_rate)
+            wav_file.writeframes(pcm)
+        return wav_io.getvalue()
+
+
+def wav_header(pcm_size, sample_rate, channels=1, sample_width=2):
+    """PCM 長度為 pcm_size 的 44 bytes WAV 檔頭；串流寫入時先寫入長度 0 的檔頭，寫完後再回填"""
+    block_align = channels * sample_width
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + pcm_size, b"WAVE", b"fmt ", 16, 1, channels,
+                       sample_rate, sample_rate * block_align, block_align, sample_width * 8, b"data", pcm_size)
+
+
+def _ffmpeg_encode(pcm, sample_rate, channels, codec, bitrate):
+    fmt, encoder = _FFMPEG_CODECS[codec]
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error",
+           "-f", "s16le", "-ar", str(sample_rate), "-ac", str(channels), "-i", "pipe:0",
+           "-c:a", encoder, "-b:a", f"{bitrate}k", "-f", fmt, "pipe:1"]
+    proc = subprocess.run(cmd, input=pcm, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.decode("utf-8", "replace").strip() or "ffmpeg 轉碼失敗")
+    return proc.stdout
+
+
+def encode_pcm(pcm, sample_rate, channels=1, codec=DEFAULT_CODEC, bitrate=DEFAULT_BITRATE):
+    """
+    將 16-bit PCM 編碼為指定格式，返回 bytes。
+    MP3 優先使用行程內的 LAME 編碼器（不需啟動子行程），其餘格式交給 ffmpeg。
+    """
+    if codec == "wav":
+        return pcm_to_wav(pcm, sample_rate, channels)
+    if codec == "mp3" and HAS_LAMEENC:
+        encoder = lameenc.Encoder()
+        encoder.set_bit_rate(int(bitrate))
+        encoder.set_in_sample_rate(int(sample_rate))
+        encoder.set_channels(int(channels))
+        encoder.set_quality(2)
+        return bytes(encoder.encode(pcm) + encoder.flush())
+    if codec not in _FFMPEG_CODECS:
+        raise ValueError(f"不支援的音訊格式: {codec}")
+    if not detect_environment()["ffmpeg"]:
+        raise RuntimeError("找不到 ffmpeg，無法轉碼")
+    return _ffmpeg_encode(pcm, sample_rate, channels, codec, bitrate)
+
+
+def reencode(data, codec, bitrate=DEFAULT_BITRATE, source_format="mp3"):
+    """將壓縮音訊（bytes）解碼後以 encode_pcm 重新編碼；解碼需要 pydub 與 ffmpeg，在工作行程中執行"""
+    from pydub import AudioSegment
+    audio = AudioSegment.from_file(io.BytesIO(data), format=source_format).set_sample_width(2)
+    return encode_pcm(audio.raw_data, audio.frame_rate, audio.channels, codec, bitrate)
+
+
+def can_encode(codec):
+    return codec == "wav" or (codec == "mp3" and HAS_LAMEENC) or (codec in _FFMPEG_CODECS and detect_environment()["ffmpeg"])
+
+
+class TranscodePool:
+    """
+    常駐的 CPU 後處理工作行程池（轉碼、去靜音）。
+    工作行程只在第一次使用時啟動一次，之後所有批次共用；CPU 工作不佔用事件迴圈，與網路請求同時進行。
+    """
+
+    def __init__(self, workers=TRANSCODE_WORKERS):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn 避免在 Streamlit 的多執行緒行程中 fork
+                ctx = multiprocessing.get_context("spawn")
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+            return self._executor
+
+    async def encode(self, pcm, sample_rate, channels=1, codec=DEFAULT_CODEC, bitrate=DEFAULT_BITRATE):
+        if codec == "wav":
+            return pcm_to_wav(pcm, sample_rate, channels)
+        return await self.run(encode_pcm, pcm, sample_rate, channels, codec, bitrate)
+
+    async def run(self, fn, *args):
+        """在工作行程中執行 fn(*args)；fn 與參數須可 pickle（模組層級函式）"""
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        try:
+            return await loop.run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            # 工作行程異常結束後整個池無法再用，重建後由下一筆開始恢復
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            raise
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_transcode_pool():
+    """進程內共用的轉碼行程池"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = TranscodePool()
+        return _pool
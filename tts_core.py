@@ -0,0 +1,1248 @@
+"""
+格育語音合成核心：各引擎生成函式、「編號 內容」解析與批量 ZIP 組裝。
+不依賴 Streamlit，可供 app.py、batch_cli.py 或其他排程腳本直接匯入。
+"""
+import asyncio
+import contextlib
+import csv
+import functools
+import io
+import json
+import os
+import re
+import time
+import wave
+import zipfile
+from pathlib import Path
+
+import metrics
+from audio_cache import AudioCache
+from audio_trim import HAS_NUMPY, HAS_PYDUB, trim_silence_with_offsets
+from engine_registry import backend, detect_environment
+from hedging import get_latency_tracker, hedged_race, should_hedge
+from http_pool import body_size, copy_body, new_audio_body, stream_post
+from long_text import CHUNK_CONCURRENCY, DEFAULT_CHUNK_CHARS, DEFAULT_GAP_MS, join_audio, split_text
+from utterance_bundle import can_bundle, group_units, join_utterances, locate_items, split_audio
+from transcode import (
+    CODEC_EXTENSIONS, DEFAULT_BITRATE, DEFAULT_CODEC, can_encode, get_transcode_pool, read_wav_pcm, reencode,
+    wav_header,
+)
+from rate_limit import RetryPolicy, configure_limiter, get_limiter, parse_retry_after, retry_after_from_message
+
+# --- 1. 環境檢測 ---
+# 每個進程只檢測一次；各引擎的後端套件（edge_tts、gtts、google.generativeai 等）在第一次使用時才匯入
+HAS_FFMPEG = detect_environment()["ffmpeg"]
+
+# --- 2. 數據定義 ---
+# EDGE TTS
+VOICES_EDGE = {
+    "簡體中文 (中國)": {
+        "zh-CN-XiaoxiaoNeural": "🇨🇳 小曉 (女聲 - 活潑/推薦) 🔥",
+        "zh-CN-XiaoyiNeural": "🇨🇳 小藝 (女聲 - 氣質)",
+        "zh-CN-YunxiaNeural": "🇨🇳 雲夏 (女聲 - 溫馨) ✨",
+        "zh-CN-YunxiNeural": "🇨🇳 雲希 (男聲 - 帥氣)",
+        "zh-CN-YunjianNeural": "🇨🇳 雲健 (男聲 - 體育)",
+        "zh-CN-YunyangNeural": "🇨🇳 雲揚 (男聲 - 專業/播音)",
+    },
+    "繁體中文 (台灣)": {
+        "zh-TW-HsiaoChenNeural": "🇹🇼 曉臻 (女聲 - 溫柔/標準)",
+        "zh-TW-HsiaoYuNeural": "🇹🇼 曉雨 (女聲 - 清晰)",
+        "zh-TW-YunJheNeural": "🇹🇼 雲哲 (男聲 - 沉穩)",
+    },
+    "英文 (美國)": {
+        "en-US-AnaNeural": "🇺🇸 Ana (女聲 - 兒童/可愛)",
+        "en-US-AriaNeural": "🇺🇸 Aria (女聲 - 標準)",
+        "en-US-GuyNeural": "🇺🇸 Guy (男聲 - 標準)",
+    }
+}
+
+# GOOGLE TTS
+LANG_GOOGLE = {
+    "簡體中文 (zh-cn)": "zh-cn",
+    "繁體中文 (zh-tw)": "zh-tw",
+    "英文 (en)": "en"
+}
+
+# ELEVENLABS CONFIG
+VOICES_ELEVEN = {
+    "Adam (男聲 - 沉穩/專業)": "pNInz6z7Z84N3pG095lW",
+    "Rachel (女聲 - 溫柔/熱門)": "21m00Tcm4TlvDq8ikWAM",
+    "Bella (女聲 - 俏皮)": "EXAVITQu4vr4xnSDxMaL",
+    "Antoni (男聲 - 陽光)": "ErXw9OlCNo38pE9vEx9d",
+    "Nicole (女聲 - 甜美)": "piTKPmq9nAByT39UE9Jm",
+    "Josh (男聲 - 深度)": "TxGEqnHWuXilU4dqJnmf",
+}
+
+# API 位址可由環境變數覆寫（例如指向 benchmarks/ 的本地模擬伺服器）
+ELEVENLABS_API_BASE = os.environ.get("ELEVENLABS_API_BASE", "https://api.elevenlabs.io")
+FISH_API_BASE = os.environ.get("FISH_API_BASE", "https://api.fish.audio")
+
+# FISH AUDIO CONFIG
+FISH_MODELS = {
+    "default": "預設音色",
+}
+
+# 輸出格式：可直接要求目標格式的供應商不在本地轉碼
+NATIVE_MP3_KBPS = {"edge": 48, "google": 32}  # Edge / Google 只能輸出固定位元率的 MP3
+ELEVENLABS_BITRATES = {"mp3": (32, 64, 96, 128), "opus": (32, 64, 96, 128, 192)}  # MP3 192 kbps 需付費方案，不自動選用
+ELEVENLABS_PCM_RATE = 24000
+FISH_BITRATES = {"mp3": (64, 128, 192), "opus": (24, 32, 48, 64)}
+
+# GEMINI TTS CONFIG
+VOICES_GEMINI = {
+    "Kore": "👩 Kore (女聲 - 平衡專業/推薦) ✨",
+    "Puck": "👧 Puck (女聲 - 活力稚嫩)",
+    "Charon": "👨 Charon (男聲 - 沉穩冷靜)",
+    "Fenrir": "🧔 Fenrir (男聲 - 神秘低沉)",
+    "Zephyr": "👩 Zephyr (女聲 - 明亮輕快)"
+}
+
+GEMINI_TTS_MODEL = "models/gemini-3.1-flash-tts-preview"
+GEMINI_SAMPLE_RATE = 24000  # Gemini TTS 輸出 24 kHz、16-bit、單聲道 PCM
+
+GEMINI_PROMPTS = {
+    "none": "",
+    "game": "用充滿活力、興奮且鼓勵的語氣對小朋友說：",
+    "card": "以標準、清晰且溫柔的發音方式，像百科全書一樣朗讀：",
+    "story": "用溫柔、親切且像是在講故事的口吻，慢慢地說：",
+}
+
+ENGINES = ("edge", "google", "gemini", "elevenlabs", "fish")
+
+# 各引擎預設併發數；Gemini 免費版限流嚴格，維持逐筆
+DEFAULT_CONCURRENCY = {"edge": 4, "google": 4, "gemini": 1, "elevenlabs": 2, "fish": 2}
+
+# 單筆失敗時的預設最多嘗試次數（含第一次）
+DEFAULT_MAX_ATTEMPTS = 4
+
+# 批次管線中已完成、尚未寫出的項目上限；決定批次的記憶體用量
+PIPELINE_WINDOW = int(os.environ.get("TTS_PIPELINE_WINDOW", "16"))
+
+# 主引擎重試用盡後可改用的備援引擎（不需 API Key）及其預設音色 / 語言
+FALLBACK_ENGINES = ("edge", "google")
+# 備援引擎依主音色的語系選用的音色（Google 為語言代碼）；找不到同語系的音色時不備援
+FALLBACK_VOICES = {
+    "zh-CN": {"edge": "zh-CN-XiaoxiaoNeural", "google": "zh-cn"},
+    "zh-TW": {"edge": "zh-TW-HsiaoChenNeural", "google": "zh-tw"},
+    "en-US": {"edge": "en-US-AriaNeural", "google": "en"},
+}
+_CJK_RE = re.compile(r"[\u3400-\u9fff]")
+
+DEFAULT_SETTINGS = {
+    "engine": "edge",
+    "voice": "zh-CN-XiaoxiaoNeural",
+    "rate": 0,
+    "pitch": 0,
+    "volume": 0,
+    "lang": "zh-cn",
+    "slow": False,
+    "vibe": "none",
+    "api_key": "",
+    "remove_silence": False,
+    "silence_threshold": -70.0,
+    "exact_trim": False,
+    "codec": DEFAULT_CODEC,
+    "bitrate": DEFAULT_BITRATE,
+    "hedge": None,  # None：依 hedging.HEDGE_ENGINES 自動決定
+    "fallback_engine": "",
+    "fallback_voice": "",
+    "chunk_chars": DEFAULT_CHUNK_CHARS,  # 長文分段字數上限，0 表示不分段
+    "chunk_gap_ms": DEFAULT_GAP_MS,
+    "chunk_concurrency": CHUNK_CONCURRENCY,  # 單筆長文同時合成的段數
+    "edge_bundle": False,  # Edge 短句合併成一次請求，再依 WordBoundary 切回各筆
+}
+
+
+class SynthesisError(Exception):
+    """單筆合成失敗；訊息可直接顯示給使用者"""
+
+    def __init__(self, message, status=None, retry_after=None, retryable=False):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        # 429、5xx 與網路錯誤可重試；缺少 API Key、額度不足等則直接失敗
+        self.retryable = retryable or status == 429 or (status is not None and status >= 500)
+
+    @property
+    def throttled(self):
+        return self.status == 429
+
+
+# --- 3. 輔助功能 ---
+@functools.lru_cache(maxsize=8)
+def _gemini_service_client(api_key):
+    return backend("google.ai.generativelanguage").GenerativeServiceClient(client_options={"api_key": api_key})
+
+def get_gemini_client(api_key=None):
+    """
+    取得綁定此 API Key 的 Gemini 連線（進程內快取，跨 Streamlit rerun 重用）。
+    每個 Key 各有獨立連線，不經 genai.configure 的全域狀態，不同 session 的 Key 互不干擾。
+    """
+    api_key = api_key or get_gemini_api_key()
+    if not api_key:
+        return None
+    return _gemini_service_client(api_key)
+
+class GeminiVoiceModel:
+    """
+    綁定單一 API Key 與音色的 Gemini TTS 模型，介面與 GenerativeModel.generate_content 相同。
+    直接以公開的 GenerativeServiceClient 送出請求：GenerativeModel 只能使用 genai.configure 的全域連線，
+    無法在不改動私有欄位的情況下讓不同 session 使用各自的 Key。
+    """
+
+    def __init__(self, client, voice_name):
+        glm = backend("google.ai.generativelanguage")
+        self._client = client
+        self._glm = glm
+        self._config = glm.GenerationConfig(
+            response_modalities=["AUDIO"],
+            speech_config={"voice_config": {"prebuilt_voice_config": {"voice_name": voice_name}}},
+        )
+
+    def _request(self, text):
+        return self._glm.GenerateContentRequest(
+            model=GEMINI_TTS_MODEL,
+            contents=[{"role": "user", "parts": [{"text": text}]}],
+            generation_config=self._config,
+        )
+
+    def generate_content(self, text, stream=False):
+        if stream:
+            return self._client.stream_generate_content(self._request(text))
+        return self._client.generate_content(self._request(text))
+
+@functools.lru_cache(maxsize=32)
+def get_gemini_model(api_key, voice_name):
+    """依 (API Key, 音色) 快取已設定好語音參數的模型；更換 Key 時自動建立新的"""
+    return GeminiVoiceModel(get_gemini_client(api_key), voice_name)
+
+def wrap_wav_header(pcm_data, sample_rate=24000):
+    """將原始 PCM 16-bit 數據封裝成 WAV 格式"""
+    with io.BytesIO() as wav_io:
+        with wave.open(wav_io, "wb") as wav_file:
+            wav_file.setnchannels(1)  # Mono
+            wav_file.setsampwidth(2) # 16-bit
+            wav_file.setframerate(sample_rate)
+            wav_file.writeframes(pcm_data)
+        return wav_io.getvalue()
+
+def trim_silence(audio_bytes, threshold=-70.0, exact=False):
+    """
+    去除頭尾靜音；解碼一次後以 NumPy 向量化計算 RMS 包絡找出起訖點。
+    預設在 MP3 幀邊界直接切割不重新編碼，exact=True 時才以取樣精度裁切並重新編碼。
+    """
+    if not HAS_PYDUB or not HAS_FFMPEG or not HAS_NUMPY: return audio_bytes
+    try:
+        with metrics.stage("trim"):
+            trimmed, _ = trim_silence_with_offsets(audio_bytes, threshold, exact=exact)
+        return trimmed
+    except Exception as e:
+        metrics.warn(f"去靜音失敗，保留原始音訊：{e}")
+    return audio_bytes
+
+# --- 4. 生成邏輯 ---
+async def generate_audio_stream_edge(text, voice, rate_val, volume_val, pitch_val, remove_silence=False, silence_threshold=-70.0, exact_trim=False):
+    rate_str = f"{rate_val:+d}%"
+    pitch_str = f"{pitch_val:+d}Hz"
+    volume_str = f"{volume_val:+d}%"
+    
+    try:
+        communicate = backend("edge_tts").Communicate(text, voice, rate=rate_str, volume=volume_str, pitch=pitch_str)
+        audio_data = io.BytesIO()
+        has_data = False
+        async for chunk in communicate.stream():
+            if chunk["type"] == "audio":
+                if not has_data:
+                    metrics.mark_first_byte()
+                audio_data.write(chunk["data"])
+                has_data = True
+        
+        if not has_data:
+            # 如果還是失敗，可能是這個新角色不支援微調參數，嘗試用預設參數再請求一次
+            if rate_val != 0 or pitch_val != 0 or volume_val != 0:
+                communicate = backend("edge_tts").Communicate(text, voice)
+                audio_data = io.BytesIO()
+                async for chunk in communicate.stream():
+                    if chunk["type"] == "audio":
+                        audio_data.write(chunk["data"])
+                        has_data = True
+            
+        if not has_data:
+            raise ValueError(f"語音引擎無法生成角色 {voice} 的音訊內容。請檢查角色 ID 或稍後再試。")
+            
+        final_bytes = audio_data.getvalue()
+        if remove_silence:
+            final_bytes = trim_silence(final_bytes, silence_threshold, exact_trim)
+        return final_bytes
+    except Exception as e:
+        # 如果徹底失敗，拋出錯誤讓主迴圈捕獲
+        raise e
+
+async def generate_audio_multi_edge(texts, voice, rate_val, volume_val, pitch_val):
+    """
+    將多筆短文字合併成一次 Edge 請求，收集 WordBoundary 事件並對回各筆。
+    返回 (MP3 bytes, 各筆的 (start_ms, end_ms) 或 None)，切割交給 utterance_bundle.split_audio。
+    """
+    joined, spans = join_utterances(texts)
+    params = dict(rate=f"{rate_val:+d}%", volume=f"{volume_val:+d}%", pitch=f"{pitch_val:+d}Hz")
+    try:
+        communicate = backend("edge_tts").Communicate(joined, voice, boundary="WordBoundary", **params)
+    except TypeError:
+        # edge-tts 7 之前沒有 boundary 參數，預設即回傳 WordBoundary
+        communicate = backend("edge_tts").Communicate(joined, voice, **params)
+    audio_data = io.BytesIO()
+    events = []
+    async for chunk in communicate.stream():
+        if chunk["type"] == "audio":
+            if not audio_data.tell():
+                metrics.mark_first_byte()
+            audio_data.write(chunk["data"])
+        elif chunk["type"] in ("WordBoundary", "SentenceBoundary"):
+            events.append(chunk)
+    if not audio_data.tell():
+        raise ValueError(f"語音引擎無法生成角色 {voice} 的音訊內容。請檢查角色 ID 或稍後再試。")
+    return audio_data.getvalue(), locate_items(joined, spans, events)
+
+def generate_audio_stream_google(text, lang, slow=False, remove_silence=False, silence_threshold=-70.0, exact_trim=False):
+    tts = backend("gtts").gTTS(text=text, lang=lang, slow=slow)
+    fp = io.BytesIO()
+    tts.write_to_fp(fp)
+    metrics.mark_first_byte()  # gTTS 不提供串流，以整段下載完成時間計
+    final_bytes = fp.getvalue()
+    if remove_silence:
+        final_bytes = trim_silence(final_bytes, silence_threshold, exact_trim)
+    return final_bytes
+
+def get_gemini_api_key():
+    """從環境變數或 .env 檔案獲取 API Key"""
+    # 優先從系統環境變量獲取
+    key = os.environ.get("GEMINI_API_KEY")
+    if key and len(key.strip()) > 10:
+        return key.strip()
+    return None
+
+def generate_audio_stream_elevenlabs(text, api_key, voice_id, output_format="mp3_44100_128"):
+    """
+    使用 ElevenLabs API 生成音訊
+    API Document: https://elevenlabs.io/docs/api-reference/text-to-speech
+    """
+    buf = io.BytesIO()
+    result = stream_audio_elevenlabs(text, api_key, voice_id, buf, output_format)
+    return buf.getvalue() if result is buf else result
+
+def stream_audio_elevenlabs(text, api_key, voice_id, out, output_format="mp3_44100_128"):
+    """
+    同 generate_audio_stream_elevenlabs，但經共用連線池將音訊分塊寫入 out。
+    output_format 為 pcm_* 時先寫入 WAV 檔頭、收完後回填長度，out 內即為 WAV。
+    成功時返回 out，失敗時返回錯誤 dict。
+    """
+    if not api_key:
+        return {"error": "找不到 ElevenLabs API Key。"}
+    
+    url = f"{ELEVENLABS_API_BASE}/v1/text-to-speech/{voice_id}?output_format={output_format}"
+    pcm_rate = int(output_format.split("_")[1]) if output_format.startswith("pcm_") else None
+    if pcm_rate:
+        out.write(wav_header(0, pcm_rate))
+    headers = {
+        "xi-api-key": api_key,
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "text": text,
+        "model_id": "eleven_multilingual_v2",
+        "voice_settings": {
+            "stability": 0.5,
+            "similarity_boost": 0.75
+        }
+    }
+    
+    try:
+        response = stream_post(url, out, json=payload, headers=headers)
+        if response.status_code == 200:
+            if pcm_rate:
+                size = out.seek(0, io.SEEK_END) - 44
+                out.seek(0)
+                out.write(wav_header(size, pcm_rate))
+                out.seek(0)
+            return out
+        else:
+             err_msg = response.text
+             try:
+                 err_json = response.json()
+                 if "detail" in err_json and "message" in err_json["detail"]:
+                     err_msg = err_json["detail"]["message"]
+             except: pass
+             return {"error": f"ElevenLabs API 錯誤 ({response.status_code}): {err_msg}",
+                     "status": response.status_code,
+                     "retry_after": parse_retry_after(response.headers.get("Retry-After"))}
+    except Exception as e:
+        return {"error": str(e), "retryable": True}
+
+def generate_audio_stream_fish(text, api_key, reference_id="", audio_format=None):
+    """
+    使用 Fish Audio API 生成音訊
+    API Document: https://api.fish.audio/v1/tts
+    """
+    buf = io.BytesIO()
+    result = stream_audio_fish(text, api_key, reference_id, buf, audio_format)
+    return buf.getvalue() if result is buf else result
+
+def stream_audio_fish(text, api_key, reference_id, out, audio_format=None):
+    """
+    同 generate_audio_stream_fish，但經共用連線池將音訊分塊寫入 out。
+    audio_format 為請求中的格式欄位（format、mp3_bitrate / opus_bitrate），預設 MP3。
+    成功時返回 out，失敗時返回錯誤 dict。
+    """
+    if not api_key:
+        return {"error": "找不到 Fish Audio API Key。"}
+    
+    url = f"{FISH_API_BASE}/v1/tts"
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    
+    payload = {
+        "text": text,
+        **(audio_format or {"format": "mp3"})
+    }
+    if reference_id and reference_id.strip():
+        payload["reference_id"] = reference_id.strip()
+    
+    try:
+        response = stream_post(url, out, json=payload, headers=headers)
+        if response.status_code == 200:
+            return out
+        else:
+             err_msg = response.text
+             try:
+                 err_json = response.json()
+                 if "message" in err_json:
+                     err_msg = err_json["message"]
+             except: pass
+                 
+             if response.status_code == 402 or "Insufficient Balance" in err_msg:
+                 return {"error": "Fish Audio API 錯誤 (402): API 額度不足。請注意，Fish Audio 的「開發者 API」與「網頁版免費額度」可能是分開計費的。如果沒有儲值，可能無法調用 API。"}
+             return {"error": f"Fish Audio API 錯誤 ({response.status_code}): {err_msg}",
+                     "status": response.status_code,
+                     "retry_after": parse_retry_after(response.headers.get("Retry-After"))}
+    except Exception as e:
+        return {"error": str(e), "retryable": True}
+
+def generate_audio_stream_gemini(text, voice_name, api_key=None):
+    """
+    使用 Gemini 3.1 Flash TTS 生成音訊
+    """
+    api_key = api_key or get_gemini_api_key()
+    if not api_key:
+        return {"error": "找不到 GEMINI_API_KEY 環境變數或 .env 設定。"}
+    
+    try:
+        model = get_gemini_model(api_key, voice_name)
+        response = model.generate_content(text)
+        metrics.mark_first_byte()  # 非串流回應，首包即完整回應
+        
+        # 遍歷所有 candidate 和 part 尋找音訊數據
+        if not response.candidates:
+             return {"error": "Gemini 未生成任何內容，請檢查輸入或 API 狀態。"}
+             
+        for part in response.candidates[0].content.parts:
+            if hasattr(part, 'inline_data'):
+                pcm_data = part.inline_data.data
+                if pcm_data:
+                    return wrap_wav_header(pcm_data, GEMINI_SAMPLE_RATE)
+            
+        return {"error": "已收到 Gemini 回應，但其中不包含音訊數據。"}
+    except Exception as e:
+        return _gemini_error(e)
+
+def _gemini_error(e):
+    err_msg = str(e)
+    status = 429 if ("429" in err_msg or "quota" in err_msg.lower() or "exhausted" in err_msg.lower()) else None
+    return {"error": f"Gemini 請求失敗: {err_msg}", "status": status,
+            "retry_after": retry_after_from_message(err_msg), "retryable": True}
+
+def iter_gemini_pcm(text, voice_name, api_key=None):
+    """
+    以串流模式呼叫 Gemini TTS，PCM 一到就逐塊產生（24 kHz、16-bit、單聲道），供即時試聽與邊收邊寫。
+    失敗時拋出 SynthesisError。
+    """
+    api_key = api_key or get_gemini_api_key()
+    if not api_key:
+        raise SynthesisError("找不到 GEMINI_API_KEY 環境變數或 .env 設定。")
+    received = False
+    try:
+        for chunk in get_gemini_model(api_key, voice_name).generate_content(text, stream=True):
+            for candidate in chunk.candidates[:1]:
+                for part in candidate.content.parts:
+                    pcm_data = getattr(getattr(part, "inline_data", None), "data", None)
+                    if pcm_data:
+                        received = True
+                        yield pcm_data
+    except Exception as e:
+        err = _gemini_error(e)
+        raise SynthesisError(err["error"], status=err["status"], retry_after=err["retry_after"], retryable=True) from e
+    if not received:
+        raise SynthesisError("已收到 Gemini 回應，但其中不包含音訊數據。")
+
+def stream_audio_gemini(text, voice_name, api_key, out):
+    """
+    同 generate_audio_stream_gemini，但以串流模式將 WAV 直接寫入 out：
+    先寫入長度待定的檔頭，PCM 邊收邊寫，結束後回填長度，不在記憶體中另外組一份完整音訊。
+    成功時返回 out，失敗時返回錯誤 dict。
+    """
+    size = 0
+    try:
+        out.write(wav_header(0, GEMINI_SAMPLE_RATE))
+        for pcm_data in iter_gemini_pcm(text, voice_name, api_key):
+            if not size:
+                metrics.mark_first_byte()
+            out.write(pcm_data)
+            size += len(pcm_data)
+    except SynthesisError as e:
+        return {"error": str(e), "status": e.status, "retry_after": e.retry_after, "retryable": e.retryable}
+    out.seek(0)
+    out.write(wav_header(size, GEMINI_SAMPLE_RATE))
+    out.seek(0)
+    return out
+
+# --- 5. 批量處理 ---
+def parse_items(text):
+    """
+    解析「編號 內容」格式的多行文字，返回 [(編號, 內容), ...]。
+    只有一欄的行自動以 auto_<行號> 命名。
+    """
+    items = []
+    lines = text.split('\n')
+    for i, line in enumerate(lines):
+        if line.strip():
+            parts = line.strip().split(maxsplit=1)
+            if len(parts) >= 2:
+                items.append((parts[0], parts[1]))
+            elif len(parts) == 1:
+                auto_id = f"auto_{i+1:03d}"
+                items.append((auto_id, parts[0]))
+    return items
+
+
+def load_manifest(path):
+    """
+    讀取批量清單：.txt 為「編號 內容」，.csv 為 id,text 兩欄（可有表頭），
+    .json 可為 [{"id":..., "text":...}]、[[id, text]] 或 {id: text}。
+    """
+    path = Path(path)
+    raw = path.read_text(encoding="utf-8-sig")
+    suffix = path.suffix.lower()
+    if suffix == ".json":
+        data = json.loads(raw)
+        if isinstance(data, dict):
+            return [(str(k), str(v)) for k, v in data.items()]
+        items = []
+        for i, entry in enumerate(data):
+            if isinstance(entry, dict):
+                items.append((str(entry.get("id") or f"auto_{i+1:03d}"), str(entry["text"])))
+            else:
+                items.append((str(entry[0]), str(entry[1])))
+        return items
+    if suffix == ".csv":
+        rows = [r for r in csv.reader(io.StringIO(raw)) if r and any(c.strip() for c in r)]
+        if rows and [c.strip().lower() for c in rows[0][:2]] == ["id", "text"]:
+            rows = rows[1:]
+        items = []
+        for i, row in enumerate(rows):
+            if len(row) >= 2 and row[1].strip():
+                items.append((row[0].strip() or f"auto_{i+1:03d}", row[1].strip()))
+            elif row[0].strip():
+                items.append((f"auto_{i+1:03d}", row[0].strip()))
+        return items
+    return parse_items(raw)
+
+
+def build_gemini_text(text, vibe="none"):
+    # Gemini TTS preview can sometimes hallucinate or add conversational meta-text
+    # We need to strictly instruct it to ONLY read the content.
+    vibe_prompt = GEMINI_PROMPTS.get(vibe, "") if vibe != "none" else ""
+    return f"{vibe_prompt}\n\n[請勿添加任何解釋或對話，直接朗讀以下內容：]\n{text}"
+
+
+def cache_key_params(settings, text):
+    """決定音訊內容的參數集合（不含 API Key 與併發等執行參數）"""
+    engine = settings["engine"]
+    params = {"engine": engine, "text": text}
+    if engine == "edge":
+        params.update(voice=settings["voice"], rate=settings["rate"], volume=settings["volume"], pitch=settings["pitch"])
+    elif engine == "google":
+        params.update(lang=settings["lang"], slow=settings["slow"])
+    elif engine == "gemini":
+        params.update(voice=settings["voice"], vibe=GEMINI_PROMPTS.get(settings["vibe"], ""))
+    else:
+        params.update(voice=settings["voice"])
+    if engine in ("elevenlabs", "fish"):
+        # 供應商直接輸出的格式不同，內容也不同；其餘引擎快取的是轉碼前的音訊
+        params.update(provider_format(settings, len(split_text(text, settings.get("chunk_chars"))) > 1))
+    if engine in ("edge", "google"):
+        params.update(remove_silence=settings["remove_silence"], silence_threshold=settings["silence_threshold"],
+                      exact_trim=settings["exact_trim"])
+    if len(split_text(text, settings.get("chunk_chars"))) > 1:
+        params.update(chunk_chars=settings["chunk_chars"], chunk_gap_ms=settings["chunk_gap_ms"])
+    elif can_bundle_item(settings, text):
+        # 從合併請求切出的音訊與單獨合成的不完全相同（語調、頭尾停頓），分開快取
+        params.update(bundled=True)
+    return params
+
+
+def can_bundle_item(settings, text):
+    """此項目是否適合與其他短句合併成一次 Edge 請求"""
+    return (settings["engine"] == "edge" and bool(settings.get("edge_bundle")) and can_bundle(text)
+            and len(split_text(text, settings.get("chunk_chars"))) == 1)
+
+
+def _pick_bitrate(choices, bitrate):
+    """不超過 bitrate 的最高可選位元率；全部都超過時取最低"""
+    fitting = [kbps for kbps in choices if kbps <= bitrate]
+    return max(fitting) if fitting else min(choices)
+
+
+def source_format(settings, chunked=False):
+    """
+    向供應商要求的音訊格式（"mp3" / "opus" / "wav"）。
+    Edge / Google 只能輸出 MP3、Gemini 只有 PCM（包成 WAV）；ElevenLabs / Fish 直接要求設定的輸出格式，
+    但長文分段時 Opus 無法直接拼接，改要求 WAV，拼接後再編碼。
+    """
+    engine, codec = settings["engine"], settings["codec"]
+    if engine in NATIVE_MP3_KBPS:
+        return "mp3"
+    if engine == "gemini" or (codec == "opus" and chunked):
+        return "wav"
+    return codec
+
+
+def provider_format(settings, chunked=False):
+    """ElevenLabs 的 output_format 或 Fish 的格式欄位；其他引擎返回空 dict"""
+    engine, bitrate = settings["engine"], settings["bitrate"]
+    fmt = source_format(settings, chunked)
+    if engine == "elevenlabs":
+        if fmt == "wav":
+            return {"output_format": f"pcm_{ELEVENLABS_PCM_RATE}"}
+        sample_rate = 48000 if fmt == "opus" else 44100
+        return {"output_format": f"{fmt}_{sample_rate}_{_pick_bitrate(ELEVENLABS_BITRATES[fmt], bitrate)}"}
+    if engine == "fish":
+        params = {"format": fmt}
+        if fmt in FISH_BITRATES:
+            params[f"{fmt}_bitrate"] = _pick_bitrate(FISH_BITRATES[fmt], bitrate)
+        return params
+    return {}
+
+
+async def finish_format(settings, data, source="mp3"):
+    """
+    將供應商輸出（source 格式）轉為設定的輸出格式，返回 (data, 副檔名)。
+    供應商已直接輸出目標格式時原樣返回；Edge / Google 的 MP3 只有在要求其他格式或更低位元率時才解碼重編。
+    """
+    codec, bitrate = settings["codec"], settings["bitrate"]
+    if source == "wav":
+        return await transcode_wav(data, codec, bitrate)
+    if source == codec and (codec != "mp3" or bitrate >= NATIVE_MP3_KBPS.get(settings["engine"], 0)):
+        return data, CODEC_EXTENSIONS[codec]
+    return await transcode_compressed(data, codec, bitrate, source)
+
+
+async def transcode_compressed(data, codec=DEFAULT_CODEC, bitrate=DEFAULT_BITRATE, source="mp3"):
+    """
+    將壓縮音訊（MP3 等）在轉碼行程池中解碼後重新編碼，返回 (data, 副檔名)。
+    需要 pydub 與 ffmpeg；環境不支援或失敗時保留原始格式。
+    """
+    if not HAS_PYDUB or not HAS_FFMPEG or not can_encode(codec):
+        metrics.warn(f"無法轉為 {codec}（需要 ffmpeg），保留原始 {source.upper()}")
+        return data, CODEC_EXTENSIONS[source]
+    if hasattr(data, "read"):
+        with data:
+            data.seek(0)
+            data = data.read()
+    try:
+        with metrics.stage("transcode"):
+            encoded = await get_transcode_pool().run(reencode, data, codec, bitrate, source)
+        return encoded, CODEC_EXTENSIONS[codec]
+    except Exception as e:
+        metrics.warn(f"轉碼為 {codec} 失敗，保留原始 {source.upper()}：{e}")
+        return data, CODEC_EXTENSIONS[source]
+
+
+async def transcode_wav(data, codec=DEFAULT_CODEC, bitrate=DEFAULT_BITRATE):
+    """
+    將 WAV（bytes 或串流寫入的暫存檔）直接取出 PCM 後交給常駐轉碼行程池編碼，返回 (data, 副檔名)。
+    不支援該格式或轉碼失敗時保留原始 WAV。
+    """
+    if codec == "wav" or not can_encode(codec):
+        return data, ".wav"
+    try:
+        with metrics.stage("transcode"):
+            pcm, sample_rate, channels, _ = read_wav_pcm(data)
+            encoded = await get_transcode_pool().encode(pcm, sample_rate, channels, codec, bitrate)
+        if hasattr(data, "close"):
+            data.close()
+        return encoded, CODEC_EXTENSIONS[codec]
+    except Exception as e:
+        metrics.warn(f"轉碼為 {codec} 失敗，改輸出 WAV：{e}")
+        return data, ".wav"
+
+
+async def trim_audio(data, threshold=-70.0, exact=False):
+    """
+    trim_silence 的非同步版本：解碼與 RMS 計算在後處理行程池中執行，不阻塞事件迴圈。
+    環境不支援或失敗時保留原始音訊。
+    """
+    if not HAS_PYDUB or not HAS_FFMPEG or not HAS_NUMPY:
+        return data
+    if hasattr(data, "read"):
+        with data:
+            data.seek(0)
+            data = data.read()
+    try:
+        with metrics.stage("trim"):
+            trimmed, _ = await get_transcode_pool().run(trim_silence_with_offsets, data, threshold, "mp3", exact)
+        return trimmed
+    except Exception as e:
+        metrics.warn(f"去靜音失敗，保留原始音訊：{e}")
+        return data
+
+
+def _status_from_message(message):
+    m = re.search(r"\b(429|5\d\d)\b", message or "")
+    return int(m.group(1)) if m else None
+
+
+async def _call_engine(settings, text):
+    """呼叫對應引擎的生成函式一次，返回原始音訊 bytes；失敗時拋出 SynthesisError"""
+    engine = settings["engine"]
+    # 去靜音不在生成函式內做，改由 _synthesize_with 交給後處理行程池
+    if engine == "edge":
+        try:
+            return await generate_audio_stream_edge(
+                text, settings["voice"], settings["rate"], settings["volume"], settings["pitch"])
+        except ValueError as e:
+            # 音色 ID 格式錯誤或該角色生成不出音訊：屬設定問題，不重試
+            raise SynthesisError(str(e)) from e
+        except Exception as e:
+            raise SynthesisError(str(e), status=_status_from_message(str(e)), retryable=True) from e
+    if engine == "google":
+        try:
+            return await asyncio.to_thread(generate_audio_stream_google, text, settings["lang"], settings["slow"])
+        except ValueError as e:
+            # 不支援的語言代碼
+            raise SynthesisError(str(e)) from e
+        except Exception as e:
+            raise SynthesisError(str(e), status=_status_from_message(str(e)), retryable=True) from e
+    if engine == "gemini":
+        # 以串流模式接收 PCM，邊收邊寫入暫存容器（WAV），轉碼時直接從中讀取
+        body = new_audio_body()
+        result = await asyncio.to_thread(
+            stream_audio_gemini, build_gemini_text(text, settings["vibe"]), settings["voice"],
+            settings.get("api_key") or None, body)
+        if result is not body:
+            body.close()
+    elif engine in ("elevenlabs", "fish"):
+        # 回應本文直接串流進暫存容器，之後再分塊寫入壓縮檔項目；格式直接向供應商要求
+        stream_fn = stream_audio_elevenlabs if engine == "elevenlabs" else stream_audio_fish
+        audio_format = provider_format(settings)
+        if engine == "elevenlabs":
+            audio_format = audio_format["output_format"]
+        body = new_audio_body()
+        result = await asyncio.to_thread(stream_fn, text, (settings.get("api_key") or "").strip(), settings["voice"], body,
+                                         audio_format)
+        if result is not body:
+            body.close()
+    else:
+        raise SynthesisError(f"未知的引擎: {engine}")
+    if isinstance(result, dict) and "error" in result:
+        err_msg = result["error"]
+        status = result.get("status")
+        if engine == "gemini" and status == 429:
+            err_msg = "請求太頻繁，觸發了免費版 API 的限制 (429 Quota Exceeded)。請等待約一分鐘後再試。"
+        raise SynthesisError(err_msg, status=status, retry_after=result.get("retry_after"),
+                             retryable=result.get("retryable", False))
+    return result
+
+
+async def _call_engine_hedged(settings, text, limiter=None):
+    """
+    呼叫引擎一次；啟用對沖時，超過此引擎近期延遲百分位仍未完成就再送出一個請求，取先成功者。
+    對沖請求同樣經過限速器。
+    """
+    tracker = get_latency_tracker(settings["engine"])
+    delay = tracker.hedge_delay() if should_hedge(settings["engine"], settings.get("hedge")) else None
+
+    async def attempt(is_hedge):
+        if is_hedge and limiter is not None:
+            await limiter.acquire()
+        start = time.perf_counter()
+        child = metrics.fork() if delay is not None else None
+        with metrics.track(child) if child is not None else contextlib.nullcontext():
+            with metrics.stage("network"):
+                result = await _call_engine(settings, text)
+        tracker.observe(time.perf_counter() - start)
+        return result, child
+
+    if delay is None:
+        result, _ = await attempt(False)
+        return result
+    (result, child), hedged, hedge_won = await hedged_race(attempt, delay)
+    metrics.merge(child)
+    if hedged:
+        metrics.tag(hedged=True, hedge_won=hedge_won)
+    return result
+
+
+async def _fetch_raw(settings, text, retry=None, on_retry=None):
+    """
+    經供應商限速器呼叫引擎；遇 429 / 5xx / 網路錯誤時依 Retry-After 與指數退避重試。
+    on_retry(attempt, delay, error) 在每次重試前呼叫。
+    """
+    engine = settings["engine"]
+    retry = retry or RetryPolicy(DEFAULT_MAX_ATTEMPTS)
+    limiter = get_limiter(engine)
+    for attempt in range(retry.max_attempts):
+        if limiter is not None:
+            with metrics.stage("queue_wait"):
+                await limiter.acquire()
+        try:
+            with metrics.stage("network"):
+                result = await _call_engine_hedged(settings, text, limiter)
+        except SynthesisError as e:
+            if e.throttled and limiter is not None:
+                limiter.on_throttle(e.retry_after)
+            if not e.retryable or attempt + 1 >= retry.max_attempts:
+                raise
+            delay = retry.delay(attempt, e.retry_after)
+            metrics.note("retries")
+            if on_retry:
+                on_retry(attempt + 1, delay, e)
+            await asyncio.sleep(delay)
+            continue
+        if limiter is not None:
+            limiter.on_success()
+        return result
+
+
+async def _fetch_chunked(settings, chunks, cache=None, retry=None, on_retry=None):
+    """
+    長文分段平行合成後拼成單一檔案（格式見 source_format(settings, chunked=True)，為 WAV 或 MP3）。
+    每段各自重試並以段為單位快取，某段失敗時重跑只需補合成該段。
+    Edge / Google 開啟去靜音時一併去除整段頭尾靜音。
+    """
+    sem = asyncio.Semaphore(max(1, settings.get("chunk_concurrency") or CHUNK_CONCURRENCY))
+    fmt = source_format(settings, chunked=True)
+    if fmt != source_format(settings):
+        # 無法直接拼接的格式（Opus）各段改要求 WAV
+        settings = {**settings, "codec": fmt}
+
+    async def part(chunk):
+        # 各段並行執行，階段計時各記在自己的紀錄，避免互相干擾
+        child = metrics.fork()
+        async with sem:
+            with metrics.track(child) if child is not None else contextlib.nullcontext():
+                if cache is None:
+                    data = await _fetch_raw(settings, chunk, retry, on_retry)
+                else:
+                    key = AudioCache.make_key(part=True, **cache_key_params(settings, chunk))
+                    data = await cache.afetch(key, lambda: _fetch_raw(settings, chunk, retry, on_retry))
+        if hasattr(data, "read"):
+            with data:
+                data.seek(0)
+                data = data.read()
+        return data, child
+
+    with metrics.stage("network"):
+        results = await asyncio.gather(*(part(chunk) for chunk in chunks))
+    metrics.merge(results[0][1], fields=("ttfb",))
+    metrics.note("retries", sum(child["retries"] for _, child in results if child is not None))
+    engine = settings["engine"]
+    trim_ends = engine in ("edge", "google") and settings["remove_silence"]
+    with metrics.stage("concat"):
+        return await get_transcode_pool().run(
+            join_audio, [data for data, _ in results], fmt,
+            settings["chunk_gap_ms"], trim_ends)
+
+
+def voice_locale(settings, text=""):
+    """
+    主引擎設定的語系（如 "zh-TW"、"en-US"）。Edge 取自音色 ID、Google 取自語言代碼；
+    Gemini 等多語音色無法得知語系，依文字是否含漢字推測。
+    """
+    engine = settings["engine"]
+    if engine == "edge":
+        return "-".join(settings["voice"].split("-")[:2])
+    if engine == "google":
+        lang = settings["lang"].lower()
+        for locale, voices in FALLBACK_VOICES.items():
+            if voices["google"] == lang:
+                return locale
+        return lang
+    return "zh-CN" if _CJK_RE.search(text) else "en-US"
+
+
+def fallback_voice(engine, locale):
+    """備援引擎中與 locale 同語系的音色；完全相同的優先，其次同語言，都沒有時返回 None"""
+    if locale in FALLBACK_VOICES:
+        return FALLBACK_VOICES[locale][engine]
+    language = locale.split("-")[0].lower()
+    for candidate, voices in FALLBACK_VOICES.items():
+        if candidate.split("-")[0].lower() == language:
+            return voices[engine]
+    return None
+
+
+def fallback_settings(settings, text=""):
+    """
+    主引擎失敗時改用的設定；未設定備援、備援與主引擎相同，或備援引擎沒有同語系的音色時返回 None。
+    未指定 fallback_voice 時依主音色的語系選用（見 voice_locale），不會把英文內容改用中文音色朗讀。
+    """
+    engine = settings.get("fallback_engine")
+    if not engine or engine == settings["engine"]:
+        return None
+    voice = settings.get("fallback_voice") or fallback_voice(engine, voice_locale(settings, text))
+    if not voice:
+        return None
+    fallback = {**settings, "engine": engine, "fallback_engine": ""}
+    if engine == "google":
+        fallback["lang"] = voice
+    else:
+        fallback["voice"] = voice
+    return fallback
+
+
+async def synthesize_item(settings, text, cache=None, retry=None, on_retry=None):
+    """
+    合成單筆音訊，返回 (data, 副檔名)。
+    主引擎遇供應商或網路錯誤、重試用盡仍失敗，且設定了 fallback_engine 時改用備援引擎，並在項目紀錄標記 fallback。
+    設定錯誤（缺少 API Key、音色或語言不支援等）與程式錯誤直接拋出，不以其他引擎的結果掩蓋。
+    """
+    try:
+        return await _synthesize_with(settings, text, cache, retry, on_retry)
+    except SynthesisError as e:
+        if not e.retryable:
+            raise
+        fallback = fallback_settings(settings, text)
+        if fallback is None:
+            raise
+        metrics.warn(f"{settings['engine']} 失敗（{e}），改用備援引擎 {fallback['engine']}")
+        data, ext = await _synthesize_with(fallback, text, cache, retry, on_retry)
+        metrics.tag(fallback=fallback["engine"])
+        return data, ext
+
+
+async def _synthesize_with(settings, text, cache=None, retry=None, on_retry=None):
+    """
+    以指定引擎合成單筆音訊，返回 (data, 副檔名)。
+    快取位於各引擎生成函式之前，命中時不會發出請求也不受限速；Edge / Google 快取的是去靜音後的結果。
+    """
+    chunks = split_text(text, settings.get("chunk_chars"))
+
+    async def fetch():
+        if len(chunks) > 1:
+            return await _fetch_chunked(settings, chunks, cache, retry, on_retry)
+        data = await _fetch_raw(settings, text, retry, on_retry)
+        if settings["engine"] in ("edge", "google") and settings["remove_silence"]:
+            data = await trim_audio(data, settings["silence_threshold"], settings["exact_trim"])
+        return data
+
+    if cache is not None:
+        record = metrics.current()
+        if record is not None:
+            record["cache_hit"] = True
+
+        def produce():
+            if record is not None:
+                record["cache_hit"] = False
+            return fetch()
+
+        data = await cache.afetch(AudioCache.make_key(**cache_key_params(settings, text)), produce)
+    else:
+        data = await fetch()
+    return await finish_format(settings, data, source_format(settings, len(chunks) > 1))
+
+
+async def synthesize_edge_bundle(settings, texts, records, cache=None):
+    """
+    以一次 Edge 請求合成多筆短文字，返回與 texts 等長的 list，元素為 MP3 bytes；
+    切不出來或整個請求失敗的項目為 None，由呼叫端逐筆合成（逐筆合成時才有重試與備援）。
+    快取命中的項目不放進請求；records 為各筆的指標紀錄，請求與切割時間記在第一筆待合成的項目。
+    """
+    keys = [AudioCache.make_key(**cache_key_params(settings, t)) for t in texts] if cache is not None else None
+    results = [cache.get(key) for key in keys] if keys else [None] * len(texts)
+    todo = [i for i, data in enumerate(results) if data is None]
+    for i, record in enumerate(records):
+        record["cache_hit"] = None if keys is None else i not in todo
+    if len(todo) < 2:
+        return results
+    try:
+        with metrics.track(records[todo[0]]):
+            with metrics.stage("network"):
+                data, ranges = await generate_audio_multi_edge(
+                    [texts[i] for i in todo], settings["voice"], settings["rate"], settings["volume"], settings["pitch"])
+            with metrics.stage("split"):
+                parts = await get_transcode_pool().run(split_audio, data, ranges)
+    except Exception as e:
+        metrics.warn(f"Edge 合併請求失敗，改為逐筆合成：{e}")
+        return results
+
+    async def finish(i, part):
+        with metrics.track(records[i]):
+            records[i]["bundled"] = len(todo)
+            if settings["remove_silence"]:
+                part = await trim_audio(part, settings["silence_threshold"], settings["exact_trim"])
+        if keys is not None:
+            cache.put(keys[i], part)
+        results[i] = part
+
+    await asyncio.gather(*(finish(i, part) for i, part in zip(todo, parts) if part is not None))
+    return results
+
+
+def plan_batch(items, settings):
+    """
+    依實際合成參數（文字 + 引擎與音色參數）將項目分組，相同內容只需合成一次。
+    返回 [(text, [項目索引, ...]), ...]，順序依各組第一次出現的位置。
+    """
+    settings = {**DEFAULT_SETTINGS, **settings}
+    groups = {}
+    plan = []
+    for idx, (_, txt) in enumerate(items):
+        key = AudioCache.make_key(**cache_key_params(settings, txt))
+        if key not in groups:
+            groups[key] = []
+            plan.append((txt, groups[key]))
+        groups[key].append(idx)
+    return plan
+
+
+async def run_batch(items, settings, concurrency=None, cache=None, on_progress=None,
+                    rpm=None, max_attempts=DEFAULT_MAX_ATTEMPTS, on_retry=None, plan=None, batch_metrics=None,
+                    window=None):
+    """
+    在同一個事件迴圈上併發合成多筆音訊。
+    以 Semaphore 限制同時請求數、以供應商限速器控制每分鐘請求數（rpm 可覆寫設定）。
+    內容相同的項目（見 plan_batch）只合成一次，結果寫到每個需要它的檔名。
+    Edge 開啟 edge_bundle 時，相鄰的短句合併成一次請求（見 synthesize_edge_bundle），切不出來的再逐筆合成。
+    完成順序不定，但依輸入順序逐筆 yield (fname, data, ext, error)。
+    已完成、尚未輸出的結果最多 window 筆（預設 PIPELINE_WINDOW，至少為併發數），
+    前面的項目較慢時後面的請求會暫停，記憶體用量不隨批量成長。
+    on_retry(fname, attempt, delay, error) 在單筆重試前呼叫。
+    傳入 batch_metrics（metrics.BatchMetrics）時記錄每一項的各階段耗時。
+    """
+    settings = {**DEFAULT_SETTINGS, **settings}
+    if plan is None:
+        plan = plan_batch(items, settings)
+    engine = settings["engine"]
+    if concurrency is None:
+        concurrency = DEFAULT_CONCURRENCY.get(engine, 1)
+    if rpm:
+        configure_limiter(engine, rpm)
+    concurrency = max(1, int(concurrency))
+    sem = asyncio.Semaphore(concurrency)
+    # 依建立順序（即輸入順序）取得名額，最前面尚未輸出的項目一定拿得到，不會互相卡死
+    slots = asyncio.Semaphore(max(concurrency, int(window or PIPELINE_WINDOW)))
+    retry = RetryPolicy(max_attempts)
+    total = len(items)
+
+    async def synthesize_group(members, txt, record):
+        fname = items[members[0]][0]
+        item_retry = (lambda attempt, delay, err: on_retry(fname, attempt, delay, err)) if on_retry else None
+        with metrics.track(record):
+            try:
+                data, ext = await synthesize_item(settings, txt, cache, retry, item_retry)
+                if len(members) > 1 and hasattr(data, "read"):
+                    # 同一份串流結果要寫出多次，先讀成 bytes 以便共用
+                    with data:
+                        data.seek(0)
+                        data = data.read()
+                return members, record, data, ext, None
+            except Exception as e:
+                return members, record, None, None, e
+
+    async def worker(unit):
+        """合成一個工作單位（一組，或合併成一次 Edge 請求的多組短句），返回各組的結果"""
+        records = [metrics.new_record(engine, txt) for txt, _ in unit]
+        start = time.perf_counter()
+        with metrics.track(records[0]):
+            with metrics.stage("queue_wait"):
+                await slots.acquire()
+                await sem.acquire()
+        for record in records[1:]:
+            record["queue_wait"] = records[0]["queue_wait"]
+        try:
+            bundled = [None] * len(unit)
+            if len(unit) > 1:
+                bundled = await synthesize_edge_bundle(settings, [txt for txt, _ in unit], records, cache)
+            results = []
+            for (txt, members), record, data in zip(unit, records, bundled):
+                if data is not None:
+                    with metrics.track(record):
+                        data, ext = await finish_format(settings, data, "mp3")
+                    results.append((members, record, data, ext, None))
+                else:
+                    results.append(await synthesize_group(members, txt, record))
+            return results
+        finally:
+            sem.release()
+            for record in records:
+                record["total"] = time.perf_counter() - start
+
+    units = group_units(plan, lambda txt: can_bundle_item(settings, txt))
+    tasks = [asyncio.create_task(worker(unit)) for unit in units]
+    pending = {}
+    next_idx = 0
+    done = 0
+    try:
+        for fut in asyncio.as_completed(tasks):
+            for n, (members, record, data, ext, err) in enumerate(await fut):
+                for idx in members:
+                    # 每個工作單位只佔一個名額，在其第一項輸出時歸還
+                    pending[idx] = (data, ext, err, n == 0 and idx == members[0])
+                    if batch_metrics is not None:
+                        batch_metrics.add(idx, items[idx][0], record, shared=idx != members[0])
+                done += len(members)
+            if on_progress:
+                on_progress(done, total)
+            # 只在前綴齊全時輸出，確保寫入順序與輸入一致
+            while next_idx in pending:
+                data, ext, err, first = pending.pop(next_idx)
+                if first:
+                    slots.release()
+                yield items[next_idx][0], data, ext, err
+                next_idx += 1
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+async def export_batch(items, settings, write, concurrency=None, cache=None, on_progress=None, on_message=None,
+                       rpm=None, max_attempts=DEFAULT_MAX_ATTEMPTS, on_result=None, batch_metrics=None):
+    """
+    批量合成並依輸入順序呼叫 write(檔名, data) 寫出（見 zip_entry_writer / dir_entry_writer）。
+    合成（事件迴圈上的併發請求與行程池中的去靜音 / 轉碼）與寫出同時進行：
+    結果經有上限的佇列交給單一寫入工作，在背景執行緒依序寫出，不阻塞事件迴圈。
+    data 可能是 bytes 或已串流完成的檔案物件，寫出後由本函式關閉。
+    on_message(level, text) 接收 "error" / "warning" / "info" 訊息；
+    on_result(索引, 輸出檔名, error) 在每一項寫出或失敗後呼叫（成功時 error 為 None，失敗時檔名為 None）。
+    batch_metrics（metrics.BatchMetrics）會記錄每一項的各階段耗時與寫入時間，結束時累加到進程計數器。
+    返回 {"ok": 成功數, "failed": [(編號, 錯誤)], "retries": 重試次數, "deduplicated": 省下的請求數,
+          "hedged": 送出對沖請求的項目數, "fallback": [(編號, 備援引擎)]}。
+    """
+    settings = {**DEFAULT_SETTINGS, **settings}
+    plan = plan_batch(items, settings)
+    if batch_metrics is None:
+        batch_metrics = metrics.BatchMetrics(settings["engine"])
+    summary = {"ok": 0, "failed": [], "retries": 0, "deduplicated": len(items) - len(plan),
+               "hedged": 0, "fallback": []}
+    queue = asyncio.Queue(maxsize=PIPELINE_WINDOW)
+    write_error = None
+
+    def note_retry(fname, attempt, delay, err):
+        summary["retries"] += 1
+        if on_message:
+            on_message("info", f"{fname} 第 {attempt} 次重試（{delay:.1f} 秒後）：{err}")
+
+    def finish_item(idx, fname, data, ext, err):
+        entry = batch_metrics.items[idx]
+        if on_message and not entry["shared"]:
+            for warning in entry["warnings"]:
+                on_message("warning", f"{fname}：{warning}")
+        if entry["hedged"] and not entry["shared"]:
+            summary["hedged"] += 1
+        if err is not None:
+            entry.update(status="failed", error=str(err))
+            summary["failed"].append((fname, str(err)))
+            if on_message:
+                on_message("error", f"檔案 {fname} 失敗: {err}")
+            if on_result:
+                on_result(idx, None, err)
+            return None
+        size = body_size(data) if data is not None else 0
+        if size < 100:  # 檢查是否為空
+            if on_message:
+                on_message("warning", f"注意：{fname} 的音訊內容異常過短（{size} bytes）")
+        return entry, size
+
+    async def writer():
+        nonlocal write_error
+        while True:
+            job = await queue.get()
+            if job is None:
+                return
+            idx, fname, data, ext, err = job
+            try:
+                checked = finish_item(idx, fname, data, ext, err) if write_error is None else None
+                if checked is None:
+                    continue
+                entry, size = checked
+                start = time.perf_counter()
+                await asyncio.to_thread(write, f"{fname}{ext}", data)
+                entry.update(status="ok", file=f"{fname}{ext}", bytes=size, write=time.perf_counter() - start)
+                if entry["fallback"]:
+                    summary["fallback"].append((fname, entry["fallback"]))
+                summary["ok"] += 1
+                if on_result:
+                    on_result(idx, f"{fname}{ext}", None)
+            except Exception as e:
+                # 寫入失敗（例如磁碟已滿）時停止合成，剩下的佇列項目只關閉不寫出
+                if write_error is None:
+                    write_error = e
+                    producer.cancel()
+            finally:
+                if hasattr(data, "close"):
+                    data.close()
+
+    async def produce():
+        # 寫入失敗時此工作被取消，aclosing 立即關閉 run_batch、取消仍在進行的合成，
+        # 不等到垃圾回收才釋放配額與限速器
+        async with contextlib.aclosing(run_batch(items, settings, concurrency, cache, on_progress, rpm,
+                                                 max_attempts, note_retry, plan, batch_metrics)) as results:
+            idx = -1
+            async for fname, data, ext, err in results:
+                idx += 1
+                await queue.put((idx, fname, data, ext, err))
+
+    producer = asyncio.create_task(produce())
+    writer_task = asyncio.create_task(writer())
+    try:
+        try:
+            await producer
+        except asyncio.CancelledError:
+            if write_error is None:
+                raise
+        await queue.put(None)
+        await writer_task
+    finally:
+        for task in (producer, writer_task):
+            if not task.done():
+                task.cancel()
+    if write_error is not None:
+        raise write_error
+    batch_metrics.finish()
+    return summary
+
+
+def zip_entry_writer(zf):
+    """返回可寫入 bytes 或檔案物件的 write(name, data)；檔案物件以串流方式寫入 ZIP 項目"""
+    def write(name, data):
+        with zf.open(name, "w") as dst:
+            copy_body(data, dst)
+    return write
+
+
+def dir_entry_writer(out_dir):
+    """返回將音訊寫成 out_dir 下個別檔案的 write(name, data)"""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    def write(name, data):
+        with open(out_dir / name, "wb") as dst:
+            copy_body(data, dst)
+    return write
+
+
+def write_zip(fileobj, items, settings, **kwargs):
+    """同步便利函式：將整批結果寫成 ZIP 至 fileobj，返回摘要"""
+    with zipfile.ZipFile(fileobj, "w") as zf:
+        return asyncio.run(export_batch(items, settings, zip_entry_writer(zf), **kwargs))
@@ -0,0 +1,154 @@
+"""
+佇列模式的合成工作行程：從 work_queue 的持久化佇列領取項目，合成後寫入共用的 job 目錄。
+可在介面所在的主機上啟動任意數量，只要 TTS_QUEUE_DB 與 TTS_JOBS_DIR 指向同一份資料；
+佇列資料庫須在本機磁碟上，不支援跨主機共用（見 work_queue 的說明）。
+
+    TTS_QUEUE_DB=/srv/tts/queue.sqlite3 TTS_JOBS_DIR=/srv/tts/jobs python tts_worker.py --slots 8
+    python tts_worker.py --queue-db /srv/tts/queue.sqlite3 --cap gemini=2 --cap edge=24   # 設定全域上限後結束
+
+API Key 不存入佇列，由工作行程的環境變數提供（GEMINI_API_KEY、ELEVENLABS_API_KEY、FISH_API_KEY）。
+每分鐘請求數（rpm）限速仍是各行程各自計算；跨行程的約束為 --cap 設定的同時請求數。
+"""
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import sys
+import time
+
+import metrics
+from audio_cache import AudioCache
+from batch_cli import API_KEY_ENV
+from batch_jobs import BatchJob
+from rate_limit import RetryPolicy, configure_limiter
+from tts_core import DEFAULT_MAX_ATTEMPTS, DEFAULT_SETTINGS, ENGINES, synthesize_item
+from work_queue import LEASE_SECONDS, QUEUE_DB, WorkQueue
+
+DEFAULT_SLOTS = int(os.environ.get("TTS_WORKER_SLOTS", "8"))  # 單一工作行程同時處理的項目數
+POLL_SECONDS = 1.0
+
+
+async def process(queue, worker_id, claim, cache, jobs):
+    """合成一個領取到的項目並回報結果；合成期間定期續約"""
+    settings = {**DEFAULT_SETTINGS, **claim["settings"]}
+    engine = settings["engine"]
+    settings["api_key"] = os.environ.get(API_KEY_ENV.get(engine, ""), "")
+    # 全域上限以領取的項目數計算：每個項目同時只能送出一個請求，長文分段依序合成、不送對沖請求
+    settings.update(chunk_concurrency=1, hedge=False)
+    options = claim["options"]
+    if options.get("rpm"):
+        configure_limiter(engine, options["rpm"])
+    job = jobs.get(claim["job_id"]) or BatchJob.load(claim["job_id"])
+    jobs[claim["job_id"]] = job
+
+    async def keep_lease():
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            if not await asyncio.to_thread(queue.renew, claim["job_id"], claim["idx"], worker_id):
+                return
+
+    record = metrics.new_record(engine, claim["text"])
+    renewer = asyncio.create_task(keep_lease())
+    start = time.perf_counter()
+    name = error = data = None
+    try:
+        with metrics.track(record):
+            if job is None:
+                raise RuntimeError(f"找不到 job {claim['job_id']} 的目錄，請確認 TTS_JOBS_DIR 與介面相同")
+            data, ext = await synthesize_item(settings, claim["text"], cache if options.get("use_cache") else None,
+                                              RetryPolicy(options.get("max_attempts") or DEFAULT_MAX_ATTEMPTS))
+            name = f"{claim['fname']}{ext}"
+            with metrics.stage("write"):
+                await asyncio.to_thread(job.write_file, name, data)
+                # 內容相同的其他項目沿用同一份音訊（檔名規則與 work_queue.sync_job 一致）
+                for idx in claim["dups"]:
+                    await asyncio.to_thread(job.copy_file, name, f"{job.entries[idx]['id']}{ext}")
+    except Exception as e:
+        name, error = None, e
+    finally:
+        renewer.cancel()
+        if hasattr(data, "close"):
+            data.close()
+    record["total"] = time.perf_counter() - start
+    entry = {k: v for k, v in record.items() if not k.startswith("_")}
+    entry.update(index=claim["idx"], id=claim["fname"], shared=False, status="failed" if error else "ok",
+                 error=None if error is None else str(error), file=name)
+    try:
+        await asyncio.to_thread(queue.complete, claim["job_id"], claim["idx"], worker_id, name, error, entry)
+    except Exception:
+        # 例如資料庫暫時被鎖住；不中斷工作行程，租約過期後項目自動回到佇列重新合成
+        metrics.logger.exception("回報項目 %s#%s 的結果失敗，待租約過期後重新排入", claim["job_id"], claim["idx"])
+
+
+async def run_worker(queue, worker_id, slots=DEFAULT_SLOTS, stop=None):
+    """以 slots 條並行的處理迴圈領取並合成項目，直到 stop（asyncio.Event）被設定"""
+    stop = stop or asyncio.Event()
+    cache = AudioCache()
+    jobs = {}
+
+    async def idle():
+        try:
+            await asyncio.wait_for(stop.wait(), POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+    async def lane():
+        # 單一項目或單次資料庫存取出錯只記錄下來，不讓整個工作行程結束
+        while not stop.is_set():
+            try:
+                claim = await asyncio.to_thread(queue.claim, worker_id)
+            except Exception:
+                metrics.logger.exception("領取佇列項目失敗")
+                claim = None
+            if claim is None:
+                await idle()
+                continue
+            try:
+                await process(queue, worker_id, claim, cache, jobs)
+            except Exception:
+                metrics.logger.exception("處理佇列項目 %s#%s 時發生未預期的錯誤", claim["job_id"], claim["idx"])
+
+    await asyncio.gather(*(lane() for _ in range(max(1, slots))))
+
+
+def parse_cap(value):
+    engine, _, limit = value.partition("=")
+    if engine not in ENGINES or not limit.isdigit():
+        raise argparse.ArgumentTypeError(f"格式為 引擎=數量，例如 gemini=2（可用引擎：{', '.join(ENGINES)}）")
+    return engine, int(limit)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="格育語音佇列工作行程")
+    parser.add_argument("--queue-db", default=QUEUE_DB, help="佇列資料庫路徑（預設讀取 TTS_QUEUE_DB）")
+    parser.add_argument("--slots", type=int, default=DEFAULT_SLOTS, help="此行程同時處理的項目數")
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument("--cap", type=parse_cap, action="append", default=[],
+                        help="設定某供應商在所有工作行程間的同時請求數上限後結束，例如 --cap gemini=2")
+    args = parser.parse_args(argv)
+    if not args.queue_db:
+        parser.error("請以 --queue-db 或 TTS_QUEUE_DB 指定佇列資料庫")
+
+    queue = WorkQueue(args.queue_db)
+    if args.cap:
+        for engine, limit in args.cap:
+            queue.set_cap(engine, limit)
+        print("目前上限：" + ", ".join(f"{e}={n}" for e, n in sorted(queue.caps().items())), file=sys.stderr)
+        return 0
+
+    async def serve():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            # 收到結束訊號時不再領取新項目，手上的項目完成後才結束
+            loop.add_signal_handler(sig, stop.set)
+        print(f"工作行程 {args.worker_id} 已啟動（{args.slots} 條處理迴圈）", file=sys.stderr)
+        await run_worker(queue, args.worker_id, args.slots, stop)
+
+    asyncio.run(serve())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
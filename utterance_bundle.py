@@ -0,0 +1,101 @@
+"""
+將多筆短文字合併成一次 Edge TTS 請求，再依串流中的 WordBoundary 時間把音訊切回每一筆。
+適用於數百個單字的字卡包：每筆各開一條連線的開銷遠大於合成本身。
+"""
+from audio_trim import cut_mp3_frames, mp3_frame_index
+
+BUNDLE_MAX_CHARS = 40  # 只有不超過此字數的項目才合併
+BUNDLE_MAX_ITEMS = 40  # 每個合併請求最多幾筆
+BUNDLE_MAX_TOTAL_CHARS = 1000
+
+_TERMINALS = "。！？!?；;….．"
+_TICKS_PER_MS = 10_000  # WordBoundary 的 offset / duration 以 100 奈秒為單位
+
+
+def can_bundle(text):
+    return 0 < len(text.strip()) <= BUNDLE_MAX_CHARS
+
+
+def group_units(plan, eligible):
+    """
+    將 plan_batch 的分組整理成工作單位：eligible(text) 為真的相鄰短句合併成一個單位
+    （不超過筆數與總字數上限），其餘各自一個單位。
+    合併單位放在其第一組出現的位置，工作單位的順序仍與輸入順序一致。
+    """
+    units, bundle, chars = [], None, 0
+    for text, members in plan:
+        if not eligible(text):
+            units.append([(text, members)])
+            continue
+        if bundle is None or len(bundle) >= BUNDLE_MAX_ITEMS or chars + len(text) > BUNDLE_MAX_TOTAL_CHARS:
+            bundle, chars = [], 0
+            units.append(bundle)
+        bundle.append((text, members))
+        chars += len(text)
+    return units
+
+
+def join_utterances(texts):
+    """
+    以句末標點與換行串接各筆，讓每筆成為獨立的一句（語調完整、之間有停頓）。
+    返回 (合併文字, [(起, 訖), ...] 各筆在合併文字中的位置)。
+    """
+    parts, spans, pos = [], [], 0
+    for text in texts:
+        text = text.strip()
+        if text[-1] not in _TERMINALS:
+            text += "." if text[-1].isascii() else "。"
+        spans.append((pos, pos + len(text)))
+        parts.append(text)
+        pos += len(text) + 1
+    return "\n".join(parts), spans
+
+
+def locate_items(joined, spans, events):
+    """
+    依 WordBoundary 事件的文字依序對回各筆，返回每筆的 (start_ms, end_ms)；
+    沒有對到任何事件的項目為 None。事件順序與文字位置不一致時全部返回 None。
+    """
+    ranges = [None] * len(spans)
+    cursor = 0
+    item = 0
+    for event in events:
+        word = event.get("text") or ""
+        pos = joined.find(word, cursor) if word else -1
+        if pos < 0:
+            continue
+        cursor = pos + len(word)
+        while item < len(spans) and pos >= spans[item][1]:
+            item += 1
+        if item >= len(spans):
+            break
+        start = event["offset"] / _TICKS_PER_MS
+        end = (event["offset"] + event.get("duration", 0)) / _TICKS_PER_MS
+        current = ranges[item]
+        ranges[item] = (start, end) if current is None else (min(current[0], start), max(current[1], end))
+    located = [r for r in ranges if r is not None]
+    if any(a[1] > b[0] for a, b in zip(located, located[1:])):
+        return [None] * len(spans)
+    return ranges
+
+
+def split_audio(data, ranges):
+    """
+    在相鄰兩筆之間停頓的中點切開 MP3（幀邊界、不重新編碼），返回每筆的 bytes；
+    ranges 中為 None 的項目，以及與其相鄰的項目都返回 None：沒有定位的那一筆的語音
+    不知道落在哪一段停頓裡，兩側的切點都可能把它切進鄰近項目的音訊中。
+    """
+    _, frames = mp3_frame_index(data)
+    if not frames:
+        return [None] * len(ranges)
+    duration = frames[-1][2] + (frames[1][2] - frames[0][2] if len(frames) > 1 else 0.0)
+    results = [None] * len(ranges)
+    for i, current in enumerate(ranges):
+        before = ranges[i - 1] if i > 0 else (0.0, 0.0)
+        after = ranges[i + 1] if i + 1 < len(ranges) else (duration, duration)
+        if current is None or before is None or after is None:
+            continue
+        cut = cut_mp3_frames(data, (before[1] + current[0]) / 2 if i > 0 else 0.0,
+                             (current[1] + after[0]) / 2 if i + 1 < len(ranges) else duration)
+        results[i] = cut[0] if cut else None
+    return results
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from engine_registry import backend
+
+DEFAULT_CATALOG_PATH = os.environ.get(
+    "TTS_VOICE_CATALOG", str(Path.home() / ".cache" / "geyu-tts" / "edge_voices.json"))
+DEFAULT_TTL_SECONDS = int(os.environ.get("TTS_VOICE_CATALOG_TTL_HOURS", "24")) * 3600
+
+# 只保留介面與查詢會用到的欄位
+_FIELDS = ("ShortName", "Locale", "Gender", "FriendlyName")
+
+
+def _gender_from_label(label):
+    if "女" in label:
+        return "Female"
+    if "男" in label:
+        return "Male"
+    return ""
+
+
+def seed_voices(voices_by_category):
+    """由內建的 VOICES_EDGE 表建立離線備用清單（目錄尚未下載時使用）"""
+    seeds = []
+    for voices in voices_by_category.values():
+        for short_name, label in voices.items():
+            seeds.append({
+                "ShortName": short_name,
+                "Locale": "-".join(short_name.split("-")[:2]),
+                "Gender": _gender_from_label(label),
+                "FriendlyName": label,
+            })
+    return seeds
+
+
+class VoiceCatalog:
+    """
+    Edge TTS 音色目錄。
+    首次使用時從網路取得完整清單並存檔，TTL 內直接讀檔；過期時在背景執行緒更新，
+    查詢永遠只讀記憶體中的索引，不會等待網路。
+    """
+
+    def __init__(self, path=DEFAULT_CATALOG_PATH, ttl=DEFAULT_TTL_SECONDS, seed=None):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.fetched_at = 0.0
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._index(seed or [])
+        self.load()
+
+    def _index(self, voices):
+        by_name, by_locale, by_gender = {}, {}, {}
+        for v in voices:
+            by_name[v["ShortName"]] = v
+            by_locale.setdefault(v["Locale"], []).append(v)
+            by_gender.setdefault(v.get("Gender", ""), []).append(v)
+        with self._lock:
+            self.voices = list(voices)
+            self.by_name = by_name
+            self.by_locale = by_locale
+            self.by_gender = by_gender
+
+    def load(self):
+        """讀取磁碟上的目錄；不存在或損毀時保留目前內容"""
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            voices = data["voices"]
+        except (OSError, ValueError, KeyError):
+            return False
+        self._index(voices)
+        self.fetched_at = float(data.get("fetched_at", 0))
+        return True
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"fetched_at": self.fetched_at, "voices": self.voices}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def is_stale(self):
+        return time.time() - self.fetched_at > self.ttl
+
+    async def fetch(self):
+        """從微軟伺服器取得最新音色清單並更新索引與磁碟檔案"""
+        raw = await backend("edge_tts").list_voices()
+        voices = [{k: v.get(k, "") for k in _FIELDS} for v in raw]
+        self._index(voices)
+        self.fetched_at = time.time()
+        self.save()
+        return voices
+
+    def refresh(self):
+        """同步更新（供 CLI 或偵錯按鈕使用）"""
+        try:
+            asyncio.run(self.fetch())
+            self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)
+            raise
+
+    def refresh_in_background(self, force=False):
+        """目錄過期時在背景執行緒更新，立即返回；同一時間只會有一個更新"""
+        if not force and not self.is_stale():
+            return False
+        with self._lock:
+            if self._refreshing:
+                return False
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, name="voice-catalog-refresh", daemon=True).start()
+        return True
+
+    def locales(self):
+        return sorted(self.by_locale)
+
+    def get(self, short_name):
+        return self.by_name.get(short_name)
+
+    def find(self, locale=None, gender=None, name=None):
+        """依語言區域、性別與名稱（子字串，不分大小寫）查詢音色"""
+        if locale is not None:
+            candidates = self.by_locale.get(locale, [])
+        elif gender is not None:
+            candidates = self.by_gender.get(gender, [])
+        else:
+            candidates = self.voices
+        if gender is not None:
+            candidates = [v for v in candidates if v.get("Gender") == gender]
+        if name:
+            needle = name.lower()
+            candidates = [v for v in candidates
+                          if needle in v["ShortName"].lower() or needle in v.get("FriendlyName", "").lower()]
+        return list(candidates)
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_voice_catalog(seed=None):
+    """進程內共用的音色目錄；過期時自動觸發背景更新"""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = VoiceCatalog(seed=seed)
+    _catalog.refresh_in_background()
+    return _catalog
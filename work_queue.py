@@ -0,0 +1,372 @@
+"""
+以 SQLite 為後端的持久化工作佇列，供任意數量的合成工作行程（tts_worker.py）共同消化。
+
+設定 TTS_QUEUE_DB 後，介面（app.py）只把 BatchJob 的待合成項目排入佇列並讀取結果，不在自己的行程中合成；
+工作行程與介面必須在同一台主機上，共用同一個佇列資料庫與 job 目錄（TTS_JOBS_DIR）：
+SQLite 的 WAL 模式以共享記憶體維護索引，只在單一主機內有效，佇列資料庫放在 NFS/SMB 等網路檔案系統上
+會讓不同主機的領取與租約互相覆蓋，同一項目可能被重複領取甚至損毀資料庫。
+每個供應商的同時請求數上限記在資料庫中，所有工作行程領取項目時一起遵守；
+工作行程中每個項目同時只送出一個請求（長文分段依序合成、不送對沖請求），
+學期初大量匯出時再多開工作行程也不會超出供應商配額。
+工作行程領取項目時取得有期限的租約並定期續約；行程中斷時租約過期，項目自動回到佇列。
+排入時與行程內執行相同，內容重複的項目（見 tts_core.plan_batch）只排入第一筆，其餘記在 dups 中、完成後沿用同一份音訊；
+Edge 的短句合併請求（edge_bundle）則不適用，佇列模式中每個項目各自一個請求。
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from batch_jobs import BatchJob
+from metrics import BatchMetrics, logger
+from tts_core import DEFAULT_CONCURRENCY, plan_batch
+
+# 佇列資料庫路徑，須位於本機磁碟（不可放在網路檔案系統上，見模組說明）；未設定時介面在行程內執行批次（見 job_runner.JobRunner）
+QUEUE_DB = os.environ.get("TTS_QUEUE_DB", "")
+LEASE_SECONDS = float(os.environ.get("TTS_QUEUE_LEASE_SECONDS", "60"))
+MAX_CLAIMS = 3  # 同一項目因工作行程中斷而重新領取的次數上限，超過即標記失敗
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    engine TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    options TEXT NOT NULL,
+    session_id TEXT,
+    status TEXT NOT NULL,
+    resumed INTEGER NOT NULL DEFAULT 0,
+    submitted REAL,
+    started REAL,
+    finished REAL,
+    synced INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS items (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    fname TEXT NOT NULL,
+    text TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    claims INTEGER NOT NULL DEFAULT 0,
+    file TEXT,
+    error TEXT,
+    record TEXT,
+    dups TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS items_status ON items (status, job_id);
+CREATE TABLE IF NOT EXISTS caps (
+    engine TEXT PRIMARY KEY,
+    max_running INTEGER NOT NULL
+);
+"""
+
+_ACTIVE = ("queued", "running")
+
+
+class WorkQueue:
+    """
+    佇列資料庫的存取介面；每個執行緒各自開一條連線，同一台主機上跨行程的互斥由 SQLite 的 BEGIN IMMEDIATE 處理。
+    jobs 為排入的批次（設定不含 API Key，工作行程自己的環境變數提供），items 為逐項的狀態與租約，
+    caps 為各供應商的全域同時請求數上限（未設定時為 tts_core.DEFAULT_CONCURRENCY）。
+    """
+
+    def __init__(self, path=QUEUE_DB):
+        self.path = str(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        conn = self._connect()
+        conn.executescript(_SCHEMA)
+        if "dups" not in {row["name"] for row in conn.execute("PRAGMA table_info(items)")}:
+            conn.execute("ALTER TABLE items ADD COLUMN dups TEXT")  # 舊版建立的佇列資料庫
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._connect())
+
+    # --- 供應商上限 ---
+    def set_cap(self, engine, max_running):
+        with self._transaction() as conn:
+            conn.execute("INSERT INTO caps (engine, max_running) VALUES (?, ?) "
+                         "ON CONFLICT(engine) DO UPDATE SET max_running = excluded.max_running",
+                         (engine, max(1, int(max_running))))
+
+    def caps(self):
+        caps = dict(DEFAULT_CONCURRENCY)
+        caps.update({row["engine"]: row["max_running"] for row in self._connect().execute("SELECT * FROM caps")})
+        return caps
+
+    # --- 介面端 ---
+    def enqueue(self, job, settings, session_id, options):
+        """
+        排入 job 中尚未完成的項目；同一個 job 已在排隊或執行中時不重複排入，返回 False。
+        已結束的同一個 job 再次排入時沿用磁碟上已完成的項目，只重排剩下的。
+        內容重複的項目只排入第一筆，其餘的索引記在該筆的 dups。
+        """
+        settings = {k: v for k, v in settings.items() if k != "api_key"}
+        todo = job.pending_indices()
+        plan = plan_batch([(job.entries[i]["id"], job.entries[i]["text"]) for i in todo], settings)
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT status FROM jobs WHERE job_id = ?", (job.job_id,)).fetchone()
+            if row is not None and row["status"] in _ACTIVE:
+                return False
+            conn.execute("DELETE FROM items WHERE job_id = ?", (job.job_id,))
+            conn.execute("INSERT OR REPLACE INTO jobs (job_id, engine, settings, options, session_id, status, resumed, "
+                         "submitted, started, finished, synced) VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL, 0)",
+                         (job.job_id, settings["engine"], json.dumps(settings, ensure_ascii=False),
+                          json.dumps(options), session_id, "queued" if todo else "done",
+                          len(job.entries) - len(todo), now))
+            conn.executemany("INSERT INTO items (job_id, idx, fname, text, status, dups) VALUES (?, ?, ?, ?, 'pending', ?)",
+                             [(job.job_id, todo[members[0]], job.entries[todo[members[0]]]["id"], text,
+                               json.dumps([todo[k] for k in members[1:]]) if len(members) > 1 else None)
+                              for text, members in plan])
+            if not todo:
+                conn.execute("UPDATE jobs SET finished = ? WHERE job_id = ?", (now, job.job_id))
+        return True
+
+    def cancel(self, job_id):
+        """取消工作：尚未領取的項目不再執行，已在合成中的項目完成後保留"""
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE job_id = ? AND status IN (?, ?)",
+                         (time.time(), job_id, *_ACTIVE))
+
+    def job(self, job_id):
+        return self._connect().execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+    def items(self, job_id):
+        return self._connect().execute("SELECT * FROM items WHERE job_id = ? ORDER BY idx", (job_id,)).fetchall()
+
+    def jobs_ahead(self, job_id):
+        """比 job_id 更早提交、仍在排隊或執行中的工作數"""
+        row = self.job(job_id)
+        if row is None:
+            return 0
+        return self._connect().execute("SELECT COUNT(*) FROM jobs WHERE status IN (?, ?) AND submitted < ?",
+                                       (*_ACTIVE, row["submitted"])).fetchone()[0]
+
+    def running_jobs(self):
+        return self._connect().execute("SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+
+    def mark_synced(self, job_id):
+        """搶下將結果寫回 job manifest 的權利；多個介面行程同時看到工作結束時只有一個返回 True"""
+        with self._transaction() as conn:
+            busy = conn.execute("SELECT COUNT(*) FROM items WHERE job_id = ? AND status = 'running'",
+                                (job_id,)).fetchone()[0]
+            if busy:
+                return False
+            return conn.execute("UPDATE jobs SET synced = 1 WHERE job_id = ? AND synced = 0 AND status NOT IN (?, ?)",
+                                (job_id, *_ACTIVE)).rowcount == 1
+
+    # --- 工作行程端 ---
+    def claim(self, worker_id):
+        """
+        領取一個待合成項目並取得租約；沒有可執行的項目（或各供應商都已達上限）時返回 None。
+        執行中項目最少的工作階段優先，其次依提交順序，同一個 job 內依項目順序。
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            self._expire_leases(conn, now)
+            caps = self.caps()
+            running = dict(conn.execute("SELECT j.engine, COUNT(*) FROM items i JOIN jobs j ON j.job_id = i.job_id "
+                                        "WHERE i.status = 'running' GROUP BY j.engine").fetchall())
+            engines = [engine for engine, cap in caps.items() if running.get(engine, 0) < cap]
+            if not engines:
+                return None
+            row = conn.execute(
+                "SELECT i.job_id, i.idx, i.fname, i.text, i.dups, j.settings, j.options FROM items i "
+                "JOIN jobs j ON j.job_id = i.job_id "
+                f"WHERE i.status = 'pending' AND j.status IN (?, ?) AND j.engine IN ({','.join('?' * len(engines))}) "
+                "ORDER BY (SELECT COUNT(*) FROM items r JOIN jobs rj ON rj.job_id = r.job_id "
+                "          WHERE r.status = 'running' AND rj.session_id IS j.session_id), j.submitted, i.idx "
+                "LIMIT 1", (*_ACTIVE, *engines)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE items SET status = 'running', worker = ?, lease_until = ?, claims = claims + 1 "
+                         "WHERE job_id = ? AND idx = ?", (worker_id, now + LEASE_SECONDS, row["job_id"], row["idx"]))
+            conn.execute("UPDATE jobs SET status = 'running', started = COALESCE(started, ?) "
+                         "WHERE job_id = ? AND status = 'queued'", (now, row["job_id"]))
+        return {"job_id": row["job_id"], "idx": row["idx"], "fname": row["fname"], "text": row["text"],
+                "dups": item_dups(row), "settings": json.loads(row["settings"]), "options": json.loads(row["options"])}
+
+    def renew(self, job_id, idx, worker_id):
+        """延長租約；項目已不屬於此工作行程（租約過期被重新領取）時返回 False"""
+        with self._transaction() as conn:
+            return conn.execute("UPDATE items SET lease_until = ? WHERE job_id = ? AND idx = ? AND worker = ? "
+                                "AND status = 'running'",
+                                (time.time() + LEASE_SECONDS, job_id, idx, worker_id)).rowcount == 1
+
+    def complete(self, job_id, idx, worker_id, file=None, error=None, record=None):
+        """回報項目結果（成功時 file 為輸出檔名，失敗時 error 為錯誤訊息）；整個 job 因此結束時更新 job 狀態"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("UPDATE items SET status = ?, file = ?, error = ?, record = ?, lease_until = NULL "
+                         "WHERE job_id = ? AND idx = ? AND worker = ?",
+                         ("failed" if error is not None else "done", file, None if error is None else str(error),
+                          json.dumps(record, ensure_ascii=False, default=str) if record is not None else None,
+                          job_id, idx, worker_id))
+            self._settle(conn, now)
+
+    def _expire_leases(self, conn, now):
+        # 工作行程中斷：租約過期的項目回到佇列，多次中斷的項目改為失敗，避免一直拖垮工作行程
+        conn.execute("UPDATE items SET status = 'failed', error = '工作行程多次中斷，放棄此項目', worker = NULL "
+                     "WHERE status = 'running' AND lease_until < ? AND claims >= ?", (now, MAX_CLAIMS))
+        expired = conn.execute("UPDATE items SET status = 'pending', worker = NULL "
+                               "WHERE status = 'running' AND lease_until < ?", (now,)).rowcount
+        if expired:
+            logger.warning("%d 個佇列項目的租約過期，重新排入", expired)
+        self._settle(conn, now)
+
+    @staticmethod
+    def _settle(conn, now):
+        conn.execute("UPDATE jobs SET status = 'done', finished = ? WHERE status IN (?, ?) AND NOT EXISTS "
+                     "(SELECT 1 FROM items i WHERE i.job_id = jobs.job_id AND i.status IN ('pending', 'running'))",
+                     (now, *_ACTIVE))
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT；寫入鎖在交易開始時即取得，領取與計數之間不會被其他行程插隊"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+class QueueJobHandle:
+    """
+    佇列中某個 job 的狀態快照，屬性與 job_runner.JobHandle 相同，介面可共用同一套顯示邏輯。
+    每次 QueueRunner.get 都由資料庫重新建立。
+    """
+
+    def __init__(self, job, row, items):
+        self.job = job
+        self.settings = json.loads(row["settings"])
+        self.session_id = row["session_id"]
+        self.status = row["status"]
+        self.submitted, self.started, self.finished = row["submitted"], row["started"], row["finished"]
+        self.error = None
+        resumed = row["resumed"]
+        self.done = resumed + sum(1 + len(item_dups(item)) for item in items if item["status"] == "done")
+        self.total = resumed + sum(1 + len(item_dups(item)) for item in items)
+        self.messages = []
+        self.batch_metrics = BatchMetrics(row["engine"])
+        summary = {"ok": 0, "failed": [], "retries": 0, "hedged": 0, "fallback": [], "resumed": resumed,
+                   "deduplicated": sum(len(item_dups(item)) for item in items)}
+        for item in items:
+            fnames = [item["fname"]] + [job.entries[i]["id"] for i in item_dups(item)]
+            entry = json.loads(item["record"]) if item["record"] else None
+            if entry is not None:
+                self.batch_metrics.items.append(entry)
+                summary["retries"] += entry["retries"]
+                summary["hedged"] += bool(entry["hedged"])
+                for warning in entry["warnings"]:
+                    self.messages.append(("warning", f"{item['fname']}：{warning}"))
+            if item["status"] == "done":
+                summary["ok"] += len(fnames)
+                if entry is not None and entry["fallback"]:
+                    summary["fallback"].extend((fname, entry["fallback"]) for fname in fnames)
+            elif item["status"] == "failed":
+                for fname in fnames:
+                    summary["failed"].append((fname, item["error"]))
+                    self.messages.append(("error", f"檔案 {fname} 失敗: {item['error']}"))
+        self.summary = None if self.active else summary
+
+    @property
+    def job_id(self):
+        return self.job.job_id
+
+    @property
+    def active(self):
+        return self.status in _ACTIVE
+
+    def recent_messages(self, limit=None):
+        return list(self.messages[-limit:] if limit else self.messages)
+
+
+class QueueRunner:
+    """
+    佇列模式下取代 job_runner.JobRunner 的介面端：submit 只排入佇列，合成交給 tts_worker.py。
+    工作結束後，第一個讀到結果的介面行程將各項狀態寫回 job 的 manifest（供續跑與打包下載），並呼叫 on_finish。
+    """
+
+    def __init__(self, path=QUEUE_DB):
+        self.queue = WorkQueue(path)
+        self._on_finish = {}  # job_id -> on_finish(handle)；只在提交的行程內有效
+
+    def submit(self, job, settings, session_id, on_finish=None, **options):
+        # concurrency 由全域的供應商上限取代；快取物件改為旗標，由工作行程使用自己的磁碟快取
+        options = {"use_cache": options.get("cache") is not None, "rpm": options.get("rpm"),
+                   "max_attempts": options.get("max_attempts")}
+        self.queue.enqueue(job, settings, session_id, options)
+        if on_finish is not None:
+            self._on_finish[job.job_id] = on_finish
+        return self.get(job.job_id)
+
+    def get(self, job_id):
+        row = self.queue.job(job_id) if job_id else None
+        if row is None:
+            return None
+        job = BatchJob.load(job_id)
+        if job is None:
+            return None
+        handle = QueueJobHandle(job, row, self.queue.items(job_id))
+        if not handle.active and not row["synced"] and self.queue.mark_synced(job_id):
+            sync_job(job, self.queue.items(job_id))
+            on_finish = self._on_finish.pop(job_id, None)
+            if on_finish is not None:
+                try:
+                    on_finish(handle)
+                except Exception:
+                    logger.exception("批次工作 %s 的結束回呼失敗", job_id)
+        return handle
+
+    def queue_position(self, handle):
+        return self.queue.jobs_ahead(handle.job_id) if handle.status == "queued" else 0
+
+    def running_count(self):
+        return self.queue.running_jobs()
+
+    def cancel(self, job_id):
+        self.queue.cancel(job_id)
+
+
+def item_dups(item):
+    """與此佇列項目內容相同、沿用其結果的其他項目索引"""
+    return json.loads(item["dups"]) if item["dups"] else []
+
+
+def sync_job(job, items):
+    """
+    將佇列中的項目結果寫回 job manifest（一次存檔）；之後續跑、打包與 BatchJob.counts 都以 manifest 為準。
+    重複項目的輸出檔由工作行程以「編號 + 副檔名」寫出，這裡依同樣規則記錄檔名。
+    """
+    for item in items:
+        ext = item["file"][len(item["fname"]):] if item["file"] else ""
+        for idx in [item["idx"]] + item_dups(item):
+            entry = job.entries[idx]
+            if item["status"] == "done":
+                entry.update(status="done", file=f"{entry['id']}{ext}", error=None)
+                record = json.loads(item["record"]) if item["record"] else {}
+                if record.get("fallback"):
+                    entry["fallback"] = record["fallback"]
+            elif item["status"] == "failed":
+                entry.update(status="failed", error=item["error"])
+    job.save()
@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+# 壓縮檔不超過此大小時在記憶體中打包、以 download_button 下載，超過時直接寫到靜態服務目錄
+DEFAULT_SPOOL_MAX_MB = int(os.environ.get("TTS_EXPORT_SPOOL_MAX_MB", "32"))
+
+# 已落地的壓縮檔透過 Streamlit 靜態檔服務（server.enableStaticServing）直接由磁碟串流下載
+EXPORT_DIR = Path(__file__).resolve().parent / "static" / "exports"
+EXPORT_URL_PREFIX = "app/static/exports"
+EXPORT_TTL_SECONDS = int(os.environ.get("TTS_EXPORT_TTL_HOURS", "6")) * 3600
+
+
+def open_spooled_archive(max_mb=DEFAULT_SPOOL_MAX_MB):
+    """建立壓縮檔輸出目標：小於 max_mb 時留在記憶體，超過後自動轉為磁碟暫存檔"""
+    return tempfile.SpooledTemporaryFile(max_size=max_mb * 1024 * 1024, mode="w+b")
+
+
+def cleanup_exports(ttl=EXPORT_TTL_SECONDS):
+    """刪除超過保存期限的匯出檔"""
+    if not EXPORT_DIR.exists():
+        return
+    cutoff = time.time() - ttl
+    for job_dir in EXPORT_DIR.iterdir():
+        try:
+            if job_dir.stat().st_mtime < cutoff:
+                shutil.rmtree(job_dir, ignore_errors=True)
+        except OSError:
+            pass
+
+
+def new_export_path(file_name="audio.zip"):
+    """
+    在靜態服務目錄中配置一個新的匯出檔位置，返回 (磁碟路徑, 可下載的相對 URL)。
+    呼叫端直接把壓縮檔寫到該路徑，不經暫存檔再複製一次。
+    """
+    cleanup_exports()
+    job_dir = EXPORT_DIR / uuid.uuid4().hex
+    job_dir.mkdir(parents=True, exist_ok=True)
+    return job_dir / file_name, f"{EXPORT_URL_PREFIX}/{job_dir.name}/{file_name}"